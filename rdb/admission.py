@@ -0,0 +1,102 @@
+"""Admission control for the server's listeners.
+
+   Handlers run one at a time on the IOLoop, so requests that the
+   server doesn't have time for wait in the IOLoop rather than in any
+   queue of ours. We notice them by how late the IOLoop runs a timer
+   that we keep rescheduling ('lag', the time a new request has to
+   wait for its turn), and how much of the time is spent handling
+   requests ('busy'). Once either gets too high, new requests are
+   refused immediately, lowest priority first, so that clients can go
+   elsewhere instead of all timing out together"""
+
+import time
+
+import tornado.ioloop
+
+# request priorities. Requests with a priority of None are never
+# refused
+HIGH = 0 # single-key operations
+NORMAL = 1 # bulk operations
+LOW = 2 # scans and dumps
+
+priority_names = {HIGH: 'high', NORMAL: 'normal', LOW: 'low'}
+
+
+class AdmissionControl(object):
+
+    interval = 0.05 # seconds between lag measurements
+    smoothing = 0.3 # weight of each new measurement
+
+    def __init__(self, max_lag = 0.5, max_busy = 0.9, retry_after = 1,
+                 io_loop = None):
+        """Requests of priority p are refused while the lag is over
+           max_lag / 2**p seconds. LOW priority requests are also
+           refused while more than max_busy of the time is being spent
+           on requests. Clients are told to retry after 'retry_after'
+           seconds"""
+        self.max_lag = max_lag
+        self.max_busy = max_busy
+        self.retry_after = retry_after
+        self._io_loop = io_loop
+
+        self.lag = 0.0
+        self.busy = 0.0
+        self._busy_time = 0.0
+        self._last_tick = None
+
+        self.admitted = dict.fromkeys(priority_names, 0)
+        self.shed = dict.fromkeys(priority_names, 0)
+
+    @property
+    def io_loop(self):
+        # not until it's needed, since the server's processes are
+        # forked after we're made, and each needs an IOLoop of its own
+        if self._io_loop is None:
+            self._io_loop = tornado.ioloop.IOLoop.instance()
+        return self._io_loop
+
+    def start(self):
+        self._last_tick = time.time()
+        self._schedule()
+
+    def _schedule(self):
+        deadline = time.time() + self.interval
+        self.io_loop.add_timeout(deadline, lambda: self._tick(deadline))
+
+    def _tick(self, deadline):
+        now = time.time()
+        self.lag += self.smoothing * (max(0, now - deadline) - self.lag)
+        elapsed = now - self._last_tick
+        if elapsed > 0:
+            busy = min(1.0, self._busy_time / elapsed)
+            self.busy += self.smoothing * (busy - self.busy)
+        self._busy_time = 0.0
+        self._last_tick = now
+        self._schedule()
+
+    def admit(self, priority):
+        "Whether to handle a request of this priority now"
+        if priority is None:
+            return True
+        if (self.lag > self.max_lag / 2 ** priority
+            or (priority == LOW and self.busy > self.max_busy)):
+            self.shed[priority] += 1
+            return False
+        self.admitted[priority] += 1
+        return True
+
+    def done(self, seconds):
+        "Account for the time taken by a request that we admitted"
+        self._busy_time += seconds
+
+    def stats(self):
+        return {
+            'lag': self.lag,
+            'busy': self.busy,
+            'max_lag': self.max_lag,
+            'max_busy': self.max_busy,
+            'admitted': dict((priority_names[p], n)
+                             for (p, n) in self.admitted.iteritems()),
+            'shed': dict((priority_names[p], n)
+                         for (p, n) in self.shed.iteritems()),
+            }
@@ -1,6 +1,8 @@
 from optparse import OptionParser
 
-from .. rdbutil import NotFound, DictNature
+from .. rdbutil import NotFound, DictNature, version_of
+from .. import rdbops
+from .. import rdbcodec
 
 class NoneResult(object):
     """stored in caches instead of pickling None itself so that we can
@@ -14,9 +16,36 @@ class NoInclude(object):
     pass
 
 
+class ValueReader(object):
+    """A stored value, for callers that send it on a piece at a time
+       rather than all at once"""
+    piece_size = 256 * 1024
+
+    def __init__(self, value):
+        self.value = value
+        self.size = len(value)
+        self.version = version_of(value)
+        self.encoded = rdbcodec.is_encoded(value)
+
+    def read(self, start = 0, end = None):
+        """Yields the bytes from 'start' up to 'end' (or the end of
+           the value) in pieces"""
+        end = self.size if end is None else min(end, self.size)
+        for offset in xrange(start, end, self.piece_size):
+            yield self.value[offset:min(offset + self.piece_size, end)]
+
+
 class StorageBackend(DictNature):
     supports_iteration = False # not all backends support retrieving
                                # all of their keys
+    supports_ttl = False # or expiring them
+    supports_uploads = False # or having values written a piece at a
+                             # time (see ChunkedBackend)
+    supports_backup = False # or being backed up while they're in use
+    supports_indexes = False # or keeping an ordered index alongside
+                             # (see IndexedBackend)
+    supports_processes = False # or being written by the server's
+                               # processes (--processes) at once
     def __init__(self, options, args):
         pass
 
@@ -51,15 +80,22 @@ class StorageBackend(DictNature):
            a NotFound exception"""
         raise NotImplementedError
 
-    def put(self, key, value):
+    def put(self, key, value, ttl = None):
         """Create or replace a key/value, storing a pickled NoneResult
-           for stored-none values. Implementations can take advantage of
+           for stored-none values. If 'ttl' is given, the key expires
+           after that many seconds, which only backends that set
+           'supports_ttl' can do. Implementations can take advantage of
            this class's None handling by implementing _put"""
         assert isinstance(key, str) and isinstance(value, str)
 
-        self._put(key, NoneResult() if value is None else value)
+        value = NoneResult() if value is None else value
+        if ttl is None:
+            self._put(key, value)
+        else:
+            assert self.supports_ttl
+            self._put(key, value, ttl)
 
-    def _put(self, key, value):
+    def _put(self, key, value, ttl = None):
         raise NotImplementedError
 
     def delete(self, key):
@@ -69,6 +105,16 @@ class StorageBackend(DictNature):
     def _delete(self, key):
         raise NotImplementedError
 
+    def delete_multi(self, keys):
+        """Remove several keys at once. Implementations can take
+           advantage of this by implementing _delete_multi"""
+        self._delete_multi([str(key) for key in keys])
+
+    def _delete_multi(self, keys):
+        "The default implementation calls _delete for each key"
+        for key in keys:
+            self._delete(key)
+
     def has_key(self, key):
         """Returns true if the given key exists in the store."""
         raise NotImplementedError
@@ -79,6 +125,27 @@ class StorageBackend(DictNature):
            backends implement this."""
         raise NotImplementedError
 
+    def scan(self, start = None, limit = 1000):
+        """Returns a list of up to 'limit' (key, value) pairs
+           following the key 'start' (or from the beginning if it's
+           None), and the key to pass as 'start' to continue the scan,
+           or None when there's nothing left. The scan has to carry on
+           from where 'start' was even if it has been deleted since,
+           so that callers paging through a store that's being written
+           to get to the end. This very naive default implementation
+           walks items() from the beginning for every page, and so
+           doesn't: backends that set 'supports_iteration' override it"""
+        ret = []
+        found = start is None
+        for key, value in self.items():
+            if not found:
+                found = key == start
+                continue
+            if len(ret) == limit:
+                return ret, ret[-1][0]
+            ret.append((key, value))
+        return ret, None
+
     def get_multi(self, keys, default = NoInclude):
         """Retrieve multiple keys from the backend at once, returning
            a dictionary of keys to values. Non-found keys will be set
@@ -125,11 +192,12 @@ class StorageBackend(DictNature):
                 pass
         return ret
 
-    def put_multi(self, keys):
+    def put_multi(self, keys, ttl = None):
         """Store multiple values at once, using a dictionary or
-           iterator yielding tuples. Implementations can take
-           advantage of this class's iterator and None handling by
-           implementing _put_multi."""
+           iterator yielding tuples, all expiring after 'ttl' seconds
+           if it's given. Implementations can take advantage of this
+           class's iterator and None handling by implementing
+           _put_multi."""
         if isinstance(keys, dict):
             keys = keys.iteritems()
 
@@ -140,13 +208,117 @@ class StorageBackend(DictNature):
         assert all((isinstance(key, str) and isinstance(val, str))
                    for (key, val) in keys.iteritems())
 
-        self._put_multi(keys)
+        if ttl is None:
+            self._put_multi(keys)
+        else:
+            assert self.supports_ttl
+            self._put_multi(keys, ttl)
 
-    def _put_multi(self, keys):
+    def _put_multi(self, keys, ttl = None):
         """The default implementation of _put_multi calls _put
            multiple times"""
         for key, value in keys.iteritems():
-            self._put(key, value)
+            if ttl is None:
+                self._put(key, value)
+            else:
+                self._put(key, value, ttl)
+
+    def update(self, key, func, ttl = None):
+        """Atomically replace the value of 'key' with func(value),
+           where value is None if the key isn't there, and return the
+           new value. An exception from func leaves the value as it
+           is. Unless 'ttl' is given, the key keeps its old expiry
+           time.
+
+           This implementation is only atomic because the server
+           handles one request at a time, so backends whose storage
+           is shared with other processes need to do better"""
+        value = func(self.get(key, None))
+        if ttl is None:
+            ttl = self.ttl(key) or None
+        self.put(key, value, ttl)
+        return value
+
+    def incr(self, key, delta = 1, ttl = None):
+        """Atomically add 'delta' to the integer stored at 'key' (or 0
+           if it isn't there) and return the new stored value, raising
+           Conflict if it isn't an integer. This implementation uses
+           update(), so backends that can increment values themselves
+           should override it"""
+        return self.update(key, rdbops.atomic_op('incr', delta), ttl)
+
+    def ttl(self, key):
+        """Returns the number of seconds until a key expires, or None
+           if it doesn't (or the backend can't tell)"""
+        return None
+
+    def get_reader(self, key):
+        """Returns a ValueReader for the value of 'key', raising
+           NotFound if it isn't there. Backends that can read values a
+           piece at a time should override this, so that big values
+           are never all in memory at once"""
+        return ValueReader(self.get(key))
+
+    # Uploads write a value a piece at a time, for backends that set
+    # 'supports_uploads': begin_upload(key, ttl) returns an upload id
+    # and the size that every piece but the last has to be,
+    # upload_part(upload, data) adds the next piece (raising NotFound
+    # for uploads that we don't know about), commit_upload(upload)
+    # stores the value under the key and returns its version, and
+    # abort_upload(upload) forgets it
+
+    def begin_upload(self, key, ttl = None):
+        raise NotImplementedError
+
+    def upload_part(self, upload, data):
+        raise NotImplementedError
+
+    def commit_upload(self, upload):
+        raise NotImplementedError
+
+    def abort_upload(self, upload):
+        raise NotImplementedError
+
+    # Backups, for backends that set 'supports_backup': begin_backup()
+    # returns a backup in progress, whose read() returns the next
+    # piece of it as a string of records, or '' once it's all been
+    # read, and whose close() stops it. Reading it can be spread out
+    # between other requests. restore(f) replaces everything in the
+    # store with a backup read from the file 'f', returning how many
+    # records it had
+
+    def begin_backup(self):
+        raise NotImplementedError
+
+    def restore(self, f):
+        raise NotImplementedError
+
+    # The index, for backends that set 'supports_indexes', is an
+    # ordered set of byte strings kept apart from the keys and values:
+    # index_put(entries) and index_delete(entries) add and remove
+    # them, and index_scan(start, end, limit) returns up to 'limit'
+    # of them from 'start' up to (but not including) 'end', in order
+
+    def index_put(self, entries):
+        raise NotImplementedError
+
+    def index_delete(self, entries):
+        raise NotImplementedError
+
+    def index_scan(self, start, end, limit = 1000):
+        raise NotImplementedError
+
+    def expire(self, limit = 1000):
+        """Remove up to 'limit' keys that have expired, returning how
+           many were removed. The server calls this periodically for
+           backends that need to do their own reaping"""
+        return 0
+
+    def tick(self):
+        """The server calls this several times a second, between
+           requests, for backends that have background work to do a
+           little at a time"""
+        pass
 
     def stats(self):
         """Returns a dictionary describing statistics and status
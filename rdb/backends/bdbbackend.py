@@ -1,8 +1,18 @@
 import os.path
+import math
+import time
+import fcntl
+import shutil
+import struct
+import tempfile
+
+import simplejson as json
 
 from backend import StorageBackend
 
 from .. rdbutil import NotFound, DictNature, trace
+from .. rdbutil import pack_record, read_records, record_header
+from .. bloomfilter import BloomFilter
 
 try:
     from bsddb3 import db
@@ -10,8 +20,181 @@ try:
 except ImportError:
     have_bdb=False
 
+def _cursor_op(op, *a, **kw):
+    "Run a cursor operation, returning None instead of raising on not-found"
+    try:
+        return op(*a, **kw)
+    except db.DBNotFoundError:
+        return None
+
+# Values stored with a TTL are prefixed with this byte and their
+# expiry time as a big-endian unsigned int. Values that clients send
+# us are JSON or start with rdbcodec.MAGIC, and CompressedBackend's and
+# ChunkedBackend's start with their own tags, so it can't be mistaken
+# for one of those
+EXPIRY_TAG = '\x02'
+expiry_header = struct.Struct('!cI')
+
+def _expiry_key(key, data):
+    """The key of a data_db record in the expiry index: its expiry
+       time, which sorts in time order as a big-endian int"""
+    if data.startswith(EXPIRY_TAG):
+        return data[1:expiry_header.size]
+    return db.DB_DONOTINDEX
+
+def _own_key(key, data):
+    """The key of a data_db record in the key index, which is just
+       its key, so that the index has them in order"""
+    return key
+
+def _with_expiry(value, ttl):
+    "A value to store that expires after 'ttl' seconds"
+    return expiry_header.pack(EXPIRY_TAG,
+                              int(math.ceil(time.time() + ttl))) + value
+
+def _live_value(stored, now):
+    """Strip the expiry header (if any) off of a stored value,
+       returning None if it has expired"""
+    if stored is None or not stored.startswith(EXPIRY_TAG):
+        return stored
+    tag, expires = expiry_header.unpack(stored[:expiry_header.size])
+    if expires <= now:
+        return None
+    return stored[expiry_header.size:]
+
+class BDBBackup(object):
+    """A backup in progress. It walks the key index a page at a time,
+       with a cursor that's closed between pages so that writes (which
+       CDB would make wait for it) can carry on, and the backend adds
+       the writes made in the meantime to a spool file, which is sent
+       after the walk. Restoring it replays them over
+       what the walk saw, which leaves the store as it was when the
+       backup finished.
+
+       It's records: an h record with a JSON header, p (with values as
+       they're stored) and d records, and an e record with the number
+       of p and d records, so that a truncated backup can be told
+       from a whole one"""
+
+    format = 1
+
+    # the most records, and about the most bytes, for each read()
+    page_records = 1000
+    page_bytes = 1024 * 1024
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.spool = tempfile.TemporaryFile(dir = backend.basedir,
+                                            prefix = 'backup.')
+        self.spooled = 0 # bytes of it written
+        self.sent = 0 # bytes of it read
+        self.walked_to = None # the last key that the walk has sent
+        self.records = 0
+        self.started = time.time()
+        self.state = 'header' # then 'walk', 'spool' and 'done'
+
+    def add(self, op, key, value):
+        "Called by the backend for each write while we're going"
+        self.spool.seek(self.spooled)
+        record = pack_record(op, key, value)
+        self.spool.write(record)
+        self.spooled += len(record)
+
+    def read(self):
+        if self.state == 'header':
+            self.state = 'walk'
+            return pack_record('h', '', json.dumps({
+                'format': self.format,
+                'keys': len(self.backend.data_db),
+                'started': self.started,
+                }))
+        if self.state == 'walk':
+            ret = self._walk()
+            if ret:
+                return ret
+            self.state = 'spool'
+        if self.state == 'spool':
+            ret = self._read_spool()
+            if ret:
+                return ret
+            self.state = 'done'
+            self.close()
+            return pack_record('e', '', str(self.records))
+        return ''
+
+    def _walk(self):
+        ret = []
+        size = 0
+        now = time.time()
+        after = self.walked_to
+        cursor = self.backend.keys_db.cursor()
+        try:
+            if after is None:
+                rec = _cursor_op(cursor.first)
+            else:
+                rec = _cursor_op(cursor.set_range, after)
+                if rec is not None and rec[0] == after:
+                    rec = _cursor_op(cursor.next)
+            while rec is not None:
+                key, stored = rec
+                self.walked_to = key
+                if _live_value(stored, now) is not None:
+                    ret.append(pack_record('p', key, stored))
+                    size += len(ret[-1])
+                if len(ret) >= self.page_records or size >= self.page_bytes:
+                    break
+                rec = _cursor_op(cursor.next)
+        finally:
+            cursor.close()
+        self.records += len(ret)
+        return ''.join(ret)
+
+    def _read_spool(self):
+        if self.sent == self.spooled:
+            return ''
+        self.spool.seek(self.sent)
+        data = self.spool.read(min(self.page_bytes,
+                                   self.spooled - self.sent))
+        # only whole records
+        ret = []
+        pos = 0
+        while len(data) - pos >= record_header.size:
+            op, keylen, valuelen = record_header.unpack_from(data, pos)
+            end = pos + record_header.size + keylen + valuelen
+            if end > len(data):
+                if not ret:
+                    # a record bigger than a page
+                    data += self.spool.read(end - len(data))
+                    continue
+                break
+            ret.append(data[pos:end])
+            pos = end
+        self.sent += pos
+        self.records += len(ret)
+        return ''.join(ret)
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        if self in self.backend.backups:
+            self.backend.backups.remove(self)
+
 class BDBBackend(StorageBackend):
     supports_iteration = True
+    supports_ttl = True
+    supports_backup = True
+    supports_indexes = True
+
+    @property
+    def supports_processes(self):
+        # the store is opened for CDB, which lets any number of
+        # processes read and write it, but only one can keep a Bloom
+        # filter of its keys (see _lock())
+        return not self.bloom_capacity
+
+    restore_cache = 256 * 1024 * 1024 # BDB cache to build restores with
+    lock_file = 'rdb.lock' # flock()ed by every process with the store open
 
     def __init__(self, options, args):
         self.basedir = options.basedir
@@ -19,7 +202,18 @@ class BDBBackend(StorageBackend):
 
         self.shmkey = options.shmkey
 
-        self.env = self.data_db = None
+        self.bloom_capacity = options.bloom_capacity
+        self.bloom_error_rate = options.bloom_error_rate
+        self.bloom = None
+        self.bloom_building = None # the filter that tick() is filling
+        self.bloom_built_to = None # the last key that's in it
+
+        self.expired = 0
+
+        self.env = self.data_db = self.expiry_db = self.index_db = None
+        self.keys_db = None
+        self.lock = None
+        self.backups = [] # BDBBackups in progress
 
         self.open()
 
@@ -38,41 +232,413 @@ class BDBBackend(StorageBackend):
                             type='int',
                             metavar='SHMKEY',
                             default=0)
+        optparse.add_option('--bloom-capacity', dest='bloom_capacity',
+                            help='''Keep a Bloom filter of the keys in
+                            the store sized for this many keys, so that
+                            lookups of keys that were never written
+                            don't have to touch the disk. It grows
+                            as needed. Other processes don't see it, so
+                            the store can't be shared with them. 0 to
+                            disable''',
+                            type='int',
+                            metavar='KEYS',
+                            default=0)
+        optparse.add_option('--bloom-error-rate', dest='bloom_error_rate',
+                            help='''The false-positive rate to size the
+                            Bloom filter for''',
+                            type='float',
+                            metavar='RATE',
+                            default=0.01)
 
     def _get(self, key, default = None):
         """Note that we let the superclass's _get_multi just call this
-           multiple times"""
-        return self.data_db.get(key, default = default)
+           multiple times, so it gets the Bloom filter for free"""
+        if self.bloom is not None and key not in self.bloom:
+            self.bloom_negatives += 1
+            return default
+        stored = self.data_db.get(key, default = None)
+        if stored is None and self.bloom is not None:
+            self.bloom_false_positives += 1
+        ret = _live_value(stored, time.time())
+        return default if ret is None else ret
 
-    def _put(self, key, value):
+    def _put(self, key, value, ttl = None):
         """Note that we let the superclass's _put_multi just call this
            multiple times"""
-        return self.data_db.put(key, value)
+        if ttl is not None:
+            value = _with_expiry(value, ttl)
+        ret = self.data_db.put(key, value)
+        self._wrote(key, value)
+        return ret
+
+    def update(self, key, func, ttl = None):
+        """Reads and writes the record through a write cursor, which
+           CDB only lets one process have at a time, so that it's
+           atomic even with other processes writing the store"""
+        assert isinstance(key, str)
+        cursor = self.data_db.cursor(None, db.DB_WRITECURSOR)
+        try:
+            rec = _cursor_op(cursor.set, key)
+            stored = rec[1] if rec is not None else None
+            old = _live_value(stored, time.time())
+            value = func(old)
+            if ttl is not None:
+                stored = _with_expiry(value, ttl)
+            elif old is not None and stored.startswith(EXPIRY_TAG):
+                # it keeps its expiry time
+                stored = stored[:expiry_header.size] + value
+            else:
+                stored = value
+            cursor.put(key, stored, db.DB_KEYFIRST)
+        finally:
+            cursor.close()
+        self._wrote(key, stored)
+        return value
+
+    def _wrote(self, key, value):
+        "Bookkeeping for a record that has just been written"
+        for backup in self.backups:
+            backup.add('p', key, value)
+        if self.bloom is not None:
+            self.bloom.add(key)
+            if self.bloom.count > self.bloom.capacity:
+                self.rebuild_bloom()
+        if self.bloom_building is not None:
+            # it may already be past this key
+            self.bloom_building.add(key)
 
     def has_key(self, key):
-        return self.data_db.exists(key)
+        if self.bloom is not None and key not in self.bloom:
+            self.bloom_negatives += 1
+            return False
+        # we only need to read enough of the value to see if it has
+        # expired
+        stored = self.data_db.get(key, default = None,
+                                  dlen = expiry_header.size, doff = 0)
+        return _live_value(stored, time.time()) is not None
+
+    def ttl(self, key):
+        stored = self.data_db.get(key, default = None,
+                                  dlen = expiry_header.size, doff = 0)
+        if stored is None or not stored.startswith(EXPIRY_TAG):
+            return None
+        tag, expires = expiry_header.unpack(stored[:expiry_header.size])
+        return max(0, int(math.ceil(expires - time.time())))
+
+    def expire(self, limit = 1000):
+        """Walks the expiry index from the soonest expiry time, so it
+           only ever reads the keys that are due"""
+        now = time.time()
+        due = []
+        cursor = self.expiry_db.cursor()
+        try:
+            # partial reads, since we don't need the values
+            rec = _cursor_op(cursor.pget, db.DB_FIRST, 0, 0)
+            while rec is not None and len(due) < limit:
+                when, key, data = rec
+                if struct.unpack('!I', when)[0] > now:
+                    break
+                due.append(key)
+                rec = _cursor_op(cursor.pget, db.DB_NEXT, 0, 0)
+        finally:
+            cursor.close()
+
+        for key in due:
+            # this removes it from the index too
+            self._delete(key)
+        self.expired += len(due)
+        return len(due)
 
     def _delete(self, key):
         try:
             self.data_db.delete(key)
         except db.DBNotFoundError:
-            pass
+            return
+        for backup in self.backups:
+            backup.add('d', key, '')
+        if self.bloom is not None:
+            # a Bloom filter can't forget keys, so deleted ones just
+            # become false positives until we build a new one
+            self.bloom_deletes += 1
+            if self.bloom_deletes > self.bloom.count * self.bloom_rebuild_ratio:
+                self.rebuild_bloom()
 
     def keys(self):
-        return iter(self.data_db.keys())
+        now = time.time()
+        ret = []
+        cursor = self.data_db.cursor()
+        try:
+            rec = _cursor_op(cursor.first, 0, expiry_header.size, 0)
+            while rec is not None:
+                if _live_value(rec[1], now) is not None:
+                    ret.append(rec[0])
+                rec = _cursor_op(cursor.next, 0, expiry_header.size, 0)
+        finally:
+            cursor.close()
+        return iter(ret)
+
+    def scan(self, start = None, limit = 1000):
+        """Pages through the key index, which has the keys in order,
+           so that we find our place again after 'start' even if it has
+           been deleted since. Expired records are skipped"""
+        now = time.time()
+        ret = []
+        cursor = self.keys_db.cursor()
+        try:
+            if start is None:
+                rec = _cursor_op(cursor.first)
+            else:
+                rec = _cursor_op(cursor.set_range, start)
+                if rec is not None and rec[0] == start:
+                    rec = _cursor_op(cursor.next)
+            while rec is not None and len(ret) < limit:
+                value = _live_value(rec[1], now)
+                if value is not None:
+                    ret.append((rec[0], value))
+                rec = _cursor_op(cursor.next)
+        finally:
+            cursor.close()
+        return ret, (ret[-1][0] if rec is not None else None)
+
+    # rebuild the Bloom filter once this fraction of the keys in it
+    # have been deleted
+    bloom_rebuild_ratio = 0.25
+
+    bloom_snapshot = 'bloom.filter'
+
+    bloom_batch = 10000 # keys to add to a filter being built each tick
+
+    def rebuild_bloom(self):
+        """Start building a new Bloom filter, which tick() fills from
+           the key index a batch at a time and then swaps in. It's
+           sized for at least twice as many keys as the one we have,
+           so that it can grow for a while before the next rebuild.
+           The one we have still has every key, so it's used until
+           then, and without one every key is maybe there"""
+        if self.bloom_building is not None:
+            return
+        count = self.bloom.count if self.bloom is not None else 0
+        self.bloom_building = BloomFilter(max(self.bloom_capacity,
+                                              2 * count),
+                                          self.bloom_error_rate)
+        self.bloom_built_to = None
+
+    def tick(self):
+        if self.bloom_building is not None:
+            self._build_bloom()
+
+    def _build_bloom(self):
+        bloom = self.bloom_building
+        after = self.bloom_built_to
+        count = 0
+        cursor = self.keys_db.cursor()
+        try:
+            # partial reads, so that we only read the keys
+            if after is None:
+                rec = _cursor_op(cursor.first, dlen = 0, doff = 0)
+            else:
+                rec = _cursor_op(cursor.set_range, after,
+                                 dlen = 0, doff = 0)
+                if rec is not None and rec[0] == after:
+                    rec = _cursor_op(cursor.next, dlen = 0, doff = 0)
+            while rec is not None and count < self.bloom_batch:
+                bloom.add(rec[0])
+                self.bloom_built_to = rec[0]
+                count += 1
+                rec = _cursor_op(cursor.next, dlen = 0, doff = 0)
+        finally:
+            cursor.close()
+        if rec is None:
+            self.bloom = bloom
+            self.bloom_building = self.bloom_built_to = None
+            self.bloom_deletes = 0
+            self.bloom_rebuilds += 1
+
+    def _open_bloom(self):
+        self.bloom_negatives = self.bloom_false_positives = 0
+        self.bloom_deletes = self.bloom_rebuilds = 0
+
+        path = os.path.join(self.basedir, self.bloom_snapshot)
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self.bloom = BloomFilter.load(f)
+            except (IOError, ValueError):
+                self.bloom = None
+            # the snapshot is only good until the next write, so remove
+            # it now: if we don't get to close() cleanly to save a new
+            # one, we'll scan the keys next time instead
+            os.unlink(path)
+
+        # one with another error rate still has every key, so it'll do
+        # until its replacement is built
+        if (self.bloom is None
+            or self.bloom.error_rate != self.bloom_error_rate):
+            self.rebuild_bloom()
+
+    def _save_bloom(self):
+        path = os.path.join(self.basedir, self.bloom_snapshot)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            self.bloom.save(f)
+        os.rename(tmp, path)
+
+    def index_put(self, entries):
+        for entry in entries:
+            self.index_db.put(entry, '')
+
+    def index_delete(self, entries):
+        for entry in entries:
+            try:
+                self.index_db.delete(entry)
+            except db.DBNotFoundError:
+                pass
+
+    def index_scan(self, start, end, limit = 1000):
+        ret = []
+        cursor = self.index_db.cursor()
+        try:
+            # partial reads, since the entries have no values
+            rec = _cursor_op(cursor.set_range, start, 0, 0)
+            while rec is not None and rec[0] < end and len(ret) < limit:
+                ret.append(rec[0])
+                rec = _cursor_op(cursor.next, 0, 0)
+        finally:
+            cursor.close()
+        return ret
+
+    def begin_backup(self):
+        backup = BDBBackup(self)
+        self.backups.append(backup)
+        return backup
+
+    def restore(self, f):
+        """Builds a new database from the backup in a private
+           environment of its own, then renames it over data.db, so
+           that the old one is still there if anything goes wrong
+           before that. The table is sized for the number of keys up
+           front, and the expiry and key indexes and the Bloom filter
+           are built along the way rather than kept up to date by every
+           put"""
+        workdir = tempfile.mkdtemp(dir = self.basedir, prefix = 'restore.')
+        try:
+            records = read_records(f)
+            op, key, value = next(records, ('', '', ''))
+            if op != 'h':
+                raise ValueError('Not a backup')
+            header = json.loads(value)
+            if header.get('format') != BDBBackup.format:
+                raise ValueError('Unknown backup format %r'
+                                 % header.get('format'))
+
+            bloom = None
+            if self.bloom_capacity:
+                bloom = BloomFilter(max(self.bloom_capacity,
+                                        2 * header['keys']),
+                                    self.bloom_error_rate)
+
+            env = db.DBEnv()
+            env.set_cachesize(0, self.restore_cache, 1)
+            env.open(workdir, db.DB_CREATE | db.DB_INIT_MPOOL | db.DB_PRIVATE)
+            try:
+                data_db = db.DB(dbEnv = env)
+                data_db.set_h_nelem(max(1, header['keys']))
+                data_db.open('data.db', dbname = 'data',
+                             dbtype = db.DB_HASH, flags = db.DB_CREATE)
+                count = 0
+                for op, key, value in records:
+                    if op == 'e':
+                        if int(value) != count:
+                            raise ValueError('The backup has %d records, '
+                                             'not %s' % (count, value))
+                        break
+                    elif op == 'p':
+                        data_db.put(key, value)
+                        if bloom is not None:
+                            bloom.add(key)
+                    elif op == 'd':
+                        try:
+                            data_db.delete(key)
+                        except db.DBNotFoundError:
+                            pass
+                    else:
+                        raise ValueError('Unexpected %r record' % op)
+                    count += 1
+                else:
+                    raise ValueError('The backup is truncated')
+
+                # DB_CREATE builds the indexes from data_db in one go
+                expiry_db = db.DB(dbEnv = env)
+                expiry_db.set_flags(db.DB_DUPSORT)
+                expiry_db.open('data.db', dbname = 'expiry',
+                               dbtype = db.DB_BTREE, flags = db.DB_CREATE)
+                data_db.associate(expiry_db, _expiry_key, db.DB_CREATE)
+                keys_db = db.DB(dbEnv = env)
+                keys_db.open('data.db', dbname = 'keys',
+                             dbtype = db.DB_BTREE, flags = db.DB_CREATE)
+                data_db.associate(keys_db, _own_key, db.DB_CREATE)
+                keys_db.close()
+                expiry_db.close()
+                data_db.close()
+            finally:
+                env.close()
+
+            self.close()
+            os.rename(os.path.join(workdir, 'data.db'),
+                      os.path.join(self.basedir, 'data.db'))
+            # the old Bloom filter that close() saved is of the old keys
+            bloom_path = os.path.join(self.basedir, self.bloom_snapshot)
+            if bloom is not None:
+                with open(bloom_path + '.tmp', 'wb') as bf:
+                    bloom.save(bf)
+                os.rename(bloom_path + '.tmp', bloom_path)
+            elif os.path.exists(bloom_path):
+                os.unlink(bloom_path)
+            self.open()
+            return count
+        finally:
+            shutil.rmtree(workdir, ignore_errors = True)
 
     def stats(self):
-        return self.data_db.stat()
+        ret = self.data_db.stat()
+        ret['expired'] = self.expired
+        ret['backups'] = [dict(started = backup.started,
+                               state = backup.state,
+                               records = backup.records,
+                               spooled = backup.spooled)
+                          for backup in self.backups]
+        if self.bloom is not None:
+            ret['bloom'] = dict(capacity = self.bloom.capacity,
+                                keys = self.bloom.count,
+                                bytes = len(self.bloom.bits),
+                                hashes = self.bloom.nhashes,
+                                expected_error_rate = self.bloom.expected_error_rate(),
+                                negatives = self.bloom_negatives,
+                                false_positives = self.bloom_false_positives,
+                                deletes = self.bloom_deletes,
+                                rebuilds = self.bloom_rebuilds)
+        if self.bloom_building is not None:
+            ret['bloom_building'] = dict(
+                capacity = self.bloom_building.capacity,
+                keys = self.bloom_building.count)
+        return ret
 
     def open(self):
         self.close()
+        self._lock()
 
         env = db.DBEnv()
         env.set_shm_key(self.shmkey)
 
-        flags = db.DB_CREATE | db.DB_INIT_MPOOL | db.DB_SYSTEM_MEM
-        # we'll need this when multi-process/multi-threaded support is added
-        # flags |= db.DB_INIT_CDB
+        # CDB, so that the server's processes (and anything else with
+        # the shmkey) can share the store: any number of readers, or
+        # one writer. It locks all of the databases in the file
+        # together, since writes to data_db write its indexes too. A
+        # cursor held open blocks writers, so none are kept between
+        # calls
+        env.set_flags(db.DB_CDB_ALLDB, 1)
+        flags = (db.DB_CREATE | db.DB_INIT_MPOOL | db.DB_SYSTEM_MEM
+                 | db.DB_INIT_CDB)
         env.open(self.basedir, flags)
         self.env = env
 
@@ -81,10 +647,75 @@ class BDBBackend(StorageBackend):
                      dbtype = db.DB_HASH, flags = db.DB_CREATE)
         self.data_db = data_db
 
+        # keys with a TTL, ordered by when they expire. BDB keeps it up
+        # to date as data_db changes, and DB_CREATE builds it from
+        # data_db if it's new
+        expiry_db = db.DB(dbEnv = self.env)
+        expiry_db.set_flags(db.DB_DUPSORT)
+        expiry_db.open('data.db', dbname = 'expiry',
+                       dbtype = db.DB_BTREE, flags = db.DB_CREATE)
+        data_db.associate(expiry_db, _expiry_key, db.DB_CREATE)
+        self.expiry_db = expiry_db
+
+        # the keys in order, for scan() to page through. data_db is a
+        # hash, whose order a cursor can't find its place in again once
+        # the key it was at has gone. Built the same way as expiry_db
+        keys_db = db.DB(dbEnv = self.env)
+        keys_db.open('data.db', dbname = 'keys',
+                     dbtype = db.DB_BTREE, flags = db.DB_CREATE)
+        data_db.associate(keys_db, _own_key, db.DB_CREATE)
+        self.keys_db = keys_db
+
+        # for IndexedBackend. It isn't in backups, so restoring one
+        # leaves it empty, to be built again
+        index_db = db.DB(dbEnv = self.env)
+        index_db.open('data.db', dbname = 'index',
+                      dbtype = db.DB_BTREE, flags = db.DB_CREATE)
+        self.index_db = index_db
+
+        if self.bloom_capacity:
+            self._open_bloom()
+
     def close(self):
+        # their cursors have to be closed before the database is
+        for backup in list(getattr(self, 'backups', [])):
+            backup.close()
+        if getattr(self, 'bloom', None) is not None:
+            self._save_bloom()
+        self.bloom = None
+        # reopening starts any build again
+        self.bloom_building = self.bloom_built_to = None
+        if getattr(self, 'index_db', None) is not None:
+            self.index_db.close()
+        self.index_db = None
+        if getattr(self, 'keys_db', None) is not None:
+            self.keys_db.close()
+        self.keys_db = None
+        if getattr(self, 'expiry_db', None) is not None:
+            self.expiry_db.close()
+        self.expiry_db = None
         if hasattr(self, 'data_db') and self.data_db is not None:
             self.data_db.close()
         self.data_db = None
         if hasattr(self, 'env') and self.env is not None:
             self.env.close()
         self.env = None
+        if getattr(self, 'lock', None) is not None:
+            self.lock.close()
+        self.lock = None
+
+    def _lock(self):
+        """Other processes can share the store (with the same shmkey,
+           like the server's --processes), but only one that keeps a Bloom filter, which it alone
+           would know to add their keys to, can have it open. Raises
+           ValueError if that isn't so"""
+        self.lock = open(os.path.join(self.basedir, self.lock_file), 'a')
+        try:
+            fcntl.flock(self.lock, (fcntl.LOCK_EX if self.bloom_capacity
+                                    else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        except IOError:
+            self.lock.close()
+            self.lock = None
+            raise ValueError('%s is open in another process, which it '
+                             "can't be if either keeps a Bloom filter "
+                             '(--bloom-capacity)' % self.basedir)
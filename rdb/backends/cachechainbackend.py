@@ -1,6 +1,12 @@
-from backend import StorageBackend
+import os
+import time
+import hashlib
+
+from backend import StorageBackend, NoneResult
 
 from .. rdbutil import NotFound
+from .. recentkeys import RecentKeys
+from .. shmcache import SharedCache
 from bdbbackend import BDBBackend
 from memcachebackend import MemcacheBackend
 
@@ -8,15 +14,113 @@ class CacheChainBackend(StorageBackend):
     """
     Uses a list of backends in sequence. Because they all share
     OptionParser instances, they need to not overlap on usage of
-    command-line arguments
+    command-line arguments.
+
+    The keys that were read recently are saved every so often, and
+    when the chain is opened the earlier caches are warmed up with
+    them from the last one, a little at a time while requests are
+    being served, so that they don't all start out cold
+
+    With --shm-cache-size, there's a SharedCache in front of them all,
+    which the server's --processes share, so that a value that one of
+    them has read is there for the others. It's emptied when the server
+    starts, since the store may have changed while it was down
     """
     backends = (MemcacheBackend, BDBBackend)
+    supports_ttl = True
+
+    warm_batch = 500 # keys to warm up at a time, at most
+
+    @property
+    def supports_processes(self):
+        return all(cache.supports_processes for cache in self.caches)
 
     def __init__(self, options, args):
         self.caches = tuple(backend(options, args)
                             for backend in self.backends)
 
+        self.shared = None
+        self.shared_cleared = False # whether open() has emptied it
+        if options.shm_cache_size:
+            path = options.shm_cache_file or self._shm_path(options.basedir)
+            self.shared = SharedCache(path,
+                                      options.shm_cache_size * 1024 * 1024,
+                                      options.shm_cache_slot)
+
+        self.recent = None
+        if options.warm_keys:
+            self.recent = RecentKeys(options.warm_keys)
+        self.warm_file = (options.warm_file
+                          or os.path.join(options.basedir, 'warm.keys'))
+        self.warm_rate = options.warm_rate
+        self.snapshot_interval = options.warm_snapshot_interval
+        self.last_snapshot = time.time()
+
+        self.warming = [] # keys still to be warmed up, last first
+        self.warm_progress = None
+        self._last_warm = None
+        self._start_warming()
+
+    @staticmethod
+    def _shm_path(basedir):
+        # the same for every process using this basedir
+        name = 'rdb-%s.cache' % hashlib.md5(
+            os.path.abspath(basedir)).hexdigest()[:12]
+        if os.path.isdir('/dev/shm'):
+            return os.path.join('/dev/shm', name)
+        return os.path.join(basedir, name)
+
+    def _start_warming(self):
+        if self.recent is None:
+            return
+        keys = RecentKeys.load(self.warm_file)
+        keys.reverse() # so that we can pop the most recent first
+        self.warming = keys
+        self.warm_progress = {
+            'keys': len(keys),
+            'warmed': 0,
+            'started': time.time(),
+            'finished': None if keys else time.time(),
+            }
+        self._last_warm = time.time()
+
+    def tick(self):
+        """Warm up the next few keys, at no more than warm_rate keys a
+           second, and save the recent keys if it's time"""
+        for cache in self.caches:
+            cache.tick()
+        if self.recent is None:
+            return
+        now = time.time()
+
+        if self.warming:
+            count = min(int((now - self._last_warm) * self.warm_rate),
+                        self.warm_batch, len(self.warming))
+            if count:
+                self._last_warm = now
+                batch = self.warming[-count:]
+                del self.warming[-count:]
+                # reading them pushes them up into the earlier caches
+                self._get_multi(batch)
+                self.warm_progress['warmed'] += count
+                if not self.warming:
+                    self.warm_progress['finished'] = now
+
+        if now - self.last_snapshot >= self.snapshot_interval:
+            self.save_recent()
+
+    def save_recent(self):
+        self.last_snapshot = time.time()
+        self.recent.save(self.warm_file)
+
     def _get(self, key, default = None):
+        if self.recent is not None:
+            self.recent.add(key)
+        token = None
+        if self.shared is not None:
+            ret, token = self.shared.get(key)
+            if ret is not None:
+                return ret
         found_idx = -1
         for i, cache in enumerate(self.caches):
             try:
@@ -30,18 +134,54 @@ class CacheChainBackend(StorageBackend):
             return default
 
         # we found it, let's push it all the way back up the cache
-        # chain
-        for cache in self.caches[:found_idx]:
-            cache.put(key, ret)
+        # chain, expiring when it does
+        ttl = self.caches[found_idx].ttl(key)
+        if ttl != 0:
+            for cache in self.caches[:found_idx]:
+                cache.put(key, ret, ttl)
+            self._fill_shared({key: ret}, {key: token})
 
         return ret
 
+    def _fill_shared(self, found, tokens):
+        if self.shared is None:
+            return
+        for key, value in found.iteritems():
+            if isinstance(value, str) and tokens.get(key) is not None:
+                # the last backend's TTL, since the earlier ones can't
+                # always say
+                ttl = self.ttl(key)
+                if ttl != 0:
+                    self.shared.fill(key, value, tokens[key], ttl)
+
+    def _invalidate(self, keys):
+        # after the writes, so that a process that read the old value
+        # while they were happening can't put it in the shared cache
+        if self.shared is not None:
+            self.shared.invalidate(keys)
+
+    def get_multi(self, keys, *a, **kw):
+        keys = list(keys)
+        if self.recent is not None:
+            # counted here so that warming up doesn't count
+            self.recent.update(keys)
+        return StorageBackend.get_multi(self, keys, *a, **kw)
+
     def _get_multi(self, keys):
         ret = {}
-        pushup = {} # dict(cacheno -> dict(key -> value))
+        pushup = {} # dict((cacheno, ttl) -> dict(key -> value))
         keys = set(keys)
         find_keys = set(keys)
 
+        tokens = {}
+        if self.shared is not None:
+            for key in keys:
+                value, tokens[key] = self.shared.get(key)
+                if value is not None:
+                    ret[key] = value
+                    find_keys.discard(key)
+        found = {} # what the shared cache didn't have
+
         for i, cache in enumerate(self.caches):
             # a NoneResult should never be returned from get_multi
             # (because those are converted to Nones before returning),
@@ -50,52 +190,157 @@ class CacheChainBackend(StorageBackend):
             # backwards
             subret = cache.get_multi(find_keys)
             find_keys -= set(subret.keys())
-            for pushupcache_no in range(i):
-                pushup.setdefault(pushupcache_no, {}).update(subret)
+            for key, value in subret.iteritems():
+                ttl = cache.ttl(key) if i else None
+                if ttl == 0:
+                    continue
+                for pushupcache_no in range(i):
+                    pushup.setdefault((pushupcache_no, ttl), {})[key] = value
 
             ret.update(subret)
+            found.update(subret)
 
             if not find_keys:
                 # we found them all
                 break
 
         # for the ones we did find, push those up the cache-chain
-        for i, c_keys in pushup.iteritems():
-            self.caches[i].put_multi(c_keys)
+        for (i, ttl), c_keys in pushup.iteritems():
+            self.caches[i].put_multi(c_keys, ttl)
+        self._fill_shared(found, tokens)
 
         # we've got to convert the Nones into NoneResults here,
         # because our parent class will be expecting that
         return dict((key, NoneResult() if val is None else val)
                     for (key, val) in ret.iteritems())
 
-    def _put(self, key, val):
+    def _put(self, key, val, ttl = None):
         for cache in self.caches:
-            cache.put(key, val)
+            cache.put(key, val, ttl)
+        self._invalidate([key])
 
-    def _put_multi(self, keys):
+    def _put_multi(self, keys, ttl = None):
         for cache in self.caches:
-            cache.put_multi(keys)
+            cache.put_multi(keys, ttl)
+        self._invalidate(keys)
 
     def _delete(self, key):
         for cache in self.caches:
             cache.delete(key)
+        self._invalidate([key])
+
+    def _delete_multi(self, keys):
+        for cache in self.caches:
+            cache.delete_multi(keys)
+        self._invalidate(keys)
+
+    def update(self, key, func, ttl = None):
+        """Updates the last backend in the chain, and drops the key
+           from the others rather than trying to update them all
+           atomically"""
+        ret = self.caches[-1].update(key, func, ttl)
+        for cache in self.caches[:-1]:
+            cache.delete(key)
+        self._invalidate([key])
+        return ret
+
+    def incr(self, key, delta = 1, ttl = None):
+        """Like update()"""
+        ret = self.caches[-1].incr(key, delta, ttl)
+        for cache in self.caches[:-1]:
+            cache.delete(key)
+        self._invalidate([key])
+        return ret
+
+    def ttl(self, key):
+        return self.caches[-1].ttl(key)
+
+    def expire(self, limit = 1000):
+        return sum(cache.expire(limit) for cache in self.caches)
 
     @classmethod
     def parse_arguments(cls, optparse):
         for backend in cls.backends:
             backend.parse_arguments(optparse)
+        optparse.add_option('--warm-keys', dest='warm_keys',
+                            help='''remember about this many of the most
+                            recently read keys, to warm up the caches
+                            with when starting (default: %default, 0 to
+                            not warm them up)''',
+                            type='int',
+                            metavar='KEYS',
+                            default=100000)
+        optparse.add_option('--warm-file', dest='warm_file',
+                            help='''where to save the recently read keys
+                            (default: warm.keys in the BDB basedir)''',
+                            metavar='FILE',
+                            default=None)
+        optparse.add_option('--warm-rate', dest='warm_rate',
+                            help='''the most keys a second to warm up
+                            (default: %default)''',
+                            type='int',
+                            metavar='KEYS',
+                            default=5000)
+        optparse.add_option('--warm-snapshot-interval',
+                            dest='warm_snapshot_interval',
+                            help='''how often to save the recently read
+                            keys (default: %default seconds)''',
+                            type='float',
+                            metavar='SECONDS',
+                            default=300)
+        optparse.add_option('--shm-cache-size', dest='shm_cache_size',
+                            help='''keep a cache of this many MB in shared
+                            memory, in front of the others, for the
+                            server's --processes to share. It's emptied
+                            when the server starts (default: don't)''',
+                            type='int',
+                            metavar='MB',
+                            default=0)
+        optparse.add_option('--shm-cache-file', dest='shm_cache_file',
+                            help='''the file to map it from (default: one
+                            in /dev/shm for the BDB basedir)''',
+                            metavar='FILE',
+                            default=None)
+        optparse.add_option('--shm-cache-slot', dest='shm_cache_slot',
+                            help='''the size of each of its slots, which
+                            is as big as a key and value that it caches
+                            can be (default: %default bytes)''',
+                            type='int',
+                            metavar='BYTES',
+                            default=4096)
 
     def open(self):
         for cache in self.caches:
             cache.open()
+        if self.shared is not None:
+            self.shared.open()
+            if not self.shared_cleared:
+                # the store could have been changed or restored while
+                # we were down, or a process could have died between a
+                # write and dropping the key from it. Only the first
+                # time, since the server's processes open it again
+                # after they fork
+                self.shared.clear()
+                self.shared_cleared = True
 
     def close(self):
+        if getattr(self, 'recent', None) is not None:
+            self.save_recent()
         for cache in getattr(self, 'caches', []):
             cache.close()
+        if getattr(self, 'shared', None) is not None:
+            self.shared.close()
 
     def stats(self):
-        return dict((cache.__class__.__name__, cache.stats())
-                    for cache in self.caches)
+        ret = dict((cache.__class__.__name__, cache.stats())
+                   for cache in self.caches)
+        if self.recent is not None:
+            ret['warm_up'] = dict(self.warm_progress,
+                                  remaining = len(self.warming),
+                                  recent_keys = len(self.recent))
+        if self.shared is not None:
+            ret['shared_cache'] = self.shared.stats()
+        return ret
 
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, self.caches)
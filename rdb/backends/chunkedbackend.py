@@ -0,0 +1,334 @@
+import time
+import uuid
+import hashlib
+from collections import deque
+
+import simplejson as json
+
+from backend import StorageBackend, ValueReader
+from wrapper import BackendWrapper
+
+from .. rdbutil import NotFound
+from .. import rdbops
+from .. import rdbcodec
+
+# A value that has been split into chunks is stored as a manifest that
+# starts with this byte, which neither values that clients send us nor
+# CompressedBackend's and BDBBackend's (TTL) tags start with, and its
+# chunks under keys of their own that start with CHUNK_PREFIX
+MANIFEST_TAG = '\x03'
+CHUNK_PREFIX = '\x02chunk:'
+
+
+def chunk_key(value_id, index):
+    return '%s%s:%d' % (CHUNK_PREFIX, value_id, index)
+
+
+class _Upload(object):
+
+    def __init__(self, key, ttl):
+        self.key = key
+        self.ttl = ttl
+        self.id = uuid.uuid4().hex
+        self.digest = hashlib.md5()
+        self.size = 0
+        self.chunks = 0
+        self.last = False # whether we've had a short part, which has
+                          # to be the last one
+        self.encoded = False
+        self.started = time.time()
+
+
+class ChunkedValueReader(ValueReader):
+    "Reads a chunked value a chunk at a time, as it's needed"
+
+    def __init__(self, backend, manifest):
+        self.backend = backend
+        self.manifest = manifest
+        self.size = manifest['size']
+        self.version = manifest['version']
+        self.encoded = manifest['encoded']
+
+    def read(self, start = 0, end = None):
+        chunk_size = self.manifest['chunk_size']
+        end = self.size if end is None else min(end, self.size)
+        for i in xrange(start // chunk_size,
+                        (end + chunk_size - 1) // chunk_size):
+            chunk = self.backend.get(chunk_key(self.manifest['id'], i), None)
+            if chunk is None:
+                # it expired, or the value was replaced long enough
+                # ago that its chunks have been deleted
+                raise NotFound
+            offset = i * chunk_size
+            yield chunk[max(0, start - offset):end - offset]
+
+
+class ChunkedBackend(BackendWrapper):
+    """Stores values of more than 'threshold' bytes as chunks of
+       'chunk_size' bytes under keys of their own, with a manifest
+       under the value's key, so that they can be read (get_reader())
+       and written (the upload methods) a chunk at a time. Everything
+       else still sees whole values.
+
+       Knowing whether a write replaces a chunked value, whose chunks
+       then have to go, costs a read before every write. The chunks
+       of replaced values are kept for 'grace' seconds, so that
+       readers that are part of the way through them can finish"""
+
+    supports_uploads = True
+
+    grace = 60
+    upload_timeout = 3600 # the longest that an upload can take
+
+    def __init__(self, backend, threshold = 1024 * 1024,
+                 chunk_size = 1024 * 1024):
+        BackendWrapper.__init__(self, backend)
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+
+        self.garbage = deque() # (when, chunk keys to delete then)
+        self.uploads = {} # id -> _Upload
+        self.chunked = self.uploaded = 0
+
+    @staticmethod
+    def _manifest(value):
+        "The manifest that a stored value is, or None if it's a value"
+        if isinstance(value, str) and value.startswith(MANIFEST_TAG):
+            return json.loads(value[1:])
+        return None
+
+    @staticmethod
+    def _chunk_keys(manifest):
+        return [chunk_key(manifest['id'], i)
+                for i in xrange(manifest['chunks'])]
+
+    def _assemble(self, manifest):
+        "The whole of a chunked value, or None if any chunk is missing"
+        keys = self._chunk_keys(manifest)
+        chunks = self.backend.get_multi(keys)
+        if len(chunks) < len(keys):
+            return None
+        return ''.join(chunks[key] for key in keys)
+
+    def _chunk_ttl(self, ttl):
+        # chunks have to outlast their manifest, which is written
+        # after them (as much as an upload's length after them)
+        if ttl is None:
+            return None
+        return ttl + self.grace + self.upload_timeout
+
+    def _is_large(self, value):
+        return isinstance(value, str) and len(value) > self.threshold
+
+    def _old_chunks(self, keys):
+        "The chunks of any chunked values that 'keys' have now"
+        ret = []
+        for value in self.backend.get_multi(keys).itervalues():
+            manifest = self._manifest(value)
+            if manifest is not None:
+                ret.extend(self._chunk_keys(manifest))
+        return ret
+
+    def _discard(self, chunk_keys):
+        if chunk_keys:
+            self.garbage.append((time.time() + self.grace, chunk_keys))
+
+    def _put_manifest(self, key, value_id, size, chunks, version, encoded,
+                      ttl):
+        manifest = {'id': value_id, 'size': size, 'chunks': chunks,
+                    'chunk_size': self.chunk_size, 'version': version,
+                    'encoded': encoded}
+        self.backend.put(key, MANIFEST_TAG + json.dumps(manifest), ttl)
+
+    def _put_chunked(self, key, value, ttl):
+        value_id = uuid.uuid4().hex
+        chunks = 0
+        for offset in xrange(0, len(value), self.chunk_size):
+            self.backend.put(chunk_key(value_id, chunks),
+                             value[offset:offset + self.chunk_size],
+                             self._chunk_ttl(ttl))
+            chunks += 1
+        self._put_manifest(key, value_id, len(value), chunks,
+                           hashlib.md5(value).hexdigest(),
+                           rdbcodec.is_encoded(value), ttl)
+        self.chunked += 1
+
+    def _get(self, key, default = None):
+        value = self.backend.get(key, None)
+        manifest = self._manifest(value)
+        if manifest is not None:
+            value = self._assemble(manifest)
+        return default if value is None else value
+
+    def _get_multi(self, keys):
+        ret = self.backend.get_multi(keys)
+        for key, value in ret.items():
+            manifest = self._manifest(value)
+            if manifest is not None:
+                ret[key] = self._assemble(manifest)
+        return ret
+
+    def get_reader(self, key):
+        value = self.backend.get(key)
+        manifest = self._manifest(value)
+        if manifest is None:
+            return ValueReader(value)
+        return ChunkedValueReader(self.backend, manifest)
+
+    def _put(self, key, value, ttl = None):
+        old = self._old_chunks([key])
+        if self._is_large(value):
+            self._put_chunked(key, value, ttl)
+        else:
+            self.backend.put(key, value, ttl)
+        self._discard(old)
+
+    def _put_multi(self, keys, ttl = None):
+        old = self._old_chunks(keys.keys())
+        small = {}
+        for key, value in keys.iteritems():
+            if self._is_large(value):
+                self._put_chunked(key, value, ttl)
+            else:
+                small[key] = value
+        if small:
+            self.backend.put_multi(small, ttl)
+        self._discard(old)
+
+    def _delete(self, key):
+        old = self._old_chunks([key])
+        self.backend.delete(key)
+        self._discard(old)
+
+    def _delete_multi(self, keys):
+        old = self._old_chunks(keys)
+        self.backend.delete_multi(keys)
+        self._discard(old)
+
+    def update(self, key, func, ttl = None):
+        manifest = self._manifest(self.backend.get(key, None))
+        if manifest is None:
+            return self.backend.update(key, func, ttl)
+        value = func(self._assemble(manifest))
+        if ttl is None and self.backend.supports_ttl:
+            ttl = self.backend.ttl(key)
+        self._put(key, value, ttl)
+        return value
+
+    def incr(self, key, delta = 1, ttl = None):
+        if self._manifest(self.backend.get(key, None)) is None:
+            return self.backend.incr(key, delta, ttl)
+        # which won't be an integer, but let update() say so
+        return StorageBackend.incr(self, key, delta, ttl)
+
+    def begin_upload(self, key, ttl = None):
+        upload = _Upload(key, ttl)
+        self.uploads[upload.id] = upload
+        return upload.id, self.chunk_size
+
+    def _upload(self, upload_id):
+        try:
+            return self.uploads[upload_id]
+        except KeyError:
+            raise NotFound
+
+    def upload_part(self, upload_id, data):
+        upload = self._upload(upload_id)
+        if upload.last or not data or len(data) > self.chunk_size:
+            raise ValueError('Every part but the last must be %d bytes'
+                             % self.chunk_size)
+        if upload.chunks == 0:
+            # we can't check that the value is valid JSON without
+            # having all of it
+            if not rdbcodec.is_encoded(data):
+                raise rdbops.BadValue('Uploads must be encoded values')
+            upload.encoded = True
+        self.backend.put(chunk_key(upload.id, upload.chunks), data,
+                         self._chunk_ttl(upload.ttl))
+        upload.digest.update(data)
+        upload.size += len(data)
+        upload.chunks += 1
+        upload.last = len(data) < self.chunk_size
+
+    def commit_upload(self, upload_id):
+        upload = self._upload(upload_id)
+        if not upload.chunks:
+            raise ValueError('Nothing has been uploaded')
+        del self.uploads[upload_id]
+        old = self._old_chunks([upload.key])
+        version = upload.digest.hexdigest()
+        self._put_manifest(upload.key, upload.id, upload.size,
+                           upload.chunks, version, upload.encoded,
+                           upload.ttl)
+        self._discard(old)
+        self.uploaded += 1
+        return version
+
+    def abort_upload(self, upload_id):
+        upload = self.uploads.pop(upload_id, None)
+        if upload is not None:
+            self.backend.delete_multi([chunk_key(upload.id, i)
+                                       for i in xrange(upload.chunks)])
+
+    def tick(self):
+        self.backend.tick()
+        now = time.time()
+        while self.garbage and self.garbage[0][0] <= now:
+            self.backend.delete_multi(self.garbage.popleft()[1])
+        for upload in self.uploads.values():
+            if now - upload.started > self.upload_timeout:
+                self.abort_upload(upload.id)
+
+    def keys(self):
+        for key in self.backend.keys():
+            if not key.startswith(CHUNK_PREFIX):
+                yield key
+
+    def items(self):
+        for key, value in self.backend.items():
+            if key.startswith(CHUNK_PREFIX):
+                continue
+            manifest = self._manifest(value)
+            if manifest is not None:
+                value = self._assemble(manifest)
+                if value is None:
+                    continue
+            yield key, value
+
+    iteritems = items
+
+    def scan(self, start = None, limit = 1000):
+        # a page can be all chunks, and so come back empty, but there's
+        # still a next key to carry on from
+        items, next = self.backend.scan(start, limit)
+        ret = []
+        for key, value in items:
+            if key.startswith(CHUNK_PREFIX):
+                continue
+            manifest = self._manifest(value)
+            if manifest is not None:
+                value = self._assemble(manifest)
+                if value is None:
+                    continue
+            ret.append((key, value))
+        return ret, next
+
+    def stats(self):
+        ret = dict(self.backend.stats())
+        ret['large_values'] = {
+            'threshold': self.threshold,
+            'chunk_size': self.chunk_size,
+            'chunked': self.chunked,
+            'uploaded': self.uploaded,
+            'uploads': len(self.uploads),
+            'pending_deletes': sum(len(keys) for (when, keys)
+                                   in self.garbage),
+            }
+        return ret
+
+    def close(self):
+        # nobody can be reading these once we're shut down
+        if getattr(self, 'garbage', None) and self.backend is not None:
+            while self.garbage:
+                self.backend.delete_multi(self.garbage.popleft()[1])
+        BackendWrapper.close(self)
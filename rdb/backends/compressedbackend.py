@@ -0,0 +1,112 @@
+import zlib
+
+from backend import StorageBackend
+from wrapper import BackendWrapper
+
+from .. import rdbcodec
+
+# Stored values that we've compressed start with this byte. Values
+# that clients send us are either JSON or start with rdbcodec.MAGIC,
+# so it can't be mistaken for the start of one
+COMPRESSED_TAG = '\x01'
+
+
+class CompressedBackend(BackendWrapper):
+    """Transparently zlib-compresses values of at least 'threshold'
+       bytes on their way into the wrapped backend, and decompresses
+       them on the way out. Wrapping a CacheChainBackend means that
+       every tier holds (and pushes up) the compressed values"""
+
+    def __init__(self, backend, threshold = 512, level = 6):
+        BackendWrapper.__init__(self, backend)
+        self.threshold = threshold
+        self.level = level
+
+        self.hits = self.misses = 0
+        self.compressed = self.uncompressed = 0
+        self.bytes_in = self.bytes_stored = 0
+
+    def compress(self, value):
+        if (len(value) < self.threshold
+            or (rdbcodec.is_encoded(value)
+                and ord(value[2]) & rdbcodec.COMPRESSED)):
+            # too small to bother with, or the client already did it
+            self.uncompressed += 1
+            return value
+
+        compressed = COMPRESSED_TAG + zlib.compress(value, self.level)
+        if len(compressed) >= len(value):
+            self.uncompressed += 1
+            return value
+
+        self.compressed += 1
+        self.bytes_in += len(value)
+        self.bytes_stored += len(compressed)
+        return compressed
+
+    def decompress(self, value):
+        if value is not None and value.startswith(COMPRESSED_TAG):
+            return zlib.decompress(value[1:])
+        return value
+
+    def _get(self, key, default = None):
+        ret = self.backend.get(key, None)
+        if ret is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return self.decompress(ret)
+
+    def _get_multi(self, keys):
+        ret = self.backend.get_multi(keys)
+        self.hits += len(ret)
+        self.misses += len(keys) - len(ret)
+        return dict((key, self.decompress(value))
+                    for (key, value) in ret.iteritems())
+
+    def _put(self, key, value, ttl = None):
+        self.backend.put(key, self.compress(value), ttl)
+
+    def _put_multi(self, keys, ttl = None):
+        self.backend.put_multi(dict((key, self.compress(value))
+                                    for (key, value) in keys.iteritems()),
+                               ttl)
+
+    def update(self, key, func, ttl = None):
+        ret = []
+        def _func(value):
+            # the wrapped backend may call this more than once
+            ret.append(func(self.decompress(value)))
+            return self.compress(ret[-1])
+        self.backend.update(key, _func, ttl)
+        return ret[-1]
+
+    # the wrapped backend can't increment values that it doesn't know
+    # how to decompress, so this goes through update()
+    incr = StorageBackend.incr
+
+    def items(self):
+        for key, value in self.backend.items():
+            yield key, self.decompress(value)
+
+    iteritems = items
+
+    def scan(self, start = None, limit = 1000):
+        items, next = self.backend.scan(start, limit)
+        return [(key, self.decompress(value))
+                for (key, value) in items], next
+
+    def stats(self):
+        ret = dict(self.backend.stats())
+        ret['compression'] = {
+            'threshold': self.threshold,
+            'hits': self.hits,
+            'misses': self.misses,
+            'compressed': self.compressed,
+            'uncompressed': self.uncompressed,
+            'bytes_in': self.bytes_in,
+            'bytes_stored': self.bytes_stored,
+            'ratio': (float(self.bytes_in) / self.bytes_stored
+                      if self.bytes_stored else None),
+            }
+        return ret
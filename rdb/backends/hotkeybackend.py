@@ -0,0 +1,73 @@
+from base64 import b64encode
+
+from wrapper import BackendWrapper
+
+from .. hotkeys import HotKeys
+
+
+class HotKeyBackend(BackendWrapper):
+    """Keeps track of the most read and most written keys, which
+       stats() reports with their rates. Keys can be any bytes, so
+       they're base64-encoded there, to keep /_stats valid JSON"""
+
+    def __init__(self, backend, k = 10, window = 60):
+        BackendWrapper.__init__(self, backend)
+        self.reads = HotKeys(k, window)
+        self.writes = HotKeys(k, window)
+
+    def _get(self, key, default = None):
+        self.reads.add((key,))
+        return self.backend.get(key, default)
+
+    def _get_multi(self, keys):
+        keys = list(keys)
+        self.reads.add(keys)
+        return self.backend.get_multi(keys)
+
+    def get_reader(self, key):
+        self.reads.add((key,))
+        return self.backend.get_reader(key)
+
+    def has_key(self, key):
+        self.reads.add((key,))
+        return self.backend.has_key(key)
+
+    def _put(self, key, value, ttl = None):
+        self.writes.add((key,))
+        self.backend.put(key, value, ttl)
+
+    def _put_multi(self, keys, ttl = None):
+        self.writes.add(keys)
+        self.backend.put_multi(keys, ttl)
+
+    def _delete(self, key):
+        self.writes.add((key,))
+        self.backend.delete(key)
+
+    def _delete_multi(self, keys):
+        self.writes.add(keys)
+        self.backend.delete_multi(keys)
+
+    def begin_upload(self, key, ttl = None):
+        self.writes.add((key,))
+        return self.backend.begin_upload(key, ttl)
+
+    def update(self, key, func, ttl = None):
+        self.writes.add((key,))
+        return self.backend.update(key, func, ttl)
+
+    def incr(self, key, delta = 1, ttl = None):
+        self.writes.add((key,))
+        return self.backend.incr(key, delta, ttl)
+
+    def stats(self):
+        stats = dict(self.backend.stats())
+        stats['hot_keys'] = {
+            'window': self.reads.window,
+            'reads': self._encoded(self.reads.rates()),
+            'writes': self._encoded(self.writes.rates()),
+            }
+        return stats
+
+    def _encoded(self, rates):
+        return [(b64encode(key), rate) for (key, rate) in rates]
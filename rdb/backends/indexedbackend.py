@@ -0,0 +1,297 @@
+import struct
+
+from wrapper import BackendWrapper
+
+from .. rdbutil import NotFound
+from .. rdbops import document, lookup, split_path
+
+# which indexes have been built, and from which paths, is kept in the
+# index too, as entries of MARKER, the name, a NUL and the path. Index
+# names can't be empty, so these sort before all of the indexes
+MARKER = '\x00built\x00'
+MARKER_END = '\x00built\x01'
+
+
+class IndexNotReady(Exception):
+    "The index is still being built"
+    pass
+
+
+def encode_value(value):
+    """A byte string for a value in a document that sorts the way the
+       values do, with false and true before numbers and numbers
+       before strings, or None for values that can't be indexed. NULs
+       are escaped as NUL 0xff, so that the NUL NUL that ends it in an
+       entry sorts before anything that could follow"""
+    if isinstance(value, bool):
+        ret = '\x01' + ('\x01' if value else '\x00')
+    elif isinstance(value, (int, long, float)):
+        try:
+            bits, = struct.unpack('>Q', struct.pack('>d', float(value)))
+        except OverflowError:
+            return None
+        # flipping the sign bit of positive numbers and every bit of
+        # negative ones makes them sort as unsigned integers do
+        if bits >> 63:
+            bits ^= 0xffffffffffffffff
+        else:
+            bits |= 1 << 63
+        ret = '\x02' + struct.pack('>Q', bits)
+    elif isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        ret = '\x03' + value
+    else:
+        return None
+    return ret.replace('\x00', '\x00\xff')
+
+
+def entry(name, encoded, key):
+    return '%s\x00%s\x00\x00%s' % (name, encoded, key)
+
+
+def entry_key(name, entry):
+    "The document key at the end of one of an index's entries"
+    pos = len(name) + 1
+    while True:
+        pos = entry.index('\x00', pos)
+        if entry[pos + 1] != '\xff':
+            return entry[pos + 2:]
+        pos += 2
+
+
+_nothing = object()
+
+
+class IndexedBackend(BackendWrapper):
+    """Keeps secondary indexes on fields of the JSON documents that
+       are stored, in the wrapped backend's index (see
+       supports_indexes). An index's entries are its name, the value
+       of the field encoded to sort in order, and the document's key.
+       'indexes' is a dict of index names to dotted paths. Documents
+       whose field is a list are in the index once for each item. Only
+       documents that clients stored as JSON are indexed (see
+       rdbops.document()).
+
+       Knowing which entries a write replaces costs a read before it.
+       Queries check the documents that they return, so entries that
+       a write didn't get to remove (like those of keys that expired)
+       are removed when a query comes across them.
+
+       Indexes that are new, or whose paths have changed, are built
+       from a scan of the store a page at a time in tick(), while
+       writes keep them up to date. They can't be queried until
+       they're finished"""
+
+    build_batch = 500 # documents or entries to deal with each tick
+
+    def __init__(self, backend, indexes):
+        BackendWrapper.__init__(self, backend)
+        self.paths = dict(indexes)
+        self.indexes = dict((name, split_path(path))
+                            for (name, path) in indexes.iteritems())
+
+        self.clearing = set() # indexes whose entries all have to go
+        self.building = {} # index -> the key its scan continues from
+        self.queries = self.stale = 0
+        self._check_built()
+
+    def _check_built(self):
+        built = {}
+        for marker in self.backend.index_scan(MARKER, MARKER_END, 1000000):
+            name, path = marker[len(MARKER):].split('\x00', 1)
+            built[name] = path
+        # the ones that we don't have any more, or that have moved
+        self.backend.index_delete([MARKER + '%s\x00%s' % (name, path)
+                                   for (name, path) in built.iteritems()
+                                   if self.paths.get(name) != path])
+        self.clearing = set(name for name in set(built) | set(self.paths)
+                            if built.get(name) != self.paths.get(name))
+        self.building = {}
+
+    def _maintained(self):
+        "The indexes that writes have to keep up to date"
+        return [name for name in self.indexes if name not in self.clearing]
+
+    def _entries(self, key, value, names):
+        if value is None or not names:
+            return set()
+        doc = document(value)
+        if doc is None:
+            return set()
+        ret = set()
+        for name in names:
+            field = lookup(doc, self.indexes[name])
+            for item in (field if isinstance(field, list) else [field]):
+                encoded = encode_value(item)
+                if encoded is not None:
+                    ret.add(entry(name, encoded, key))
+        return ret
+
+    def _old(self, keys):
+        "What 'keys' have now, if there are any indexes to update"
+        if not self._maintained():
+            return {}
+        return self.backend.get_multi(keys)
+
+    def _reindex(self, old, new):
+        names = self._maintained()
+        if not names:
+            return
+        remove, add = set(), set()
+        for key in set(old) | set(new):
+            before = self._entries(key, old.get(key), names)
+            after = self._entries(key, new.get(key), names)
+            remove |= before - after
+            add |= after - before
+        if remove:
+            self.backend.index_delete(remove)
+        if add:
+            self.backend.index_put(add)
+
+    def _put(self, key, value, ttl = None):
+        old = self._old([key])
+        self.backend.put(key, value, ttl)
+        self._reindex(old, {key: value})
+
+    def _put_multi(self, keys, ttl = None):
+        old = self._old(keys.keys())
+        self.backend.put_multi(keys, ttl)
+        self._reindex(old, keys)
+
+    def _delete(self, key):
+        old = self._old([key])
+        self.backend.delete(key)
+        self._reindex(old, {key: None})
+
+    def _delete_multi(self, keys):
+        old = self._old(keys)
+        self.backend.delete_multi(keys)
+        self._reindex(old, dict.fromkeys(keys))
+
+    def update(self, key, func, ttl = None):
+        old = self._old([key])
+        ret = self.backend.update(key, func, ttl)
+        self._reindex(old, {key: ret})
+        return ret
+
+    def incr(self, key, delta = 1, ttl = None):
+        old = self._old([key])
+        ret = self.backend.incr(key, delta, ttl)
+        self._reindex(old, {key: ret})
+        return ret
+
+    def query(self, name, equals = _nothing, start = None, end = None,
+              after = None, limit = 1000):
+        """Up to 'limit' (key, value) pairs of the documents whose
+           field is 'equals', or from 'start' up to but not including
+           'end' (either of which can be None for no limit), in the
+           index's order, and the entry to continue after for the next
+           page (None at the end). KeyError for indexes that we don't
+           have, and ValueError for values that can't be in one"""
+        if name not in self.indexes:
+            raise KeyError(name)
+        if name in self.clearing or name in self.building:
+            raise IndexNotReady(name)
+        self.queries += 1
+
+        prefix = name + '\x00'
+        if equals is not _nothing:
+            low = prefix + self._encode(equals) + '\x00\x00'
+            high = low[:-1] + '\x01'
+        else:
+            low = prefix
+            if start is not None:
+                low += self._encode(start)
+            high = name + '\x01'
+            if end is not None:
+                high = prefix + self._encode(end)
+        if after is not None:
+            # the first entry that could come after it
+            low = max(low, after + '\x00')
+
+        ret = []
+        next = None
+        while len(ret) < limit:
+            wanted = limit - len(ret)
+            entries = self.backend.index_scan(low, high, wanted)
+            if not entries:
+                next = None
+                break
+            keys = [entry_key(name, e) for e in entries]
+            docs = self.backend.get_multi(keys)
+            stale = []
+            for e, key in zip(entries, keys):
+                value = docs.get(key)
+                if e in self._entries(key, value, [name]):
+                    ret.append((key, value))
+                else:
+                    stale.append(e)
+            if stale:
+                self.backend.index_delete(stale)
+                self.stale += len(stale)
+            next = entries[-1]
+            low = next + '\x00'
+            if len(entries) < wanted:
+                next = None
+                break
+        return ret, next
+
+    @staticmethod
+    def _encode(value):
+        ret = encode_value(value)
+        if ret is None:
+            raise ValueError("%r can't be in an index" % (value,))
+        return ret
+
+    def tick(self):
+        """Does a page of clearing an index's entries, or of building
+           one"""
+        self.backend.tick()
+        for name in list(self.clearing):
+            entries = self.backend.index_scan(name + '\x00', name + '\x01',
+                                              self.build_batch)
+            self.backend.index_delete(entries)
+            if len(entries) < self.build_batch:
+                self.clearing.discard(name)
+                if name in self.indexes:
+                    self.building[name] = None
+            return
+        for name, start in self.building.items():
+            try:
+                items, next = self.backend.scan(start, self.build_batch)
+            except NotFound:
+                # the key that we were to carry on from has gone, so
+                # start again, which only repeats entries that we have
+                self.building[name] = None
+                return
+            add = set()
+            for key, value in items:
+                add |= self._entries(key, value, [name])
+            if add:
+                self.backend.index_put(add)
+            if next is None:
+                del self.building[name]
+                self.backend.index_put([MARKER + '%s\x00%s'
+                                        % (name, self.paths[name])])
+            else:
+                self.building[name] = next
+            return
+
+    def restore(self, f):
+        # backups don't have the index in them
+        ret = self.backend.restore(f)
+        self._check_built()
+        return ret
+
+    def stats(self):
+        ret = dict(self.backend.stats())
+        ret['indexes'] = dict(
+            (name, {'path': self.paths[name],
+                    'state': ('clearing' if name in self.clearing
+                              else 'building' if name in self.building
+                              else 'ready')})
+            for name in self.indexes)
+        ret['index_queries'] = self.queries
+        ret['index_stale_entries'] = self.stale
+        return ret
@@ -0,0 +1,55 @@
+import math
+
+from wrapper import BackendWrapper
+
+
+class LoggedBackend(BackendWrapper):
+    """Appends every put and delete that's applied to the wrapped
+       backend to a WriteLog, for replicas to apply too. Atomic
+       updates are logged as puts of the new value"""
+
+    def __init__(self, backend, log):
+        BackendWrapper.__init__(self, backend)
+        self.log = log
+
+    @staticmethod
+    def _put_entry(key, value, ttl):
+        if ttl is not None:
+            return ('t', key, '%d\n%s' % (max(1, math.ceil(ttl)), value))
+        return ('p', key, value)
+
+    def _put(self, key, value, ttl = None):
+        self.backend.put(key, value, ttl)
+        self.log.append([self._put_entry(key, value, ttl)])
+
+    def _put_multi(self, keys, ttl = None):
+        self.backend.put_multi(keys, ttl)
+        self.log.append([self._put_entry(key, value, ttl)
+                         for (key, value) in keys.iteritems()])
+
+    def _delete(self, key):
+        self.backend.delete(key)
+        self.log.append([('d', key, '')])
+
+    def _delete_multi(self, keys):
+        self.backend.delete_multi(keys)
+        self.log.append([('d', key, '') for key in keys])
+
+    def update(self, key, func, ttl = None):
+        return self._log_update(key, self.backend.update(key, func, ttl), ttl)
+
+    def incr(self, key, delta = 1, ttl = None):
+        return self._log_update(key, self.backend.incr(key, delta, ttl), ttl)
+
+    def restore(self, f):
+        # the log's entries don't lead to the restored store
+        ret = self.backend.restore(f)
+        self.log.reset()
+        return ret
+
+    def _log_update(self, key, value, ttl):
+        if ttl is None and self.backend.supports_ttl:
+            # the key kept whatever TTL it had
+            ttl = self.backend.ttl(key)
+        self.log.append([self._put_entry(key, value, ttl)])
+        return value
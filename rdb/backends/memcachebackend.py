@@ -1,18 +1,46 @@
+import re
+import math
+import time
+import struct
+import hashlib
+
 from backend import StorageBackend
 
+from .. rdbutil import Conflict
+from .. pool import Pool
+
 try:
     from memcache import Client as MemcacheClient
     have_memcache=True
 except ImportError:
     have_memcache=False
 
+# memcached takes expiry times of up to 30 days as relative, and
+# anything bigger as a unix timestamp
+MAX_RELATIVE_TTL = 60*60*24*30
+
+# memcached keys can't be longer than this, or contain control
+# characters or spaces. We escape those (and the escape character) as
+# %XX, which leaves most keys as they are. Keys that are still too
+# long are stored under '%%' and a hash of the key, with the key
+# itself stored at the start of the value so that we can tell them
+# apart from other keys with the same hash. Neither '%%' nor a lone
+# '%' (for the empty key) can come out of the escaping
+MAX_KEY_LENGTH = 250
+needs_escape = re.compile(r'[\x00-\x20\x7f%]')
+hashed_header = struct.Struct('!I') # the length of the key
+
 class MemcacheBackend(StorageBackend):
+    supports_ttl = True
+    supports_processes = True # memcached does the locking
+    cas_retries = 10 # times to retry an update that lost a race
 
     def __init__(self, options, args):
         if not options.servers:
             raise Exception('memcache servers are required')
 
         self.servers = options.servers.split(',')
+        self.connections = options.memcache_connections
 
         self.open()
 
@@ -22,43 +50,136 @@ class MemcacheBackend(StorageBackend):
                             help='comma-separated list of memcached servers',
                             metavar='SERVERS',
                             default='localhost:11211')
-
-    def _encode_key(self, key):
-        return key.encode('base64').rstrip('\n')
-
-    def _decode_key(self, key):
-        return key.decode('base64')
+        optparse.add_option('--memcache-connections',
+                            dest='memcache_connections',
+                            help='''connections to keep to each memcached,
+                                    for requests to use concurrently
+                                    (default: %default)''',
+                            metavar='N',
+                            type='int', default=4)
+
+    @staticmethod
+    def _encode_key(key):
+        if not key:
+            return '%'
+        if needs_escape.search(key):
+            mckey = needs_escape.sub(lambda m: '%%%02X' % ord(m.group()), key)
+        else:
+            mckey = key
+        if len(mckey) > MAX_KEY_LENGTH:
+            return '%%' + hashlib.sha1(key).hexdigest()
+        return mckey
+
+    @staticmethod
+    def _is_hashed(mckey):
+        return mckey.startswith('%%')
+
+    def _wrap(self, key, mckey, value):
+        "What to store for a value"
+        if self._is_hashed(mckey):
+            return ''.join((hashed_header.pack(len(key)), key, value))
+        return value
+
+    def _unwrap(self, key, mckey, stored):
+        """The value from what was stored, or None if it's for another
+           key with the same hash"""
+        if stored is None or not self._is_hashed(mckey):
+            return stored
+        keylen, = hashed_header.unpack_from(stored)
+        start = hashed_header.size
+        if stored[start:start + keylen] != key:
+            return None
+        return stored[start + keylen:]
 
     def _get(self, key, default = None):
-        return self.mc.get(self._encode_key(key))
+        mckey = self._encode_key(key)
+        with self.pool.get_client() as mc:
+            return self._unwrap(key, mckey, mc.get(mckey))
 
     def _get_multi(self, keys):
-        keys = map(self._encode_key, keys)
-        ret = self.mc.get_multi(keys)
-        return dict((self._decode_key(key), value)
-                    for (key, value) in ret.iteritems())
-
-    def _put(self, key, val):
-        return self.mc.set(self._encode_key(key), val)
-
-    def _put_multi(self, keys):
-        keys = dict((self._encode_key(key), value)
-                    for (key, value) in keys.iteritems())
-        self.mc.set_multi(keys)
+        mckeys = dict((self._encode_key(key), key) for key in keys)
+        with self.pool.get_client() as mc:
+            found = mc.get_multi(mckeys.keys())
+        ret = {}
+        for mckey, value in found.iteritems():
+            key = mckeys[mckey]
+            ret[key] = self._unwrap(key, mckey, value)
+        return ret
+
+    def _time(self, ttl):
+        "Convert a TTL to memcached's idea of an expiry time"
+        if ttl is None:
+            return 0 # never
+        elif ttl > MAX_RELATIVE_TTL:
+            return int(math.ceil(time.time() + ttl))
+        return max(1, int(math.ceil(ttl)))
+
+    def _put(self, key, val, ttl = None):
+        mckey = self._encode_key(key)
+        with self.pool.get_client() as mc:
+            return mc.set(mckey, self._wrap(key, mckey, val),
+                          time = self._time(ttl))
+
+    def _put_multi(self, keys, ttl = None):
+        values = {}
+        for key, value in keys.iteritems():
+            mckey = self._encode_key(key)
+            values[mckey] = self._wrap(key, mckey, value)
+        with self.pool.get_client() as mc:
+            mc.set_multi(values, time = self._time(ttl))
 
     def _delete(self, key):
-        self.mc.delete(self._encode_key(key))
+        with self.pool.get_client() as mc:
+            mc.delete(self._encode_key(key))
+
+    def _delete_multi(self, keys):
+        with self.pool.get_client() as mc:
+            mc.delete_multi(map(self._encode_key, keys))
+
+    # incr goes through update() too: memcached's own incr only works
+    # on decimal numbers, and the values that clients store are in
+    # envelopes
+
+    def update(self, key, func, ttl = None):
+        """Uses gets/cas (or add for new keys), so it's atomic even
+           with other servers sharing the same memcacheds. memcached
+           can't tell us a key's TTL, so unless 'ttl' is given the
+           updated key doesn't expire"""
+        mckey = self._encode_key(key)
+        # gets and cas have to be on the same connection
+        with self.pool.get_client() as mc:
+            try:
+                for i in xrange(self.cas_retries):
+                    stored = mc.gets(mckey)
+                    old = self._unwrap(key, mckey, stored)
+                    value = func(old)
+                    wrapped = self._wrap(key, mckey, value)
+                    if stored is None:
+                        done = mc.add(mckey, wrapped, time = self._time(ttl))
+                    else:
+                        # this replaces a hashed key's namesake too
+                        done = mc.cas(mckey, wrapped, time = self._time(ttl))
+                    if done:
+                        return value
+            finally:
+                mc.cas_ids.pop(mckey, None)
+        raise Conflict('%r is changing too quickly' % key)
 
     def close(self):
-        if getattr(self, 'mc', None):
-            self.mc.disconnect_all()
-            self.mc = None
+        if getattr(self, 'pool', None):
+            for mc in self.pool.clients:
+                mc.disconnect_all()
+            self.pool = None
 
     def open(self):
         self.close()
-        self.mc = MemcacheClient(self.servers)
+        # we make sure that keys are valid ourselves
+        self.pool = Pool(MemcacheClient(self.servers, cache_cas = True,
+                                        check_keys = False)
+                         for i in xrange(max(1, self.connections)))
 
     def stats(self):
-        return dict(self.mc.get_stats())
+        with self.pool.get_client() as mc:
+            return dict(mc.get_stats())
 
 
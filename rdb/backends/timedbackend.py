@@ -0,0 +1,85 @@
+import time
+
+from wrapper import BackendWrapper
+
+
+class TimedBackend(BackendWrapper):
+    """Adds up the time spent in the wrapped backend in 'elapsed', so
+       that the server can tell how much of a request's time was the
+       backend's"""
+
+    def __init__(self, backend):
+        BackendWrapper.__init__(self, backend)
+        self.elapsed = 0.0
+
+    def _timed(self, func, *a):
+        start = time.time()
+        try:
+            return func(*a)
+        finally:
+            self.elapsed += time.time() - start
+
+    def _get(self, key, default = None):
+        return self._timed(self.backend.get, key, default)
+
+    def _get_multi(self, keys):
+        return self._timed(self.backend.get_multi, keys)
+
+    def _put(self, key, value, ttl = None):
+        self._timed(self.backend.put, key, value, ttl)
+
+    def _put_multi(self, keys, ttl = None):
+        self._timed(self.backend.put_multi, keys, ttl)
+
+    def _delete(self, key):
+        self._timed(self.backend.delete, key)
+
+    def _delete_multi(self, keys):
+        self._timed(self.backend.delete_multi, keys)
+
+    def has_key(self, key):
+        return self._timed(self.backend.has_key, key)
+
+    def update(self, key, func, ttl = None):
+        return self._timed(self.backend.update, key, func, ttl)
+
+    def incr(self, key, delta = 1, ttl = None):
+        return self._timed(self.backend.incr, key, delta, ttl)
+
+    def ttl(self, key):
+        return self._timed(self.backend.ttl, key)
+
+    def get_reader(self, key):
+        return self._timed(self.backend.get_reader, key)
+
+    def upload_part(self, upload, data):
+        self._timed(self.backend.upload_part, upload, data)
+
+    def commit_upload(self, upload):
+        return self._timed(self.backend.commit_upload, upload)
+
+    def expire(self, limit = 1000):
+        return self._timed(self.backend.expire, limit)
+
+    def keys(self):
+        return self._timed_iter(self.backend.keys())
+
+    def items(self):
+        return self._timed_iter(self.backend.items())
+
+    iteritems = items
+
+    def _timed_iter(self, it):
+        it = iter(it)
+        while True:
+            start = time.time()
+            try:
+                item = it.next()
+            except StopIteration:
+                return
+            finally:
+                self.elapsed += time.time() - start
+            yield item
+
+    def scan(self, start = None, limit = 1000):
+        return self._timed(self.backend.scan, start, limit)
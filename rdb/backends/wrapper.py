@@ -0,0 +1,128 @@
+from backend import StorageBackend
+
+
+class BackendWrapper(StorageBackend):
+    """Base class for backends that wrap another backend to do
+       something to values on their way in or out. Anything that
+       isn't overridden is passed straight through"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def supports_iteration(self):
+        return self.backend.supports_iteration
+
+    @property
+    def supports_ttl(self):
+        return self.backend.supports_ttl
+
+    @property
+    def supports_uploads(self):
+        return self.backend.supports_uploads
+
+    @property
+    def supports_backup(self):
+        return self.backend.supports_backup
+
+    @property
+    def supports_indexes(self):
+        return self.backend.supports_indexes
+
+    @property
+    def supports_processes(self):
+        return self.backend.supports_processes
+
+    def _get(self, key, default = None):
+        return self.backend.get(key, default)
+
+    def _get_multi(self, keys):
+        return self.backend.get_multi(keys)
+
+    def _put(self, key, value, ttl = None):
+        self.backend.put(key, value, ttl)
+
+    def _put_multi(self, keys, ttl = None):
+        self.backend.put_multi(keys, ttl)
+
+    def _delete(self, key):
+        self.backend.delete(key)
+
+    def _delete_multi(self, keys):
+        self.backend.delete_multi(keys)
+
+    def has_key(self, key):
+        return self.backend.has_key(key)
+
+    def update(self, key, func, ttl = None):
+        return self.backend.update(key, func, ttl)
+
+    def incr(self, key, delta = 1, ttl = None):
+        return self.backend.incr(key, delta, ttl)
+
+    def ttl(self, key):
+        return self.backend.ttl(key)
+
+    # get_reader() isn't passed through, since the wrapped backend's
+    # reader would skip whatever we do to values. Wrappers that leave
+    # values alone can pass it through themselves
+
+    def begin_upload(self, key, ttl = None):
+        return self.backend.begin_upload(key, ttl)
+
+    def upload_part(self, upload, data):
+        self.backend.upload_part(upload, data)
+
+    def commit_upload(self, upload):
+        return self.backend.commit_upload(upload)
+
+    def abort_upload(self, upload):
+        self.backend.abort_upload(upload)
+
+    # backups are of what the wrapped backend stores, so that restoring
+    # one doesn't go through us again
+
+    def begin_backup(self):
+        return self.backend.begin_backup()
+
+    def restore(self, f):
+        return self.backend.restore(f)
+
+    def index_put(self, entries):
+        self.backend.index_put(entries)
+
+    def index_delete(self, entries):
+        self.backend.index_delete(entries)
+
+    def index_scan(self, start, end, limit = 1000):
+        return self.backend.index_scan(start, end, limit)
+
+    def expire(self, limit = 1000):
+        return self.backend.expire(limit)
+
+    def tick(self):
+        self.backend.tick()
+
+    def keys(self):
+        return self.backend.keys()
+
+    def items(self):
+        return self.backend.items()
+
+    iteritems = items
+
+    def scan(self, start = None, limit = 1000):
+        return self.backend.scan(start, limit)
+
+    def stats(self):
+        return self.backend.stats()
+
+    def open(self):
+        self.backend.open()
+
+    def close(self):
+        if getattr(self, 'backend', None) is not None:
+            self.backend.close()
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.backend)
@@ -0,0 +1,77 @@
+import math
+import struct
+import hashlib
+
+
+class BloomFilter(object):
+    """A set of strings that can only say "maybe" or "definitely not".
+       'key in bloom' is always True for keys that have been add()ed,
+       and is False for any other key with a probability of about
+       1 - error_rate, as long as it holds no more than 'capacity'
+       keys"""
+
+    header = struct.Struct('!QIQQd') # nbits, nhashes, count,
+                                     # capacity, error_rate
+
+    def __init__(self, capacity, error_rate = 0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        # the optimal sizes for this capacity and error rate
+        self.nbits = max(64, int(-capacity * math.log(error_rate)
+                                 / (math.log(2) ** 2)))
+        self.nhashes = max(1, int(round(float(self.nbits) / capacity
+                                        * math.log(2))))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key):
+        # double hashing: the k hashes are h1 + i*h2 for i in 0..k
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in xrange(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, key):
+        bits = self.bits
+        new = False
+        for idx in self._indexes(key):
+            mask = 1 << (idx & 7)
+            if not bits[idx >> 3] & mask:
+                bits[idx >> 3] |= mask
+                new = True
+        if new:
+            # only count keys that we haven't (probably) seen before
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for idx in self._indexes(key):
+            if not bits[idx >> 3] & (1 << (idx & 7)):
+                return False
+        return True
+
+    def expected_error_rate(self):
+        "The false-positive rate to expect with as many keys as we have"
+        return (1 - math.exp(-float(self.nhashes) * self.count
+                             / self.nbits)) ** self.nhashes
+
+    def save(self, f):
+        f.write(self.header.pack(self.nbits, self.nhashes, self.count,
+                                 self.capacity, self.error_rate))
+        f.write(str(self.bits))
+
+    @classmethod
+    def load(cls, f):
+        (nbits, nhashes, count,
+         capacity, error_rate) = cls.header.unpack(f.read(cls.header.size))
+        bloom = cls.__new__(cls)
+        bloom.nbits, bloom.nhashes, bloom.count = nbits, nhashes, count
+        bloom.capacity, bloom.error_rate = capacity, error_rate
+        bloom.bits = bytearray(f.read())
+        if len(bloom.bits) != (nbits + 7) // 8:
+            raise ValueError('truncated bloom filter')
+        return bloom
+
+    def __repr__(self):
+        return '<%s %d/%d keys>' % (self.__class__.__name__,
+                                    self.count, self.capacity)
@@ -0,0 +1,95 @@
+"""The keys that have been written lately, for clients to watch so
+   that they know when to drop them from their caches (see /_watch).
+
+   Every put and delete gets the next sequence number, and the most
+   recent of them are kept in memory, without their values. Watchers
+   ask for the changes following the last one that they saw, so the
+   server keeps nothing for them between requests. A watcher that has
+   fallen further behind than the feed goes back, or that was watching
+   a server that has since restarted (whose feed has a new id), can't
+   know what it's missed, and is told so with a Gone"""
+
+import uuid
+from itertools import islice
+from collections import deque
+
+from rdbutil import Gone
+
+
+class ChangeFeed(object):
+
+    def __init__(self, capacity = 100000):
+        "Remember the last 'capacity' changes"
+        self.capacity = capacity
+        self.feed_id = uuid.uuid4().hex
+        self.first_seq = 1 # the oldest change we still have
+        self.next_seq = 1
+
+        self._changes = deque() # (seq, op, key)
+        self._waiters = []
+
+    def append(self, entries):
+        """Add a list of (op, key, value) entries, like those of
+           WriteLog.append(), so that a LoggedBackend can feed us.
+           Returns the sequence number of the last one"""
+        for op, key, value in entries:
+            self._changes.append((self.next_seq, 'd' if op == 'd' else 'p',
+                                  key))
+            self.next_seq += 1
+        while len(self._changes) > self.capacity:
+            self._changes.popleft()
+        if self._changes:
+            self.first_seq = self._changes[0][0]
+
+        waiters, self._waiters = self._waiters, []
+        for callback in waiters:
+            callback()
+        return self.next_seq - 1
+
+    def reset(self):
+        """Drop all of the changes and take a new id, when the store has
+           been replaced, so that watchers drop everything they have"""
+        self.feed_id = uuid.uuid4().hex
+        self._changes.clear()
+        # past every number that a watcher could carry on from
+        self.next_seq += 1
+        self.first_seq = self.next_seq
+
+        waiters, self._waiters = self._waiters, []
+        for callback in waiters:
+            callback()
+
+    def wait(self, callback):
+        "Call callback (once) the next time changes are appended"
+        self._waiters.append(callback)
+
+    def unwait(self, callback):
+        if callback in self._waiters:
+            self._waiters.remove(callback)
+
+    def read_from(self, seq, match = None, limit = 1000):
+        """Up to 'limit' of the changes (seq, op, key) from sequence
+           number 'seq' on whose keys 'match' accepts (all of them if
+           it's None), and the sequence number to carry on from. Raises
+           Gone if some of them have been dropped"""
+        if seq < self.first_seq or seq > self.next_seq:
+            raise Gone('%d is not in the feed (%d to %d)'
+                       % (seq, self.first_seq, self.next_seq))
+        ret = []
+        next_seq = seq
+        # the changes are numbered consecutively
+        for change in islice(self._changes, seq - self.first_seq, None):
+            next_seq = change[0] + 1
+            if match is None or match(change[2]):
+                ret.append(change)
+                if len(ret) >= limit:
+                    break
+        return ret, next_seq
+
+    def stats(self):
+        return {
+            'feed_id': self.feed_id,
+            'first_seq': self.first_seq,
+            'last_seq': self.next_seq - 1,
+            'waiting': len(self._waiters),
+            }
@@ -0,0 +1,122 @@
+"""Finding the keys that are being used far more than the others
+   (heavy hitters) without keeping a count for every key.
+
+   A count-min sketch gives an estimate of any key's count that can
+   be too high but never too low, in a fixed amount of memory. To
+   forget old traffic, the window is made of several sketches, one
+   for each slice of time, and the oldest slice is dropped as each new
+   one starts. The top K keys by their estimates are kept alongside"""
+
+import time
+import struct
+import hashlib
+from array import array
+
+
+class CountMinSketch(object):
+
+    def __init__(self, width = 2048, depth = 4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('L', [0]) * width for i in xrange(depth)]
+
+    def indexes(self, key):
+        "Where a key is counted in each row"
+        # double hashing, as in BloomFilter
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.width for i in xrange(self.depth)]
+
+    def add(self, indexes, count = 1):
+        for row, idx in zip(self.rows, indexes):
+            row[idx] += count
+
+    def estimate(self, indexes):
+        return min(row[idx] for (row, idx) in zip(self.rows, indexes))
+
+    def subtract(self, other):
+        for row, other_row in zip(self.rows, other.rows):
+            for idx in xrange(self.width):
+                row[idx] -= other_row[idx]
+
+
+class HotKeys(object):
+    """The top 'k' keys over the last 'window' seconds, which is made
+       of 'slices' sketches"""
+
+    def __init__(self, k = 10, window = 60, slices = 6, width = 2048,
+                 depth = 4):
+        self.k = k
+        self.window = window
+        self.slice_length = float(window) / slices
+        self.slices = [CountMinSketch(width, depth)]
+        self.max_slices = slices
+        # the sum of all of the slices, so that estimates only have to
+        # look at one sketch
+        self.total = CountMinSketch(width, depth)
+        self.started = self.slice_started = time.time()
+
+        self.top = {} # key -> estimate
+        self._threshold = 0 # no more than the smallest estimate in top
+
+    def add(self, keys, now = None):
+        "Count one use of each of 'keys'"
+        now = now or time.time()
+        if now - self.slice_started >= self.slice_length:
+            self._rotate(now)
+        top = self.top
+        # this is the inner loop of every request, so it's
+        # CountMinSketch's add() and estimate() unrolled
+        rows = zip(self.slices[-1].rows, self.total.rows)
+        width = self.total.width
+        unpack, md5 = struct.unpack, hashlib.md5
+        for key in keys:
+            h1, h2 = unpack('<QQ', md5(key).digest())
+            estimate = None
+            for current, total in rows:
+                idx = h1 % width
+                h1 += h2
+                current[idx] += 1
+                count = total[idx] = total[idx] + 1
+                if estimate is None or count < estimate:
+                    estimate = count
+            if key in top or len(top) < self.k:
+                top[key] = estimate
+            elif estimate > self._threshold:
+                smallest = min(top, key = top.get)
+                self._threshold = top[smallest]
+                if estimate > self._threshold:
+                    del top[smallest]
+                    top[key] = estimate
+
+    def _rotate(self, now):
+        # a new slice for each one that has gone by, even if nothing
+        # happened in it
+        passed = int((now - self.slice_started) / self.slice_length)
+        for i in xrange(min(passed, self.max_slices)):
+            self.slices.append(CountMinSketch(self.total.width,
+                                              self.total.depth))
+            if len(self.slices) > self.max_slices:
+                self.total.subtract(self.slices.pop(0))
+        self.slice_started += passed * self.slice_length
+
+        for key in self.top.keys():
+            estimate = self.total.estimate(self.total.indexes(key))
+            if estimate:
+                self.top[key] = estimate
+            else:
+                del self.top[key]
+        self._threshold = min(self.top.itervalues()) if self.top else 0
+
+    def rates(self, now = None):
+        """The top keys and their estimated uses per second, busiest
+           first"""
+        now = now or time.time()
+        if now - self.slice_started >= self.slice_length:
+            self._rotate(now)
+        covered = min(now - self.started,
+                      (len(self.slices) - 1) * self.slice_length
+                      + now - self.slice_started)
+        covered = max(covered, 1.0)
+        return [(key, count / covered)
+                for (key, count) in sorted(self.top.iteritems(),
+                                           key = lambda item: -item[1])]
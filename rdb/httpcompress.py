@@ -0,0 +1,142 @@
+"""gzip and deflate for the server's HTTP responses and request
+   bodies.
+
+   Responses are compressed as they're flushed, so responses that are
+   written a piece at a time (like /_all_data) are streamed compressed
+   rather than held until the end. Responses that are finished in one
+   go are only compressed if they're at least the threshold, since
+   compressing small ones costs more than it saves"""
+
+import time
+import zlib
+
+import tornado.web
+
+# the wbits for zlib to use for each content-coding. HTTP's "deflate"
+# is the zlib format
+wbits = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def accepted_encoding(accept_encoding):
+    """The content-coding to use for a request's Accept-Encoding
+       header, or None"""
+    accepted = set()
+    for part in accept_encoding.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    pass
+        if q > 0:
+            accepted.add(coding)
+    for coding in ('gzip', 'deflate'):
+        if coding in accepted:
+            return coding
+    return None
+
+
+def compress(data, coding, level = 6):
+    c = zlib.compressobj(level, zlib.DEFLATED, wbits[coding])
+    return c.compress(data) + c.flush()
+
+
+def decompress(data, coding, max_size):
+    """Decompress a request body, raising ValueError if it's bad or
+       would be bigger than max_size"""
+    if coding not in wbits:
+        raise ValueError('Unsupported Content-Encoding %r' % coding)
+    try:
+        d = zlib.decompressobj(wbits[coding])
+        ret = d.decompress(data, max_size + 1)
+    except zlib.error, e:
+        if coding != 'deflate':
+            raise ValueError(str(e))
+        # some clients send raw deflate data without the zlib header
+        try:
+            d = zlib.decompressobj(-zlib.MAX_WBITS)
+            ret = d.decompress(data, max_size + 1)
+        except zlib.error, e:
+            raise ValueError(str(e))
+    if len(ret) > max_size:
+        raise ValueError('Request body too large')
+    return ret
+
+
+class CompressionStats(object):
+
+    def __init__(self):
+        self.responses = 0
+        self.bytes_in = 0 # before compression
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def add(self, bytes_in, bytes_out, seconds):
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.seconds += seconds
+
+    def stats(self):
+        return {
+            'responses': self.responses,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'seconds': self.seconds,
+            }
+
+
+class CompressTransform(tornado.web.OutputTransform):
+    """Applies whichever of gzip or deflate the client prefers to
+       responses. Goes in the application's transforms before
+       ChunkedTransferEncoding"""
+
+    def __init__(self, request, threshold = 1024, level = 6, stats = None):
+        self.threshold = threshold
+        self.level = level
+        self.stats = stats
+        self._coding = accepted_encoding(
+            request.headers.get('Accept-Encoding', ''))
+        self._compressor = None
+
+    def transform_first_chunk(self, headers, chunk, finishing):
+        if (self._coding is None or 'Content-Encoding' in headers
+            or 'Content-Range' in headers):
+            # a compressed part of a value would only be any use to
+            # clients that asked for the rest of it compressed too
+            return headers, chunk
+        if headers.get('Vary'):
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        if finishing and len(chunk) < self.threshold:
+            return headers, chunk
+
+        headers['Content-Encoding'] = self._coding
+        self._compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                            wbits[self._coding])
+        if self.stats is not None:
+            self.stats.responses += 1
+        chunk = self.transform_chunk(chunk, finishing)
+        if finishing:
+            headers['Content-Length'] = str(len(chunk))
+        else:
+            # we don't know how long it'll be compressed, so it'll have
+            # to be chunked
+            headers.pop('Content-Length', None)
+        return headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._compressor is None:
+            return chunk
+        started = time.time()
+        # a sync flush makes everything so far readable by the client,
+        # at the cost of a few bytes
+        ret = self._compressor.compress(chunk) + self._compressor.flush(
+            zlib.Z_FINISH if finishing else zlib.Z_SYNC_FLUSH)
+        if self.stats is not None:
+            self.stats.add(len(chunk), len(ret), time.time() - started)
+        return ret
@@ -0,0 +1,136 @@
+"""Request timing for the server's listeners: a log of the requests
+   that took longer than a threshold, and profiling of a sample of
+   requests on demand.
+
+   Both are cheap enough to leave on. Timing a request is a couple of
+   calls to time.time(), and the profiler is only switched on for the
+   requests that are being profiled, while a profile is being taken"""
+
+import time
+import random
+import pstats
+import logging
+import cProfile
+from cStringIO import StringIO
+
+import tornado.ioloop
+
+slow_log = logging.getLogger('rdb.slow')
+
+
+class Timing(object):
+    "One request in progress"
+
+    def __init__(self, backend_elapsed, profiled):
+        self.started = time.time()
+        self.backend_elapsed = backend_elapsed
+        self.profiled = profiled
+
+
+class RequestMonitor(object):
+
+    def __init__(self, backend, slow_threshold = None, io_loop = None):
+        """'backend' is a TimedBackend. Requests that take at least
+           'slow_threshold' seconds are logged to the rdb.slow logger"""
+        self.backend = backend
+        self.slow_threshold = slow_threshold
+        self._io_loop = io_loop
+
+        self.requests = 0
+        self.slow = 0
+
+        self.profiler = None
+        self._sample = 1.0
+        self._remaining = None # requests left to profile, if counted
+        self._timeout = None
+        self._callback = None
+
+    @property
+    def io_loop(self):
+        # not until it's needed, since the server's processes are
+        # forked after we're made, and each needs an IOLoop of its own
+        if self._io_loop is None:
+            self._io_loop = tornado.ioloop.IOLoop.instance()
+        return self._io_loop
+
+    def begin(self):
+        "Call at the start of a request, and pass the result to end()"
+        profiled = (self.profiler is not None
+                    and random.random() < self._sample)
+        if profiled:
+            self.profiler.enable()
+        return Timing(self.backend.elapsed, profiled)
+
+    def end(self, timing, endpoint, keys = None, bytes_in = 0,
+            bytes_out = 0):
+        """Call once a request has been handled. 'endpoint' names what
+           it was, and 'keys' is how many keys it was for, if known"""
+        if timing.profiled and self.profiler is not None:
+            self.profiler.disable()
+        elapsed = time.time() - timing.started
+        self.requests += 1
+
+        if self.slow_threshold and elapsed >= self.slow_threshold:
+            self.slow += 1
+            backend = self.backend.elapsed - timing.backend_elapsed
+            slow_log.warning('%s: %s keys, %d bytes in, %d bytes out, '
+                             '%.1fms (%.1fms backend, %.1fms other)',
+                             endpoint, '?' if keys is None else keys,
+                             bytes_in, bytes_out, elapsed * 1000,
+                             backend * 1000, (elapsed - backend) * 1000)
+
+        if timing.profiled and self._remaining is not None:
+            self._remaining -= 1
+            if self._remaining <= 0:
+                self._stop_profile()
+
+    def profile(self, callback, seconds = None, requests = None,
+                sample = 1.0):
+        """Profile 'sample' of the requests (a fraction) for this many
+           seconds, or until this many of them have been profiled,
+           whichever comes first. The report is passed to callback. Only
+           one profile can be taken at a time; returns False if one is
+           already being taken"""
+        if self.profiler is not None:
+            return False
+        self.profiler = cProfile.Profile()
+        self._sample = sample
+        self._remaining = requests
+        self._callback = callback
+        if seconds is not None:
+            self._timeout = self.io_loop.add_timeout(time.time() + seconds,
+                                                     self._timed_out)
+        return True
+
+    def _timed_out(self):
+        self._timeout = None
+        self._stop_profile()
+
+    def _stop_profile(self):
+        if self.profiler is None:
+            return
+        profiler, callback = self.profiler, self._callback
+        self.profiler = self._callback = None
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        callback(self.report(profiler))
+
+    def report(self, profiler, limit = 50):
+        "The top of a profile, by cumulative time"
+        out = StringIO()
+        try:
+            stats = pstats.Stats(profiler, stream = out)
+        except TypeError:
+            # nothing was profiled
+            return 'No requests were profiled\n'
+        stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'slow': self.slow,
+            'slow_threshold': self.slow_threshold,
+            'profiling': self.profiler is not None,
+            }
@@ -1,6 +1,8 @@
+import time
 from Queue import Queue
+from collections import deque
 from contextlib import contextmanager
-from threading import Semaphore, Lock, Thread
+from threading import Semaphore, Lock, Condition, Thread
 
 class Pool(object):
     def __init__(self, clients):
@@ -24,75 +26,199 @@ class Pool(object):
                     self.clients.insert(0, c)
 
 
-class PooledThread(Thread):
+class Timeout(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Saturated(Exception):
+    """The call was refused because its key already has as many
+       calls outstanding, and waiting for them, as the executor
+       allows"""
+    pass
+
+
+class Future(object):
+    """The eventual result of a function submitted to an Executor"""
+
+    PENDING, RUNNING, DONE, CANCELLED = range(4)
+
     def __init__(self):
-        self.q = Queue()
-        self.kill_threads_on_exception = False
-        Thread.__init__(self)
+        self.cond = Condition()
+        self.state = self.PENDING
+        self.ret = self.exc = None
+        self.callbacks = []
 
-    def run(self):
-        while True:
-            func, resp_q = self.q.get()
-            ret = exc = None
-            try:
-                ret = func()
-            except Exception, e:
-                exc = e
-                if self.kill_threads_on_exception:
-                    raise
-            resp_q.put((ret, exc))
-            self.q.task_done()
-
-    def do(self, func):
-        q = self.async_do(func)
-        return self.async_retreive(q)
-
-    def async_do(self, func):
-        """Tells this thread to process this item, returning a queue
-           that can be used to retreive the result when calculated"""
-        q = Queue(1)
-        self.q.put((func, q))
-        return q
-
-    def async_retrieve(self, q):
-        resp, exc = q.get()
-        q.task_done()
+    def cancel(self):
+        """Cancel the call if it hasn't started yet. Calls that are
+           already running can't be interrupted, and their results
+           will just be dropped"""
+        with self.cond:
+            if self.state != self.PENDING:
+                return self.state == self.CANCELLED
+            self.state = self.CANCELLED
+            self.exc = Cancelled()
+            self.cond.notifyAll()
+        self._run_callbacks()
+        return True
+
+    def done(self):
+        return self.state in (self.DONE, self.CANCELLED)
+
+    def start(self):
+        """Called by the executor before running the call. Returns
+           False if it's been cancelled in the meantime"""
+        with self.cond:
+            if self.state != self.PENDING:
+                return False
+            self.state = self.RUNNING
+            return True
+
+    def set_result(self, ret):
+        self._finish(ret, None)
+
+    def set_exception(self, exc):
+        self._finish(None, exc)
+
+    def _finish(self, ret, exc):
+        with self.cond:
+            if self.done():
+                return
+            self.ret, self.exc = ret, exc
+            self.state = self.DONE
+            self.cond.notifyAll()
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        for callback in self.callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self.cond:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout = None):
+        """Returns True if the call finished within 'timeout' seconds"""
+        with self.cond:
+            if not self.done():
+                self.cond.wait(timeout)
+            return self.done()
+
+    def exception(self, timeout = None):
+        if not self.wait(timeout):
+            raise Timeout()
+        return self.exc
+
+    def result(self, timeout = None):
+        exc = self.exception(timeout)
         if exc:
             raise exc
-        else:
-            return resp
+        return self.ret
+
+
+def wait(futures, timeout = None, first = False):
+    """Wait up to 'timeout' seconds for all of the futures (or just
+       the first of them if 'first') to finish, returning a set of
+       those that did and a set of those that didn't"""
+    futures = set(futures)
+    cond = Condition()
 
+    def notify(future):
+        with cond:
+            cond.notifyAll()
 
-class ThreadPool(Pool):
+    for future in futures:
+        future.add_done_callback(notify)
+
+    deadline = None if timeout is None else time.time() + timeout
+    with cond:
+        while True:
+            done = set(f for f in futures if f.done())
+            if done == futures or (first and done):
+                break
+            if deadline is None:
+                cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                cond.wait(remaining)
+    return done, futures - done
 
-    def __init__(self, size = 10):
-        threads = [PooledThread() for x in xrange(size)]
-        for thread in threads:
+
+class Executor(object):
+    """A fixed-size pool of threads that runs submitted functions,
+       returning Futures for their results. Calls can be given a key
+       (e.g. the node that they talk to), and no key will be given
+       more than 'per_key' outstanding calls, so that one slow node
+       can't tie up every thread. Calls over that wait their turn,
+       up to 'max_waiting' of them per key, and any more are refused
+       as Saturated"""
+
+    def __init__(self, size = 10, per_key = None, max_waiting = 1000):
+        self.per_key = per_key
+        self.max_waiting = max_waiting
+        self.outstanding = {} # key -> number of unfinished calls
+        self.waiting = {} # key -> deque of (func, future) over per_key
+        self.lock = Lock()
+
+        self.q = Queue()
+        for x in xrange(size):
+            thread = Thread(target = self._work)
             thread.setDaemon(True)
             thread.start()
-        Pool.__init__(self, threads)
-
-    def pmap(self, funcs):
-        funcs = list(funcs)
-        q_s = []
-        for func in funcs:
-            # damn you, Python scoping rules
-            def _debind(_itm):
-                return _itm
-            with self.get_client() as client:
-                q_s.append(client.async_do(_debind(func)))
-
-        rets = []
-        excs = []
-        for q in q_s:
-            resp, exc = q.get()
-            if exc:
-                excs.append(exc)
-            else:
-                rets.append(resp)
-            q.task_done()
-        if excs:
-            raise excs[0]
+
+    def submit(self, func, key = None):
+        future = Future()
+
+        if key is not None and self.per_key:
+            with self.lock:
+                if self.outstanding.get(key, 0) >= self.per_key:
+                    waiting = self.waiting.setdefault(key, deque())
+                    if len(waiting) >= self.max_waiting:
+                        future.set_exception(Saturated(key))
+                    else:
+                        waiting.append((func, future))
+                    return future
+                self.outstanding[key] = self.outstanding.get(key, 0) + 1
+            self._dispatch(func, future, key)
         else:
-            return rets
+            self.q.put((func, future))
+        return future
+
+    def _dispatch(self, func, future, key):
+        # not while we hold the lock, since the callback runs at once
+        # if the call has been cancelled
+        future.add_done_callback(lambda f: self._release(key))
+        self.q.put((func, future))
 
+    def _release(self, key):
+        "A call for 'key' has finished, so the next one can go"
+        with self.lock:
+            waiting = self.waiting.get(key)
+            while waiting:
+                func, future = waiting.popleft()
+                if not future.done():
+                    break
+            else:
+                # cancelled while they waited, if there were any
+                self.outstanding[key] -= 1
+                return
+        self._dispatch(func, future, key)
+
+    def _work(self):
+        while True:
+            func, future = self.q.get()
+            if not future.start():
+                # cancelled while it was waiting in the queue
+                continue
+            try:
+                future.set_result(func())
+            except Exception, e:
+                future.set_exception(e)
@@ -1,15 +1,31 @@
-import cPickle as pickle
+import time
+import zlib
+import socket
 import urllib3
 import hashlib
 import simplejson as json
+from base64 import b64decode
 from itertools import chain
+from cStringIO import StringIO
+from collections import deque
+from Queue import Queue, Empty, Full
+from threading import Event, Lock, RLock, Thread
 from urllib import quote, urlencode
 from contextlib import contextmanager
 
-from rdbutil import DictNature, NotFound
-from pool import ThreadPool, Pool
+import rdbcodec
+from rdbutil import DictNature, NotFound, Conflict, BulkResult, BulkError
+from rdbutil import NotModified, Overloaded, Gone, version_of
+from rdbutil import pack_record, read_records, records_content_type
+from rdbutil import record_header, split_records
+from pool import Executor, Cancelled, Timeout, wait
 
-def client_from_spec(spec):
+_any = object() # for query()'s value, since None is one
+
+def client_from_spec(spec, **kw):
+    """Build a client from a "server:port,weight;server:port,weight"
+       spec. Any keyword arguments (e.g. replicas) are passed along to
+       RDBMultiClient"""
     if ';' in spec:
         servers = []
         for server in spec.split(';'):
@@ -19,11 +35,11 @@ def client_from_spec(spec):
             else:
                 weight = 1
             servers.append((server, weight))
-        return RDBMultiClient(servers)
+        return RDBMultiClient(servers, **kw)
     else:
         # we return a multiclient either way because we need it to be
         # thread-safe
-        return RDBMultiClient([(spec,1)])
+        return RDBMultiClient([(spec,1)], **kw)
 
 class ConsistantHasher(object):
     def __init__(self, weights):
@@ -31,6 +47,7 @@ class ConsistantHasher(object):
             weights = sorted(weights.items(), key=lambda x: x[1])
 
         # now weights =:= [(node_name, int), ...]
+        self.weights = weights
 
         # In practise, the total of all of the weights is probably
         # less than a hundred. So to speed up lookups, we're going to
@@ -51,6 +68,20 @@ class ConsistantHasher(object):
     def __getitem__(self, key):
         return self.nodes[self.index_for(key)]
 
+    def nodes_for(self, key, count = 1):
+        """The first 'count' distinct nodes found walking around the
+           ring from the key's position, starting with the node that
+           __getitem__ would return"""
+        idx = self.index_for(key)
+        ret = []
+        for x in xrange(self.total):
+            node = self.nodes[(idx + x) % self.total]
+            if node not in ret:
+                ret.append(node)
+                if len(ret) == count:
+                    break
+        return tuple(ret)
+
     def index_for(self, key):
         # get a hash of the object
         h = int(hashlib.md5(key).hexdigest(), 16) % self.total
@@ -61,75 +92,647 @@ class ConsistantHasher(object):
         return "%s(%r)" % (self.__class__.__name__, self.weights)
 
 
+class LatencyTracker(object):
+    """Keeps a node's most recent latencies to estimate their
+       percentiles. Percentiles are only recalculated every
+       'recalculate' samples, since that means a sort"""
+    min_samples = 100
+
+    def __init__(self, size = 1000, recalculate = 100):
+        self.samples = deque(maxlen = size)
+        self.recalculate = recalculate
+        self.count = 0
+        self.percentiles = {}
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.count += 1
+        if self.count % self.recalculate == 0:
+            self.percentiles = {}
+
+    def percentile(self, p):
+        """Returns the p'th percentile latency, or None if we haven't
+           seen enough requests to say"""
+        if len(self.samples) < self.min_samples:
+            return None
+        if p not in self.percentiles:
+            samples = sorted(self.samples)
+            idx = min(len(samples) - 1, int(len(samples) * p / 100.0))
+            self.percentiles[p] = samples[idx]
+        return self.percentiles[p]
+
+
 class RDBMultiClient(DictNature):
     pool_size = 5 # use this many threads per RDBClient
+    node_parallelism = 2 # requests per node at a time for one bulk()
+    chunk_keys = 1000 # the most keys to send a node in one request
+    timeout = None # default seconds to wait for a node during bulk()
+    page_timeout = 60 # default seconds query_iter() waits for a page
+    health_interval = 5 # seconds between checks on ejected nodes
 
-    def __init__(self, weights):
+    def __init__(self, weights, replicas = 1, hedge_delay = None,
+                 hedge_percentile = None, encoder = None,
+                 tcp_port_offset = None, compress = False):
+        """Each key is written to 'replicas' nodes, found by walking
+           around the ring from its primary node, and read from the
+           primary. If the primary hasn't answered a read after
+           'hedge_delay' seconds (or the 'hedge_percentile'th
+           percentile of its recent latencies, once we know them) the
+           read is sent to the next replica too, and the first answer
+           wins. Nodes that fail are ejected until a health check
+           finds them answering again. 'encoder' is the
+           rdbcodec.ValueEncoder that the clients encode values with. If
+           the nodes have records protocol listeners, 'tcp_port_offset'
+           is the difference between their ports and the nodes' HTTP
+           ports. 'compress' is passed along to the RDBClients"""
         self.weights = weights
         self.nodes = set(x[0] for x in weights)
         self.hasher = ConsistantHasher(weights)
 
-        self.clients = dict((node, RDBClient(node))
+        self.replicas = replicas
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.latencies = dict((node, LatencyTracker())
+                              for node in self.nodes)
+
+        self.ejected = {} # node -> when it was ejected
+        self.health_lock = Lock()
+        self.health_checker = None
+
+        def tcp_port(node):
+            if tcp_port_offset is None:
+                return None
+            port = int(node.split(':')[1]) if ':' in node else 6552
+            return port + tcp_port_offset
+        self.clients = dict((node, RDBClient(node, encoder = encoder,
+                                             tcp_port = tcp_port(node),
+                                             compress = compress))
                             for node in self.nodes)
 
         self.parallel_transfer = True
         if self.parallel_transfer:
-            # a thread-pool to support concurrent bulk requests that
-            # span multiple nodes
-            self.thread_pool = ThreadPool(len(self.nodes) * self.pool_size)
+            # threads to support concurrent bulk requests that span
+            # multiple nodes. No node gets more than pool_size of
+            # them, so a slow node can't hold up the others
+            self.executor = Executor(len(self.nodes) * self.pool_size,
+                                     per_key = self.pool_size)
 
-    def get(self, key, *a, **kw):
-        self.clients[self.hasher[key]].get(key, *a, **kw)
+    def get(self, key, default = NotFound, timeout = None, fields = None):
+        nodes = self._replicas_for(key)
+        if len(nodes) == 1 and timeout is None:
+            return self.clients[nodes[0]].get(key, default = default,
+                                              fields = fields)
+
+        def _get(node):
+            return self.clients[node].get(key, fields = fields)
+        (ret, exc), = self._hedged([(nodes, _get)], timeout)
+        if isinstance(exc, NotFound) and default is not NotFound:
+            return default
+        elif exc:
+            raise exc
+        return ret
+
+    def gets(self, key, version = None, timeout = None):
+        """Returns (value, version), where value is NotModified if
+           'version' is already the current one"""
+        nodes = self._replicas_for(key)
+        if len(nodes) == 1 and timeout is None:
+            return self.clients[nodes[0]].gets(key, version)
+
+        def _gets(node):
+            return self.clients[node].gets(key, version)
+        (ret, exc), = self._hedged([(nodes, _gets)], timeout)
+        if exc:
+            raise exc
+        return ret
+
+    def gets_multi(self, keys, timeout = None):
+        """Like RDBClient.gets_multi, but spread over the nodes. Nodes
+           that fail leave their keys out of the BulkResult, and their
+           exceptions in its errors"""
+        if not isinstance(keys, dict):
+            keys = dict.fromkeys(keys)
+
+        groups = {} # (replica nodes) -> {key: version}
+        for key, version in keys.iteritems():
+            groups.setdefault(self._replicas_for(key), {})[key] = version
+        groups = groups.items()
+
+        def getter(_keys):
+            def _gets(node):
+                return self.clients[node].gets_multi(_keys)
+            return _gets
+        answers = self._hedged([(nodes, getter(group))
+                                for (nodes, group) in groups],
+                               timeout)
+
+        ret = BulkResult()
+        for (nodes, group), (answer, exc) in zip(groups, answers):
+            if exc:
+                ret.errors.setdefault(nodes[0], exc)
+            else:
+                ret.update(answer)
+        return ret
 
     def put(self, key, value, *a, **kw):
-        self.clients[self.hasher[key]].put(key, value, *a, **kw)
+        for node in self._replicas_for(key):
+            self.clients[node].put(key, value, *a, **kw)
 
     def delete(self, key, *a, **kw):
-        self.clients[self.hasher[key]].delete(key, *a, **kw)
+        for node in self._replicas_for(key):
+            self.clients[node].delete(key, *a, **kw)
 
-    def get_multi(self, keys):
-        return self.bulk(get = keys)
+    # the atomic operations are applied on every replica in turn, and
+    # return what the primary returned
 
-    def put_multi(self, keys):
-        return self.bulk(put = keys)
+    def incr(self, key, *a, **kw):
+        return [self.clients[node].incr(key, *a, **kw)
+                for node in self._replicas_for(key)][0]
 
-    def delete_multi(self, keys):
-        return self.bulk(delete = keys)
+    def append(self, key, *a, **kw):
+        return [self.clients[node].append(key, *a, **kw)
+                for node in self._replicas_for(key)][0]
+
+    def cas(self, key, *a, **kw):
+        return [self.clients[node].cas(key, *a, **kw)
+                for node in self._replicas_for(key)][0]
+
+    def put_stream(self, key, f, ttl = None):
+        """Like RDBClient.put_stream. With more than one replica, 'f'
+           has to be seekable, since it's read once for each"""
+        nodes = self._replicas_for(key)
+        position = f.tell() if len(nodes) > 1 else None
+        versions = []
+        for node in nodes:
+            if position is not None:
+                f.seek(position)
+            versions.append(self.clients[node].put_stream(key, f, ttl))
+        return versions[0]
 
-    def bulk(self, get = [], put = {}, delete = []):
-        """Do multiple _bulk requests in parallel"""
+    def get_stream(self, key, *a, **kw):
+        return self.clients[self._replicas_for(key)[0]].get_stream(key, *a,
+                                                                    **kw)
+
+    def get_multi(self, keys, timeout = None, fields = None):
+        return self.bulk(get = keys, timeout = timeout, fields = fields)
+
+    def put_multi(self, keys, ttl = None, timeout = None, partial = False):
+        """Raises a BulkError if any node fails, unless 'partial', in
+           which case the BulkResult is returned for the caller to look
+           at its errors"""
+        ret = self.bulk(put = keys, ttl = ttl, timeout = timeout)
+        return ret if partial else ret.check()
+
+    def delete_multi(self, keys, timeout = None, partial = False):
+        "Like put_multi"
+        ret = self.bulk(delete = keys, timeout = timeout)
+        return ret if partial else ret.check()
+
+    def bulk(self, get = [], put = {}, delete = [], incr = {}, append = {},
+             cas = {}, ttl = None, timeout = None, fields = None):
+        """Do multiple _bulk requests in parallel, waiting up to
+           'timeout' seconds (default self.timeout) for them. A node
+           that fails or doesn't answer in time doesn't fail the whole
+           request: we return a BulkResult of whatever the other nodes
+           returned, with that node's exception in its 'errors'"""
         if not isinstance(put, dict):
             put = dict(put)
 
+        ret = BulkResult()
+        for node, answer, exc in self._bulk_chunks(get, put, delete, incr,
+                                                   append, cas, ttl,
+                                                   timeout, fields):
+            if exc:
+                ret.errors.setdefault(node, exc)
+            else:
+                ret.merge(answer)
+        return ret
+
+    def get_multi_iter(self, keys, timeout = None, fields = None):
+        """Like get_multi, but yields the (key, value) pairs a request's
+           worth at a time, as each node answers. If any nodes failed,
+           a BulkError is raised once the others' items are all
+           yielded"""
+        errors = {}
+        for node, answer, exc in self._bulk_chunks(get = keys,
+                                                   timeout = timeout,
+                                                   fields = fields):
+            if exc:
+                errors.setdefault(node, exc)
+            else:
+                for item in answer.iteritems():
+                    yield item
+        if errors:
+            raise BulkError(errors)
+
+    def _bulk_chunks(self, get = [], put = {}, delete = [], incr = {},
+                     append = {}, cas = {}, ttl = None, timeout = None,
+                     fields = None):
+        """Split a bulk request up by node, and into requests of no
+           more than chunk_keys keys, and yield (node, result,
+           exception) for each request as it finishes. Each node is
+           sent up to node_parallelism of them at a time. Operations on
+           the same key that end up in different requests can happen
+           in either order"""
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+
         by_node = {}
+        hedged = {} # (replica nodes) -> keys to get from them
         for key in get:
-            by_node.setdefault(self.hasher[key],
-                               {}).setdefault('get', []).append(key)
+            nodes = self._replicas_for(key)
+            if len(nodes) > 1:
+                hedged.setdefault(nodes, []).append(key)
+            else:
+                ops = by_node.setdefault(nodes[0], {})
+                ops.setdefault('get', []).append(key)
+                if fields:
+                    ops['fields'] = fields
         for key in delete:
-            by_node.setdefault(self.hasher[key],
-                               {}).setdefault('delete', []).append(key)
+            for node in self._replicas_for(key):
+                by_node.setdefault(node,
+                                   {}).setdefault('delete', []).append(key)
         for key, val in put.iteritems():
-            by_node.setdefault(self.hasher[key],
-                               {}).setdefault('put', {})[key] = val
-
-        funcs = []
-        for node, ops in by_node.iteritems():
-            def fetch(_node, _ops):
-                def _fetch():
-                    return self.clients[_node].bulk(**_ops)
-                return _fetch
-            funcs.append(fetch(node, ops))
-
-        if self.parallel_transfer and len(funcs) > 1:
-            bulks = self.thread_pool.pmap(funcs)
-        else:
-            bulks = [f() for f in funcs] 
+            for node in self._replicas_for(key):
+                ops = by_node.setdefault(node, {})
+                ops.setdefault('put', {})[key] = val
+                ops['ttl'] = ttl
+        for op, args in (('incr', incr), ('append', append), ('cas', cas)):
+            for key, arg in args.iteritems():
+                for node in self._replicas_for(key):
+                    ops = by_node.setdefault(node, {})
+                    ops.setdefault(op, {})[key] = arg
+                    ops['ttl'] = ttl
 
-        ret = {}
-        for bulk in bulks:
-            ret.update(bulk)
+        by_node = dict((node, self._split(ops))
+                       for (node, ops) in by_node.iteritems())
+        hedged = [(nodes, keys[i:i + self.chunk_keys])
+                  for (nodes, keys) in hedged.iteritems()
+                  for i in xrange(0, len(keys), self.chunk_keys)]
+
+        if not hedged and (not self.parallel_transfer
+                           or (sum(map(len, by_node.values())) == 1
+                               and timeout is None)):
+            # no point in handing these off to another thread
+            for node, chunks in by_node.iteritems():
+                for ops in chunks:
+                    try:
+                        yield node, self.clients[node].bulk(**ops), None
+                    except Exception, e:
+                        yield node, None, e
+            return
+
+        # each node's requests are shared out between up to
+        # node_parallelism lanes, which send theirs one at a time and
+        # put the answers here as they come
+        answers = Queue()
+        stop = Event()
+        futures = []
+        outstanding = {} # node -> requests that haven't been answered
+        for node, chunks in by_node.iteritems():
+            outstanding[node] = len(chunks)
+            lanes = min(len(chunks), self.node_parallelism)
+            for i in xrange(lanes):
+                lane = deque(chunks[i::lanes])
+                future = self.executor.submit(
+                    self._lane(node, lane, answers, stop), key = node)
+                future.add_done_callback(
+                    self._lane_done(node, lane, answers))
+                futures.append(future)
+
+        if hedged:
+            # these go out on the executor too, so the lanes are already
+            # getting on with it while we wait for them
+            def getter(_keys):
+                def _get(node):
+                    return self.clients[node].bulk(get = _keys,
+                                                   fields = fields)
+                return _get
+            results = self._hedged(
+                [(nodes, getter(keys)) for (nodes, keys) in hedged],
+                None if deadline is None else max(0, deadline - time.time()))
+            for (nodes, keys), (answer, exc) in zip(hedged, results):
+                yield nodes[0], answer, exc
+
+        try:
+            while any(outstanding.itervalues()):
+                try:
+                    if deadline is None:
+                        node, answer, exc = answers.get()
+                    else:
+                        node, answer, exc = answers.get(
+                            timeout = max(0, deadline - time.time()))
+                except Empty:
+                    break
+                outstanding[node] -= 1
+                yield node, answer, exc
+        finally:
+            # if we ran out of time (or our caller stopped listening),
+            # requests that haven't started yet save the nodes the
+            # trouble. Others' results are just dropped
+            stop.set()
+            for future in futures:
+                future.cancel()
+
+        for node, count in outstanding.iteritems():
+            if count:
+                yield node, None, Timeout(node)
+
+    def _split(self, ops):
+        """Split the keyword arguments for an RDBClient.bulk() into a
+           list of them with no more than chunk_keys keys each"""
+        chunks = []
+        chunk, count = {}, 0
+        for op in ('get', 'put', 'incr', 'append', 'cas', 'delete'):
+            args = ops.get(op)
+            if not args:
+                continue
+            for item in (args.iteritems() if isinstance(args, dict)
+                         else args):
+                if count == self.chunk_keys:
+                    chunks.append(chunk)
+                    chunk, count = {}, 0
+                if isinstance(args, dict):
+                    chunk.setdefault(op, {})[item[0]] = item[1]
+                else:
+                    chunk.setdefault(op, []).append(item)
+                count += 1
+        chunks.append(chunk)
+        for arg in ('ttl', 'fields'):
+            if arg in ops:
+                for chunk in chunks:
+                    chunk[arg] = ops[arg]
+        return chunks
+
+    def _lane(self, node, chunks, answers, stop):
+        def _run():
+            while chunks and not stop.is_set():
+                try:
+                    answer, exc = self.clients[node].bulk(**chunks[0]), None
+                except Exception, e:
+                    answer, exc = None, e
+                chunks.popleft()
+                answers.put((node, answer, exc))
+        return _run
+
+    def _lane_done(self, node, chunks, answers):
+        """A callback for a lane's future, which answers whatever it
+           didn't get to with the reason (e.g. the executor refused it
+           as Saturated)"""
+        def _done(future):
+            exc = future.exception() or Cancelled()
+            while chunks:
+                chunks.popleft()
+                answers.put((node, None, exc))
+        return _done
+
+    def _replicas_for(self, key):
+        """The nodes that hold a key, primary first, leaving out any
+           that are ejected unless that would leave none at all"""
+        nodes = self.hasher.nodes_for(key, self.replicas)
+        live = tuple(node for node in nodes if node not in self.ejected)
+        return live or nodes
+
+    def _hedge_delay(self, node):
+        if self.hedge_percentile is not None:
+            delay = self.latencies[node].percentile(self.hedge_percentile)
+            if delay is not None:
+                return delay
+        return self.hedge_delay
+
+    def _hedged(self, calls, timeout = None):
+        """Run each of 'calls', a list of (nodes, func) pairs, by
+           calling func(node) with the first of its nodes. If that
+           node fails, or hasn't answered within its hedge delay, the
+           call is also sent to the next node, and so on. The first
+           answer (including a NotFound) wins. Returns a list of
+           (result, exception) pairs in the same order as 'calls'"""
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+
+        rets = [None] * len(calls)
+        remaining = [list(nodes) for (nodes, func) in calls]
+        errors = [{} for call in calls]
+        outstanding = [0] * len(calls)
+        hedge_at = [None] * len(calls)
+        unfinished = set(xrange(len(calls)))
+        pending = {} # future -> (call index, node)
+
+        while True:
+            now = time.time()
+            for i in list(unfinished):
+                if outstanding[i] and (hedge_at[i] is None
+                                       or now < hedge_at[i]):
+                    continue
+                if not remaining[i]:
+                    if not outstanding[i]:
+                        unfinished.discard(i)
+                        rets[i] = (None, BulkError(errors[i]))
+                    continue
+                node = remaining[i].pop(0)
+                future = self.executor.submit(
+                    self._timed(node, calls[i][1]), key = node)
+                pending[future] = (i, node)
+                outstanding[i] += 1
+                delay = self._hedge_delay(node)
+                hedge_at[i] = (now + delay
+                               if delay is not None and remaining[i]
+                               else None)
+
+            if not unfinished:
+                break
+
+            wake = [hedge_at[i] for i in unfinished
+                    if hedge_at[i] is not None]
+            if deadline is not None:
+                wake.append(deadline)
+            done, not_done = wait(pending.keys(),
+                                  max(0, min(wake) - time.time())
+                                  if wake else None,
+                                  first = True)
+
+            for future in done:
+                i, node = pending.pop(future)
+                outstanding[i] -= 1
+                if i not in unfinished:
+                    continue
+                exc = future.exception()
+                if exc is None or isinstance(exc, NotFound):
+                    rets[i] = (future.ret, exc)
+                    unfinished.discard(i)
+                else:
+                    # _timed has already ejected nodes that raised; one
+                    # the executor refused as Saturated, or whose call
+                    # was cancelled, is busy rather than unhealthy
+                    errors[i][node] = exc
+                    # don't wait for the hedge delay to try the next,
+                    # nor spin waiting to hedge when there is none
+                    hedge_at[i] = now if remaining[i] else None
+
+            if deadline is not None and time.time() >= deadline:
+                for future, (i, node) in pending.iteritems():
+                    if i in unfinished:
+                        errors[i][node] = Timeout(node)
+                        self._eject(node)
+                for i in unfinished:
+                    rets[i] = (None, BulkError(errors[i]))
+                break
+
+        # anyone still working is too late to matter
+        for future in pending:
+            future.cancel()
+
+        return rets
+
+    def _timed(self, node, func):
+        """Wrap func(node) to keep track of the node's latency, and
+           eject it if it fails"""
+        def _call():
+            start = time.time()
+            try:
+                ret = func(node)
+            except NotFound:
+                self.latencies[node].add(time.time() - start)
+                raise
+            except Exception:
+                self._eject(node)
+                raise
+            self.latencies[node].add(time.time() - start)
+            return ret
+        return _call
+
+    def _eject(self, node):
+        with self.health_lock:
+            if node in self.ejected:
+                return
+            self.ejected[node] = time.time()
+            if self.health_checker is None:
+                self.health_checker = Thread(target = self._check_health)
+                self.health_checker.setDaemon(True)
+                self.health_checker.start()
+
+    def _check_health(self):
+        """Runs in its own thread, bringing back ejected nodes as they
+           start answering again"""
+        while True:
+            time.sleep(self.health_interval)
+            for node in list(self.ejected):
+                try:
+                    self.clients[node].ping(timeout = self.health_interval)
+                except Exception:
+                    continue
+                with self.health_lock:
+                    self.ejected.pop(node, None)
+
+    def hot_keys(self, timeout = None):
+        """The hot keys of all of the nodes that answer, for callers
+           that want to treat them specially (by caching them, say). A
+           key's rates are added up over the nodes that report it"""
+        ret = {'reads': {}, 'writes': {}}
+        for node in self.nodes:
+            try:
+                hot = self.clients[node].hot_keys(timeout = timeout)
+            except Exception:
+                continue
+            for kind, rates in hot.iteritems():
+                for key, rate in rates.iteritems():
+                    ret[kind][key] = ret[kind].get(key, 0) + rate
         return ret
 
+    def query_iter(self, index, value = _any, start = None, end = None,
+                   values = False, page_size = 1000, timeout = None):
+        """Like RDBClient.query_iter(), across all of the nodes at
+           once, yielding each node's results as they arrive. Keys are
+           only yielded from their primary node, so replicas don't
+           repeat them. If any nodes failed, or none of them sent a
+           page within 'timeout' seconds (default self.page_timeout), a
+           BulkError is raised once the others' results are all
+           yielded"""
+        if timeout is None:
+            timeout = self.page_timeout
+        nodes = [node for node in self.nodes
+                 if node not in self.ejected] or list(self.nodes)
+        pages = Queue(len(nodes) * 2)
+        stop = Event()
+
+        def put(page):
+            # without blocking forever if our caller has gone away
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout = 0.1)
+                    return
+                except Full:
+                    pass
+
+        def querier(node):
+            def _run():
+                try:
+                    after = None
+                    while not stop.is_set():
+                        results, after = self.clients[node].query(
+                            index, value, start, end, values = values,
+                            limit = page_size, after = after)
+                        put((node, results, None))
+                        if after is None:
+                            break
+                except Exception, e:
+                    put((node, None, e))
+                else:
+                    put((node, None, None))
+            return _run
+
+        def querier_done(node):
+            # the querier answers for itself once it runs, but not if
+            # the executor refused it as Saturated, or it was cancelled
+            def _done(future):
+                exc = future.exception()
+                if exc is not None:
+                    put((node, None, exc))
+            return _done
+
+        for node in nodes:
+            self.executor.submit(querier(node), key = node) \
+                .add_done_callback(querier_done(node))
+
+        running = set(nodes)
+        errors = {}
+        try:
+            while running:
+                try:
+                    node, results, exc = pages.get(timeout = timeout)
+                except Empty:
+                    for node in running:
+                        errors[node] = Timeout(node)
+                    break
+                if results is None:
+                    running.discard(node)
+                    if exc is not None:
+                        errors[node] = exc
+                    continue
+                for result in results:
+                    key = result[0] if values else result
+                    if self._replicas_for(key)[0] == node:
+                        yield result
+        finally:
+            stop.set()
+        if errors:
+            raise BulkError(errors)
+
+    def query(self, index, value = _any, start = None, end = None,
+              values = False, page_size = 1000, timeout = None):
+        """All of query_iter()'s results, as a list of keys or with
+           'values' a dictionary of items"""
+        ret = self.query_iter(index, value, start, end, values = values,
+                              page_size = page_size, timeout = timeout)
+        return dict(ret) if values else list(ret)
+
+    def scan_items(self, batch_size = 1000):
+        """Iterate over the items on every node in turn"""
+        return chain(*[self.clients[node].scan_items(batch_size)
+                       for node in sorted(self.nodes)])
+
     def _by_node(self, keys):
         ret = {}
         for key in keys:
@@ -139,11 +742,122 @@ class RDBMultiClient(DictNature):
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.weights)
 
+class PipelinedConnection(object):
+    """A persistent connection to a server's records protocol
+       listener (see rdbtcp), which threads can share. Requests are sent
+       as soon as they're made, without waiting for the answers to
+       earlier ones, and whichever thread is reading answers hands them
+       out to their callers in order"""
+
+    def __init__(self, host, port, timeout = None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        # a reader that finds the connection broken takes the send
+        # lock to reset it, but a sender never waits for the receive
+        # lock while it holds the send lock
+        self.send_lock = RLock()
+        self.recv_lock = Lock()
+        self.waiting = deque() # calls waiting for answers, in order
+        self.sock = None
+        self.responses = None
+
+    def call(self, records):
+        """Send a list of (op, key, value) request records, and
+           return the list of response records that they get"""
+        call = _PendingCall(len(records))
+        with self.send_lock:
+            if self.sock is None:
+                self._connect()
+            sock = call.sock = self.sock
+            self.waiting.append(call)
+            try:
+                sock.sendall(''.join(pack_record(*record)
+                                     for record in records))
+            except Exception, e:
+                self._reset(sock, e)
+
+        with self.recv_lock:
+            while not call.done:
+                head = self.waiting[0]
+                try:
+                    head.responses.append(self.responses.next())
+                except StopIteration:
+                    self._reset(head.sock, IOError('connection closed'))
+                except Exception, e:
+                    self._reset(head.sock, e)
+                else:
+                    if len(head.responses) == head.count:
+                        self.waiting.popleft()
+                        head.done = True
+
+        if call.exc is not None:
+            raise call.exc
+        return call.responses
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.responses = read_records(sock.makefile('rb'))
+
+    def _reset(self, sock, exc):
+        """Fail every call still waiting on 'sock' with 'exc'. The next
+           call will open a new connection"""
+        with self.send_lock:
+            if sock is self.sock:
+                self.sock = None
+            for call in list(self.waiting):
+                if call.sock is sock:
+                    self.waiting.remove(call)
+                    call.exc = exc
+                    call.done = True
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def close(self):
+        if self.sock is not None:
+            self._reset(self.sock, IOError('connection closed'))
+
+
+class _PendingCall(object):
+    def __init__(self, count):
+        self.count = count
+        self.responses = []
+        self.sock = None
+        self.exc = None
+        self.done = count == 0
+
+
 class RDBClient(DictNature):
     """A non-thread-safe client for RDB. Use RDBMultiClient for
        thread-safety and multi-server hashing"""
 
-    def __init__(self, server):
+    # how bulk requests are sent: 'records' is the compact binary
+    # format, and 'json' is understood by older servers
+    bulk_format = 'records'
+
+    compress_min = 1024 # don't gzip request bodies smaller than this
+
+    # put_stream() stores values as raw, uncompressed envelopes, so
+    # that get_stream() can fetch any part of them
+    _stream_header = rdbcodec.MAGIC + rdbcodec.RawCodec.id + chr(0)
+
+    # bulk requests are sent in pieces no bigger than these, so that
+    # neither end has to hold a huge request (or its answer) at once
+    chunk_keys = 1000
+    chunk_bytes = 4 * 1024 * 1024
+
+    def __init__(self, server, encoder = None, tcp_port = None,
+                 compress = False):
+        """If the server has a records protocol listener on
+           'tcp_port', gets, puts, deletes, the atomic operations and
+           bulk requests without TTLs are pipelined over a connection
+           to it rather than sent over HTTP. With 'compress', HTTP
+           request bodies are gzipped and the server is asked to gzip
+           its responses, which trades CPU on both ends for bandwidth"""
         if ':' in server:
             server, port = server.split(':')
             port = int(port)
@@ -152,10 +866,31 @@ class RDBClient(DictNature):
 
         self.server = server
         self.port = port
+        self.encoder = encoder or rdbcodec.default_encoder
+        self.compress = compress
 
         self.http_pool = urllib3.HTTPConnectionPool(self.server, self.port)
+        self.pipeline = (PipelinedConnection(self.server, tcp_port)
+                         if tcp_port else None)
+
+    def get(self, key, default = NotFound, fields = None):
+        """With 'fields', a list of dotted paths (like 'address.city'),
+           only those fields of a JSON document are fetched, as a
+           document of their own. A list index in a path picks out
+           that item, and other paths into lists are into each of their
+           items. Only documents stored as JSON are projected"""
+        if fields:
+            # the records protocol listener doesn't do projections
+            return self._get_fields(key, default, fields)
+        if self.pipeline is not None:
+            (op, _key, value), = self._pipelined(
+                [('g', self.encode_key(key), '')])
+            if op == 'v':
+                return self.decode_value(value, from_json=False)
+            elif default is NotFound:
+                raise NotFound
+            return default
 
-    def get(self, key, default = NotFound):
         try:
             return self.decode_value(self.openurl('GET', key = key), from_json=False)
         except NotFound:
@@ -163,73 +898,564 @@ class RDBClient(DictNature):
                 raise
             else:
                 return default
-            
 
-    def put(self, key, value):
+    def _get_fields(self, key, default, fields):
+        try:
+            return self.decode_value(self.openurl('GET', key = key,
+                                                  args = {'field': fields}),
+                                     from_json=False)
+        except NotFound:
+            if default is NotFound:
+                raise
+            return default
+
+    def put(self, key, value, ttl = None):
+        """Store a value, which expires after 'ttl' seconds if it's
+           given"""
+        if self.pipeline is not None and ttl is None:
+            self._pipelined([('p', self.encode_key(key),
+                              self.encode_value(value))])
+            return
         self.openurl('PUT', key = key,
-                     postdata = self.encode_value(value, return_json = False))
+                     args = None if ttl is None else {'ttl': ttl},
+                     postdata = self.encode_value(value))
 
     def delete(self, key):
+        if self.pipeline is not None:
+            self._pipelined([('d', self.encode_key(key), '')])
+            return
         self.openurl('DELETE', key = key)
 
-    def get_multi(self, keys):
-        return self.bulk(get = keys)
+    def get_multi(self, keys, fields = None):
+        return self.bulk(get = keys, fields = fields)
+
+    def put_multi(self, keys, ttl = None):
+        return self.bulk(put = keys, ttl = ttl)
+
+    def gets(self, key, version = None):
+        """Returns a value along with its version, to pass to cas()
+           or back to gets(). If 'version' is given and it's still the
+           current one, the value isn't sent again, and NotModified is
+           returned in its place"""
+        if self.pipeline is not None:
+            (op, _key, value), = self._pipelined(
+                [('g', self.encode_key(key), version or '')])
+            if op == 'u':
+                return NotModified, version
+            elif op == 'f':
+                raise NotFound
+            return self.decode_value(value, from_json=False), version_of(value)
+
+        headers = {'If-None-Match': '"%s"' % version} if version else None
+        resp = self.openurl('GET', key = key, headers = headers,
+                            return_response = True)
+        if resp.status == 304:
+            return NotModified, version
+        return (self.decode_value(resp.data, from_json=False),
+                resp.getheader('ETag').strip('"'))
+
+    def gets_multi(self, keys):
+        """gets() for many keys at once. 'keys' maps keys to the
+           versions the caller already has (or None), and we return a
+           dictionary of the keys that were found to (value, version)
+           tuples, with a value of NotModified for the ones whose
+           versions were current"""
+        if not isinstance(keys, dict):
+            keys = dict.fromkeys(keys)
+        records = [('g', self.encode_key(key), version or '')
+                   for (key, version) in keys.iteritems()]
+        if self.pipeline is not None:
+            responses = self._pipelined(records)
+        else:
+            # only the records format can carry versions
+            assert self.bulk_format == 'records'
+            resp = self.openurl('POST', func='/_get_multi',
+                                postdata=''.join(pack_record(*record)
+                                                 for record in records),
+                                content_type=records_content_type,
+                                return_response=True)
+            responses = read_records(StringIO(resp.data))
+
+        ret = {}
+        for op, key, value in responses:
+            key = self.decode_key(key)
+            if op == 'v':
+                ret[key] = (self.decode_value(value, from_json=False),
+                            version_of(value))
+            elif op == 'u':
+                ret[key] = (NotModified, keys[key])
+        return ret
+
+    def incr(self, key, delta = 1, ttl = None):
+        """Atomically add 'delta' to an integer value (which is 0 if
+           it isn't there yet) and return the result"""
+        if self.pipeline is not None and ttl is None:
+            (op, _key, value), = self._pipelined(
+                [('i', self.encode_key(key), str(int(delta)))])
+            if op == 'x':
+                raise Conflict(value)
+            return self.decode_value(value, from_json=False)
+
+        args = {'delta': delta}
+        if ttl is not None:
+            args['ttl'] = ttl
+        return self.openurl('POST', func = self._func_url('_incr', key),
+                            args = args, return_json = True)
+
+    def append(self, key, item, ttl = None):
+        """Atomically append 'item' to a list, or concatenate it to a
+           string, returning the new version. A key that isn't there
+           yet becomes [item], unless item is a string. The item is
+           sent as JSON (or a raw string), since the server won't
+           decode it from anything else"""
+        return self._atomic('_append', key, item, ttl)
+
+    def cas(self, key, value, version, ttl = None):
+        """Store a value only if the stored one's version (from gets())
+           is 'version', or None to only store it if it isn't there at
+           all. Returns the new version or raises Conflict"""
+        return self._atomic('_cas', key, value, ttl, version or '')
+
+    def _atomic(self, op, key, value, ttl, version = None):
+        if op == '_append':
+            encoded = rdbcodec.document_encoder.encode(value)
+        else:
+            encoded = self.encode_value(value)
+        if self.pipeline is not None and ttl is None:
+            if op == '_cas':
+                record = ('c', self.encode_key(key),
+                          '%s\n%s' % (version, encoded))
+            else:
+                record = ('a', self.encode_key(key), encoded)
+            (op, _key, value), = self._pipelined([record])
+            if op == 'x':
+                raise Conflict(value)
+            return value
+
+        args = {}
+        if version is not None:
+            args['version'] = version
+        if ttl is not None:
+            args['ttl'] = ttl
+        resp = self.openurl('POST', func = self._func_url(op, key),
+                            args = args,
+                            postdata = encoded,
+                            content_type = 'application/octet-stream',
+                            return_response = True)
+        return resp.getheader('ETag').strip('"')
+
+    def _pipelined(self, records):
+        """Send request records over the records protocol, returning
+           the responses, or raising if any of them is an error"""
+        responses = self.pipeline.call(records)
+        for op, key, value in responses:
+            if op == 'e':
+                raise Exception("Error from %s:%s for %r: %s"
+                                % (self.server, self.pipeline.port,
+                                   key, value))
+            elif op == 'o':
+                raise Overloaded(int(value))
+        return responses
+
+    def put_stream(self, key, f, ttl = None):
+        """Store what's read from the file-like object 'f' as a byte
+           string, a part at a time so that neither end ever has all
+           of it, and return its version. The server has to have been
+           started with --large-values"""
+        url = self._func_url('_upload', key)
+        info = self.openurl('POST', func = url,
+                            args = None if ttl is None else {'ttl': ttl},
+                            return_json = True)
+        args = {'upload': info['upload']}
+        part_size = info['part_size']
+        try:
+            part = self._stream_header + self._read_part(
+                f, part_size - len(self._stream_header))
+            while True:
+                self.openurl('PUT', func = url, args = args,
+                             postdata = part)
+                if len(part) < part_size:
+                    break
+                part = self._read_part(f, part_size)
+                if not part:
+                    break
+            resp = self.openurl('POST', func = url, args = args,
+                                return_response = True)
+        except:
+            try:
+                self.openurl('DELETE', func = url, args = args)
+            except Exception:
+                pass
+            raise
+        return resp.getheader('ETag').strip('"')
+
+    @staticmethod
+    def _read_part(f, size):
+        """Read 'size' bytes from 'f', or less only at the end, which
+           f.read() alone doesn't promise for pipes and sockets"""
+        ret = []
+        while size:
+            data = f.read(size)
+            if not data:
+                break
+            ret.append(data)
+            size -= len(data)
+        return ''.join(ret)
+
+    def get_stream(self, key, start = 0, end = None, piece_size = 65536):
+        """Yields the bytes from 'start' up to 'end' (or the end) of
+           a value that was stored by put_stream(), as they arrive"""
+        if end is not None and end <= start:
+            return
+        # when we start from the beginning we get the header too, to
+        # check that it's something that put_stream() stored
+        first = 0 if start == 0 else len(self._stream_header) + start
+        last = ('' if end is None
+                else str(len(self._stream_header) + end - 1))
+        resp = self.openurl('GET', key = key,
+                            headers = {'Range': 'bytes=%d-%s'
+                                       % (first, last)},
+                            return_response = True, stream = True)
+        header = '' if start == 0 else None
+        try:
+            for piece in resp.stream(piece_size):
+                needed = len(self._stream_header) - len(header or '')
+                if header is not None and needed:
+                    header, piece = header + piece[:needed], piece[needed:]
+                    if not self._stream_header.startswith(header):
+                        raise ValueError('%r is not a raw byte string'
+                                         % key)
+                if piece:
+                    yield piece
+        finally:
+            resp.release_conn()
+
+    def backup(self, f, piece_size = 65536):
+        """Write a backup of the server's store (see /_backup) to the
+           file-like object 'f', for rdbserver --restore, returning how
+           many records it has. ValueError if it's cut short"""
+        resp = self.openurl('GET', func = '/_backup', return_response = True,
+                            stream = True)
+        records = 0
+        last = None
+        buf = ''
+        try:
+            for piece in resp.stream(piece_size):
+                f.write(piece)
+                # only to know that we got all of it
+                parsed, buf = split_records(buf + piece)
+                if parsed:
+                    records += len(parsed)
+                    last = parsed[-1][0]
+        finally:
+            resp.release_conn()
+        if buf or last != 'e':
+            raise ValueError('The backup was cut short')
+        return records
+
+    def query(self, index, value = _any, start = None, end = None,
+              values = False, limit = 1000, after = None):
+        """A page of the documents in one of the server's indexes
+           (see /_query) whose field is 'value', or from 'start' up to
+           but not including 'end'. Returns a list of their keys (or
+           with 'values', of (key, value) pairs), in the index's order,
+           and the cursor to pass as 'after' for the next page, which
+           is None after the last"""
+        args = {'limit': limit}
+        if value is not _any:
+            args['value'] = json.dumps(value)
+        if start is not None:
+            args['start'] = json.dumps(start)
+        if end is not None:
+            args['end'] = json.dumps(end)
+        if values:
+            args['values'] = 1
+        if after is not None:
+            args['after'] = after
+        resp = self.openurl('GET', func = '/_query/%s?%s'
+                            % (quote(index, safe = ''), urlencode(args)),
+                            return_response = True)
+        if values:
+            items = []
+            next = None
+            for key, val in self.read_items(resp, scan = True):
+                if key is None:
+                    next = val
+                else:
+                    items.append((key, val))
+            return items, next
+        if resp.getheader('Content-Type', '').startswith(
+            records_content_type):
+            keys = []
+            next = None
+            for op, key, val in read_records(StringIO(resp.data)):
+                if op == 'k':
+                    keys.append(self.decode_key(key))
+                elif op == 'n':
+                    next = key
+            return keys, next
+        ret = json.loads(resp.data)
+        return map(self.decode_key, ret['keys']), ret['next']
+
+    def query_iter(self, index, value = _any, start = None, end = None,
+                   values = False, page_size = 1000):
+        """Yields all of query()'s results (keys, or (key, value)
+           pairs) a page at a time"""
+        after = None
+        while True:
+            results, after = self.query(index, value, start, end,
+                                        values = values, limit = page_size,
+                                        after = after)
+            for result in results:
+                yield result
+            if after is None:
+                return
 
-    def put_multi(self, keys):
-        return self.bulk(put = keys)
+    def watch(self, since = None, feed = None, keys = (), prefixes = (),
+              wait = 30, limit = 1000):
+        """The puts and deletes of 'keys' and of keys that start with
+           any of 'prefixes' (or of every key, with neither) from the
+           server's change number 'since' on, waiting up to 'wait'
+           seconds for some. Returns a list of (seq, 'put' or
+           'delete', key), the id of the server's change feed and the
+           number to pass as 'since' next time, with the feed id as
+           'feed'. Without 'since', just finds out where the feed is up
+           to. Raises Gone if the changes are no longer there, or the
+           feed isn't the one with the id 'feed', when the caller can't
+           know what it's missed (see Watcher)"""
+        args = {'wait': wait, 'limit': limit}
+        if since is not None:
+            args['since'] = since
+        if feed is not None:
+            args['feed'] = feed
+        if keys:
+            args['key'] = [self.encode_key(key) for key in keys]
+        if prefixes:
+            args['prefix'] = [self.encode_key(prefix) for prefix in prefixes]
+        # POSTed, since the keys wouldn't all fit in a URL
+        resp = self.openurl('POST', func = '/_watch',
+                            postdata = urlencode(args, True),
+                            return_response = True, timeout = wait + 60)
+        changes = []
+        next = None
+        for op, key, value in read_records(StringIO(resp.data)):
+            if op == 'n':
+                next = int(key)
+            else:
+                changes.append((int(value), 'delete' if op == 'd' else 'put',
+                                self.decode_key(key)))
+        return changes, resp.getheader('X-Rdb-Feed'), next
+
+    def _func_url(self, func, key):
+        return '/%s/%s' % (func, quote(self.encode_key(key), safe=''))
 
     def delete_multi(self, keys):
         return self.bulk(delete = keys)
 
-    def bulk(self, get = [], put = {}, delete = []):
-        assert get or put or delete
-
-        postdata = {}
-
-        # To make the logs a little more readable, make the URLs more
-        # descriptive by changing func where appropriate. _get_multi,
-        # _put_multi, and _delete_multi are just aliases for _bulk,
-        # which ignores everything after the command in the URL, so we
-        # can put the keys there for humans to see
-        func = '_bulk'
-        if get:
-            postdata['get'] = {'keys': map(self.encode_key, get)}
-            if not put and not delete:
-                func = '_get_multi'
-        if put:
-            if not isinstance(put, dict):
-                put = dict(put)
-
-            put = dict((self.encode_key(key), self.encode_value(val))
-                       for (key, val) in put.iteritems())
-            postdata['put'] = put # already a dictionary
-
-            if not get and not delete:
-                func = '_put_multi'
-        if delete:
-            postdata['delete'] = {'keys': delete}
-            if not get and not put:
-                func = '_delete_multi'
-        keys_str = '+'.join(quote(x, safe='') for x in chain(get, put.keys(), delete))
-        func = '/%s/%s' % (func, keys_str)
-
-        # where key, value are just e.g. dict('get' -> jsondata)
-        postdata = dict((key, json.dumps(value))
-                        for (key, value)
-                        in postdata.iteritems())
-
-        ret = self.openurl('POST', func=func,
-                           postdata=postdata,
-                           return_json=True)
+    def ping(self, timeout = None):
+        "Raises an exception if the server isn't answering"
+        self.openurl('GET', func='/', timeout=timeout)
+
+    def stats(self, timeout = None):
+        return self.openurl('GET', func='/_stats', return_json=True,
+                            timeout=timeout)
+
+    def hot_keys(self, timeout = None):
+        """The keys that the server has seen the most reads and writes
+           of lately, as {'reads': {key: per second}, 'writes': ...}.
+           Empty if the server isn't keeping track"""
+        hot = self.stats(timeout).get('hot_keys', {})
+        # the server base64-encodes them (see HotKeyBackend)
+        return dict((kind, dict((self.decode_key(b64decode(key)), rate)
+                                for (key, rate) in hot.get(kind, [])))
+                    for kind in ('reads', 'writes'))
+
+    def bulk(self, get = [], put = {}, delete = [], incr = {}, append = {},
+             cas = {}, ttl = None, fields = None):
+        """Get, put and delete keys in one request, and apply atomic
+           operations: 'incr' maps keys to deltas, 'append' keys to
+           items, and 'cas' keys to (version, value) tuples. Any values
+           written expire after 'ttl' seconds if it's given. The new
+           values of incremented keys are returned with the ones that
+           were fetched, and Conflicts for the atomic operations that
+           failed are in the result's 'errors'. 'get' can also be a
+           dictionary of keys to the versions that the caller already
+           has, in which case the values that haven't changed are
+           returned as NotModified. With 'fields', only those fields of
+           the values that are fetched are returned (see get())"""
+        assert get or put or delete or incr or append or cas
+
+        ret = BulkResult()
+        for result in self._bulk_chunks(get, put, delete, incr, append,
+                                        cas, ttl, fields):
+            ret.merge(result)
+        return ret
+
+    def get_multi_iter(self, keys, fields = None):
+        """Like get_multi, but yields the (key, value) pairs a
+           request's worth at a time, as they arrive"""
+        for result in self._bulk_chunks(get = keys, fields = fields):
+            for item in result.iteritems():
+                yield item
+
+    def _bulk_chunks(self, get = [], put = {}, delete = [], incr = {},
+                     append = {}, cas = {}, ttl = None, fields = None):
+        """Send a bulk request as requests of no more than chunk_keys
+           keys and about chunk_bytes bytes, yielding each one's
+           BulkResult"""
+        if not isinstance(put, dict):
+            put = dict(put)
+
+        # the order only matters to the records protocol, which does
+        # them in the order they're sent. The values are only encoded
+        # as each chunk is sent, so they're never all in memory at once
+        records = chain(
+            (('g', self.encode_key(key),
+              (get[key] or '') if isinstance(get, dict) else '')
+             for key in get),
+            (('p', self.encode_key(key), self.encode_value(val))
+             for (key, val) in put.iteritems()),
+            (('i', self.encode_key(key), str(int(delta)))
+             for (key, delta) in incr.iteritems()),
+            (('a', self.encode_key(key),
+              rdbcodec.document_encoder.encode(item))
+             for (key, item) in append.iteritems()),
+            (('c', self.encode_key(key),
+              '%s\n%s' % (version or '', self.encode_value(val)))
+             for (key, (version, val)) in cas.iteritems()),
+            (('d', self.encode_key(key), '')
+             for key in delete))
+
+        if self.bulk_format != 'records':
+            # the JSON form is only for servers that predate the
+            # atomic operations
+            assert not (incr or append or cas)
+
+        for chunk in self._chunks(records):
+            if self.pipeline is not None and ttl is None and not fields:
+                yield self._bulk_result(self._record_items(
+                    self._pipelined(chunk)))
+            else:
+                yield self._bulk_result(self.read_items(
+                    self._post_bulk(chunk, ttl, fields)))
+
+    def _chunks(self, records):
+        """Split an iterable of request records into lists of no more
+           than chunk_keys records and, unless a single record is
+           bigger, chunk_bytes bytes"""
+        chunk, size = [], 0
+        for record in records:
+            record_size = record_header.size + len(record[1]) + len(record[2])
+            if chunk and (len(chunk) >= self.chunk_keys
+                          or size + record_size > self.chunk_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(record)
+            size += record_size
+        if chunk:
+            yield chunk
+
+    def _post_bulk(self, records, ttl, fields = None):
+        # To make the logs a little more readable, use the name of the
+        # operation when there's only one. _get_multi, _put_multi and
+        # _delete_multi are just aliases for _bulk. The keys used to
+        # go in the URL too, but with thousands of keys that made for
+        # URLs that were bigger than the bodies
+        ops = set(record[0] for record in records)
+        func = '/_bulk'
+        if ops == set('g'):
+            func = '/_get_multi'
+        elif ops == set('p'):
+            func = '/_put_multi'
+        elif ops == set('d'):
+            func = '/_delete_multi'
 
-        # the return data is a dict() containing any items requested
-        # to GET, and may be an empty dict. for the key, json should
-        # decode unicode keys for us
-        ret = dict((key, self.decode_value(val))
-                   for (key, val) in ret.iteritems())
+        if self.bulk_format == 'records':
+            postdata = ''.join(pack_record(*record) for record in records)
+            content_type = records_content_type
+        else:
+            postdata = {}
+            for op, name in (('g', 'get'), ('d', 'delete')):
+                keys = [key for (_op, key, value) in records if _op == op]
+                if keys:
+                    postdata[name] = {'keys': keys}
+            put = dict((key, rdbcodec.envelope_to_json(value))
+                       for (op, key, value) in records if op == 'p')
+            if put:
+                postdata['put'] = put
+
+            # where key, value are just e.g. dict('get' -> jsondata)
+            postdata = urlencode(dict((key, json.dumps(value))
+                                      for (key, value)
+                                      in postdata.iteritems()))
+            content_type = 'application/x-www-form-urlencoded'
+
+        args = {}
+        if ttl is not None:
+            args['ttl'] = ttl
+        if fields and 'g' in ops:
+            args['field'] = fields
+        return self.openurl('POST', func=func,
+                            args=args,
+                            postdata=postdata,
+                            content_type=content_type,
+                            return_response=True)
 
+    def _bulk_result(self, items):
+        ret = BulkResult()
+        for key, value in items:
+            if isinstance(value, Conflict):
+                ret.errors[key] = value
+            else:
+                ret[key] = value
         return ret
 
+    def read_items(self, resp, scan = False, ttls = None):
+        """Yields the (key, value) pairs in a response, in whichever
+           format the server chose to send them. If this is a page of
+           a scan, the key to continue from is yielded as (None, key),
+           and the TTLs that it has are put in the dictionary 'ttls'.
+           Atomic operations that failed are yielded with Conflicts as
+           their values, and values the client already has as
+           NotModified"""
+        if resp.getheader('Content-Type', '').startswith(
+            records_content_type):
+            for item in self._record_items(read_records(StringIO(resp.data)),
+                                           ttls):
+                yield item
+        else:
+            # json should decode unicode keys for us
+            ret = json.loads(resp.data)
+            if scan:
+                if ret['next'] is not None:
+                    yield None, self.decode_key(ret['next'])
+                if ttls is not None:
+                    ttls.update((self.decode_key(key), ttl)
+                                for (key, ttl)
+                                in ret.get('ttls', {}).iteritems())
+                ret = ret['items']
+            for key, val in ret.iteritems():
+                yield (self.decode_key(key),
+                       self.decode_value(val, from_json=True))
+
+    def _record_items(self, records, ttls = None):
+        for op, key, value in records:
+            if op == 'v':
+                yield (self.decode_key(key),
+                       self.decode_value(value, from_json=False))
+            elif op == 't':
+                ttl, value = value.split('\n', 1)
+                if ttls is not None:
+                    ttls[self.decode_key(key)] = int(ttl)
+                yield (self.decode_key(key),
+                       self.decode_value(value, from_json=False))
+            elif op == 'n':
+                yield None, self.decode_key(key)
+            elif op == 'x':
+                yield self.decode_key(key), Conflict(value)
+            elif op == 'u':
+                yield self.decode_key(key), NotModified
+
     def keys(self):
         ret = self.openurl('GET', func='/_all_keys',
                            return_json=True)
@@ -246,8 +1472,45 @@ class RDBClient(DictNature):
 
     iteritems = items
 
-    def openurl(self, method, key = None, func = None,
-                postdata = None, return_json=False):
+    def scan(self, start = None, limit = 1000, ttls = None):
+        """Fetch one page of the server's items following the key
+           'start', returning a dictionary of the items and the key
+           with which to fetch the next page (None at the end). If
+           'ttls' is a dictionary, the seconds left on the keys that
+           expire are put in it"""
+        args = {'limit': limit}
+        if start is not None:
+            args['start'] = self.encode_key(start)
+        if ttls is not None:
+            args['ttls'] = 1
+        resp = self.openurl('GET', func='/_scan?%s' % urlencode(args),
+                            return_response=True)
+        items = {}
+        next = None
+        for key, value in self.read_items(resp, scan = True, ttls = ttls):
+            if key is None:
+                next = value
+            else:
+                items[key] = value
+        return items, next
+
+    def scan_items(self, batch_size = 1000):
+        """Iterate over all of the server's items a page at a time,
+           so that the whole store never has to fit in memory"""
+        start = None
+        while True:
+            items, start = self.scan(start, limit = batch_size)
+            for item in items.iteritems():
+                yield item
+            if start is None:
+                return
+
+    def openurl(self, method, key = None, func = None, args = None,
+                postdata = None, return_json=False, timeout=None,
+                content_type=None, return_response=False,
+                headers=None, stream=False):
+        """With 'stream', the response is returned before its body
+           has been read, for the caller to read and release"""
         assert key or func and not (key and func)
 
         if key:
@@ -255,54 +1518,76 @@ class RDBClient(DictNature):
         else:
             assert isinstance(func, str)
             url = func
+        if args:
+            # lists are for arguments that are repeated
+            url = '%s?%s' % (url, urlencode(args, True))
 
         # if we have post-data, encode it as necessary
         if isinstance(postdata, dict):
             postdata = urlencode(postdata)
 
-        headers = {}
-        if method == 'POST':
+        # we can read records wherever the server is willing to send
+        # them
+        headers = dict(headers or {})
+        headers['Accept'] = '%s, application/json' % records_content_type
+        if content_type:
+            headers['Content-Type'] = content_type
+        elif method == 'POST':
             # encoded by our caller
             headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif method == 'PUT':
+            headers['Content-Type'] = 'application/octet-stream'
+        if self.compress:
+            # urllib3 decodes the response for us
+            headers['Accept-Encoding'] = 'gzip, deflate'
+            if postdata and len(postdata) >= self.compress_min:
+                c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                postdata = c.compress(postdata) + c.flush()
+                headers['Content-Encoding'] = 'gzip'
 
+        kw = {} if timeout is None else {'timeout': timeout}
+        if stream:
+            kw['preload_content'] = False
         resp = self.http_pool.urlopen(method, url,
                                       body = postdata or None,
-                                      headers = headers)
+                                      headers = headers, **kw)
         code = resp.status
         msg = resp.reason
 
         if code == 404 and key is not None:
             raise NotFound
 
-        if code != 200:
+        if code == 409:
+            raise Conflict(msg)
+
+        if code == 410:
+            raise Gone(msg)
+
+        if code == 503:
+            retry_after = resp.getheader('Retry-After')
+            raise Overloaded(int(retry_after) if retry_after else None)
+
+        # a 304 or 206 only comes back if our caller asked for one
+        if code != 200 and not (code in (206, 304) and return_response):
             raise Exception("Bad response: %s %s" % (code, msg))
 
+        if return_response:
+            return resp
+
         ret = resp.data
 
         return json.loads(ret) if return_json else ret
 
-    @classmethod
-    def encode_value(self, obj, return_json = True):
-        try:
-            ret = {'type': 'object', 'value': obj}
-            json.dumps(ret)
-        except TypeError:
-            ret = {'type': 'pickle', 'value': pickle.dumps(obj)}
-        return ret if return_json else json.dumps(ret, ensure_ascii=True)
+    def encode_value(self, obj):
+        return self.encoder.encode(obj)
 
     @classmethod
     def decode_value(cls, s, from_json = True):
-        if not from_json:
-            s = json.loads(s)
-
-        if s['type'] == 'object':
-            ret = s['value']
-        elif s['type'] == 'pickle':
-            ret = pickle.loads(str(s['value']))
-        else:
-            raise ValueError("Unknown return type %r" % s.get('type', None))
-
-        return ret
+        """Decode a stored value, or if from_json, a value that was
+           embedded in a JSON response"""
+        if from_json:
+            return rdbcodec.decode_json_envelope(s)
+        return rdbcodec.decode_value(s)
 
     @classmethod
     def encode_key(cls, key):
@@ -0,0 +1,206 @@
+"""Value codecs used by the client to turn objects into the strings
+   that are stored on the server and back.
+
+   A stored value is either a legacy JSON envelope
+   ('{"type": ..., "value": ...}') or a binary envelope: a NUL byte, a
+   byte naming the codec that produced the payload, a byte of flags,
+   and then the payload itself. Since the codec is stored with the
+   value, readers never have to guess how to decode it"""
+
+import zlib
+import marshal
+import cPickle as pickle
+import simplejson as json
+
+MAGIC = '\x00'
+HEADER_SIZE = 3
+
+# flags
+COMPRESSED = 0x01
+
+
+class Codec(object):
+    """Codecs raise TypeError or ValueError from encode() for objects
+       they can't represent, so that the next one can be tried"""
+    id = None
+    name = None
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, s):
+        raise NotImplementedError
+
+
+class RawCodec(Codec):
+    "byte strings, stored as they are"
+    id = 'r'
+    name = 'raw'
+
+    def encode(self, obj):
+        if not isinstance(obj, str):
+            raise TypeError(obj)
+        return obj
+
+    def decode(self, s):
+        return s
+
+
+class MarshalCodec(Codec):
+    """Python's builtin types. Much faster than pickle or json, but
+       only readable by the same version of Python"""
+    id = 'm'
+    name = 'marshal'
+
+    def encode(self, obj):
+        return marshal.dumps(obj, 2)
+
+    def decode(self, s):
+        return marshal.loads(s)
+
+
+class JSONCodec(Codec):
+    "readable by non-Python clients"
+    id = 'j'
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def decode(self, s):
+        return json.loads(s)
+
+
+class PickleCodec(Codec):
+    id = 'p'
+    name = 'pickle'
+
+    def encode(self, obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, s):
+        return pickle.loads(s)
+
+
+codecs_by_id = dict((codec.id, codec())
+                    for codec in (RawCodec, MarshalCodec,
+                                  JSONCodec, PickleCodec))
+codecs_by_name = dict((codec.name, codec)
+                      for codec in codecs_by_id.values())
+
+
+class ValueEncoder(object):
+    """Encodes values with the first of 'codecs' that can represent
+       them, compressing payloads of at least 'compress_threshold'
+       bytes (None to never compress) when that makes them smaller"""
+
+    def __init__(self, codecs = ('raw', 'marshal', 'pickle'),
+                 compress_threshold = 1024, compress_level = 6):
+        self.codecs = [codecs_by_name[name] for name in codecs]
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, obj):
+        for codec in self.codecs:
+            try:
+                payload = codec.encode(obj)
+                break
+            except (TypeError, ValueError):
+                pass
+        else:
+            raise TypeError("no codec can encode %r" % (obj,))
+
+        flags = 0
+        if (self.compress_threshold is not None
+            and len(payload) >= self.compress_threshold):
+            compressed = zlib.compress(payload, self.compress_level)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= COMPRESSED
+
+        return ''.join((MAGIC, codec.id, chr(flags), payload))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__,
+                           [codec.name for codec in self.codecs])
+
+
+default_encoder = ValueEncoder()
+
+# for values that the server looks inside of (see rdbops), which it
+# only decodes from JSON and raw strings
+document_encoder = ValueEncoder(codecs = ('raw', 'json'))
+
+
+def is_encoded(s):
+    "Whether a string is a binary envelope that we know how to read"
+    return (len(s) >= HEADER_SIZE and s[0] == MAGIC
+            and s[1] in codecs_by_id)
+
+
+def is_json_envelope(obj):
+    "Whether a value parsed from JSON is in the legacy JSON envelope"
+    return isinstance(obj, dict) and set(obj) == set(('type', 'value'))
+
+
+def reencode(s, obj):
+    """Encode obj the way that the stored value s was encoded (or with
+       the document encoder if s is None), for the server to replace a
+       value that it has modified. Values that are JSON stay JSON, in
+       the legacy envelope if they were in one, so that whoever wrote
+       them can still read them"""
+    if s is None:
+        return document_encoder.encode(obj)
+    if s.startswith(MAGIC):
+        return ValueEncoder(codecs = (codecs_by_id[s[1]].name,)).encode(obj)
+    if is_json_envelope(json.loads(s)):
+        return json.dumps({'type': 'object', 'value': obj})
+    return json.dumps(obj)
+
+
+def decode_value(s, codecs = None):
+    """Decode a stored value, whichever envelope it's in. The server
+       passes the ids of the 'codecs' that it's safe for it to decode
+       values from clients with, and gets a ValueError for the others
+       (like pickle, whose loads() runs whatever code the value says)"""
+    if not s.startswith(MAGIC):
+        return decode_json_envelope(json.loads(s), codecs)
+
+    if codecs is not None and s[1] not in codecs:
+        raise ValueError('Not decoding a %r value' % s[1])
+    codec = codecs_by_id[s[1]]
+    flags = ord(s[2])
+    payload = s[HEADER_SIZE:]
+    if flags & COMPRESSED:
+        payload = zlib.decompress(payload)
+    return codec.decode(payload)
+
+
+def decode_json_envelope(obj, codecs = None):
+    """Decode a value from the form that envelope_to_json puts it in
+       to embed it in JSON. 'codecs' is as for decode_value()"""
+    if obj['type'] == 'object':
+        return obj['value']
+    elif obj['type'] == 'pickle':
+        if codecs is not None and PickleCodec.id not in codecs:
+            raise ValueError('Not decoding a pickle')
+        return pickle.loads(str(obj['value']))
+    elif obj['type'] == 'encoded':
+        return decode_value(obj['value'].decode('base64'), codecs)
+    raise ValueError("Unknown return type %r" % obj.get('type', None))
+
+
+def envelope_to_json(s):
+    """Convert a stored value to something that can be embedded in a
+       JSON document: legacy envelopes are JSON already, and binary
+       ones are base64-encoded in an envelope of their own"""
+    if s.startswith(MAGIC):
+        return {'type': 'encoded', 'value': s.encode('base64')}
+    return json.loads(s)
+
+
+def envelope_from_json(obj):
+    "The inverse of envelope_to_json"
+    if isinstance(obj, dict) and obj.get('type') == 'encoded':
+        return obj['value'].decode('base64')
+    return json.dumps(obj)
@@ -2,20 +2,26 @@
 
 import os
 import sys
+import time
 import os.path
 import simplejson as json
+from Queue import Queue
+from threading import Lock, Thread
 from optparse import OptionParser
 
+import rdbcodec
 from rdbclient import client_from_spec
+from rdbutil import pack_record, read_records
 
 
 class RDBCommand(object):
     requires_keys = True
 
-    def __init__(self, server, json_output, newlines = True):
+    def __init__(self, server, json_output, newlines = True, options = None):
         self.rdb = client_from_spec(server)
         self.json_output = json_output
         self.newlines = newlines
+        self.options = options
 
     def cmd_error(self, s):
         sys.stderr.write(s)
@@ -23,6 +29,39 @@ class RDBCommand(object):
         sys.exit(1)
 
 
+class Progress(object):
+    """A thread-safe counter that reports how far along we are and
+       our throughput to stderr every 'interval' seconds"""
+
+    def __init__(self, verb, interval = 5.0, quiet = False):
+        self.verb = verb
+        self.interval = interval
+        self.quiet = quiet
+        self.count = 0
+        self.start = self.last_report = time.time()
+        self.lock = Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.count += n
+            now = time.time()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                self.report(now)
+
+    def report(self, now = None):
+        if self.quiet:
+            return
+        elapsed = (now or time.time()) - self.start
+        sys.stderr.write('%s %d records in %.1fs (%.0f/s)\n'
+                         % (self.verb, self.count, elapsed,
+                            self.count / elapsed if elapsed else 0))
+
+    def done(self):
+        with self.lock:
+            self.report()
+
+
 class RDBls(RDBCommand):
     requires_keys = False
 
@@ -80,6 +119,294 @@ class RDBput(RDBCommand):
             self.cmd_error("can only PUT one key at a time")
 
 
+class RDBload(RDBCommand):
+    """Stream records from a file or stdin into the cluster, in
+       put_multi batches spread across parallel workers. Only a
+       bounded number of batches are held in memory at once"""
+    requires_keys = False
+
+    def run(self, keys):
+        if keys:
+            self.cmd_error("rdbload reads its keys from its input")
+
+        infile = sys.stdin
+        if self.options.file and self.options.file != '-':
+            infile = open(self.options.file, 'rb')
+
+        progress = Progress('loaded', quiet = self.options.quiet)
+        batches = Queue(self.options.parallel * 2)
+        errors = []
+
+        def worker():
+            while True:
+                batch = batches.get()
+                try:
+                    if batch is None:
+                        return
+                    if not errors:
+                        self.rdb.put_multi(batch)
+                        progress.add(len(batch))
+                except Exception, e:
+                    errors.append(e)
+                finally:
+                    batches.task_done()
+
+        workers = [Thread(target = worker)
+                   for x in xrange(self.options.parallel)]
+        for thread in workers:
+            thread.setDaemon(True)
+            thread.start()
+
+        batch = {}
+        for key, value in self.read_input(infile):
+            batch[key] = value
+            if len(batch) >= self.options.batch_size:
+                batches.put(batch)
+                batch = {}
+            if errors:
+                break
+        if batch and not errors:
+            batches.put(batch)
+
+        for thread in workers:
+            batches.put(None)
+        for thread in workers:
+            thread.join()
+
+        progress.done()
+        if errors:
+            self.cmd_error("load failed: %s" % errors[0])
+
+    def read_input(self, infile):
+        """Yields (key, value) pairs from the input, in either of the
+           formats that rdbdump writes"""
+        if self.options.format == 'binary':
+            for op, key, value in read_records(infile):
+                if op != 'p':
+                    raise ValueError("unknown record type %r" % op)
+                yield key, rdbcodec.decode_value(value)
+        else:
+            for line in infile:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                key = record['key']
+                if isinstance(key, unicode):
+                    key = key.encode('utf-8')
+                if 'encoded' in record:
+                    yield key, rdbcodec.decode_json_envelope(
+                        record['encoded'])
+                else:
+                    yield key, record['value']
+
+
+class RDBdump(RDBCommand):
+    """Stream every item in the cluster to a file or stdout, scanning
+       all of the nodes in parallel a page at a time"""
+    requires_keys = False
+
+    def run(self, keys):
+        if keys:
+            self.cmd_error("rdbdump always dumps every key")
+
+        outfile = sys.stdout
+        if self.options.file and self.options.file != '-':
+            outfile = open(self.options.file, 'wb')
+
+        progress = Progress('dumped', quiet = self.options.quiet)
+        pages = Queue(self.options.parallel * 2)
+        errors = []
+
+        def scanner(client):
+            try:
+                start = None
+                while not errors:
+                    items, start = client.scan(start,
+                                               limit = self.options.batch_size)
+                    pages.put(items)
+                    if start is None:
+                        break
+            except Exception, e:
+                errors.append(e)
+            finally:
+                pages.put(None)
+
+        # a node's scan is sequential, so our parallelism is the
+        # number of nodes
+        scanners = [Thread(target = scanner, args = (client,))
+                    for client in self.rdb.clients.values()]
+        for thread in scanners:
+            thread.setDaemon(True)
+            thread.start()
+
+        running = len(scanners)
+        while running:
+            items = pages.get()
+            if items is None:
+                running -= 1
+                continue
+            for key, value in items.iteritems():
+                outfile.write(self.format_record(key, value))
+            progress.add(len(items))
+
+        outfile.flush()
+        progress.done()
+        if errors:
+            self.cmd_error("dump failed: %s" % errors[0])
+
+    def format_record(self, key, value):
+        if self.options.format == 'binary':
+            return pack_record('p', key,
+                               rdbcodec.default_encoder.encode(value))
+
+        try:
+            return json.dumps({'key': key, 'value': value}) + '\n'
+        except (TypeError, ValueError):
+            # not representable as plain JSON, so keep it in the
+            # envelope that the client stores it in
+            encoded = rdbcodec.default_encoder.encode(value)
+            return json.dumps({'key': key,
+                               'encoded': rdbcodec.envelope_to_json(encoded)}
+                              ) + '\n'
+
+
+class RateLimiter(object):
+    """Blocks callers so that no more than 'rate' records per second
+       get through, across all threads. A rate of 0 means no limit"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_time = time.time()
+        self.lock = Lock()
+
+    def wait(self, n):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + float(n) / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class RDBrebalance(RDBCommand):
+    """Copy keys to the nodes that the new spec (--server) puts them
+       on, with their --replicas, scanning every node in the old spec
+       (--old-server). A key is only copied to a node that doesn't
+       have it yet, so that a value written under the new spec since
+       isn't overwritten, and it keeps its TTL. Our place in each
+       node's scan is saved to --state-file after every page, so an
+       interrupted rebalance can be restarted where it left off"""
+    requires_keys = False
+
+    def run(self, keys):
+        if keys:
+            self.cmd_error("rdbrebalance works on every key")
+        if not self.options.old_server:
+            self.cmd_error("the old spec must be given with --old-server")
+
+        self.rdb = client_from_spec(self.options.server,
+                                    replicas = self.options.replicas)
+        self.old = client_from_spec(self.options.old_server,
+                                    replicas = self.options.replicas)
+        self.limiter = RateLimiter(self.options.rate)
+        self.state_lock = Lock()
+        self.state = self.load_state()
+
+        progress = Progress('moved', quiet = self.options.quiet)
+        errors = []
+
+        def rebalancer(node):
+            try:
+                self.rebalance_node(node, progress, errors)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [Thread(target = rebalancer, args = (node,))
+                   for node in self.old.nodes]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        progress.done()
+        if errors:
+            self.cmd_error("rebalance failed (restart to resume): %s"
+                           % errors[0])
+
+    def rebalance_node(self, node, progress, errors):
+        client = self.old.clients[node]
+        with self.state_lock:
+            state = self.state.setdefault(node, {'start': None,
+                                                 'done': False,
+                                                 'stale': []})
+
+        while not state['done'] and not errors:
+            ttls = {}
+            items, next = client.scan(state['start'],
+                                      limit = self.options.batch_size,
+                                      ttls = ttls)
+            copies = {} # (node, ttl) -> {key: value}
+            leaving = [] # keys that don't belong here any more
+            for key, value in items.iteritems():
+                # all of them, even ones the client has ejected, which
+                # it would leave out
+                owners = self.rdb.hasher.nodes_for(key, self.rdb.replicas)
+                for owner in owners:
+                    if owner != node:
+                        copies.setdefault((owner, ttls.get(key)),
+                                          {})[key] = value
+                if node not in owners:
+                    leaving.append(key)
+
+            copied = 0
+            for (owner, ttl), values in copies.iteritems():
+                self.limiter.wait(len(values))
+                # a cas with no version only stores keys that aren't
+                # there, and fails with a Conflict for the ones that are
+                result = self.rdb.clients[owner].bulk(
+                    cas = dict((key, (None, value))
+                               for (key, value) in values.iteritems()),
+                    ttl = ttl)
+                copied += len(values) - len(result.errors)
+
+            deferred = []
+            stale = state['stale']
+            if self.options.delete and leaving:
+                # the key that we'll resume the scan from has to stay
+                # on the source until we've saved our place past it
+                deferred = [key for key in leaving if key == next]
+                client.delete_multi([key for key in leaving if key != next])
+
+            with self.state_lock:
+                state.update(start = next, done = next is None,
+                             stale = deferred + stale)
+                self.save_state()
+            if stale:
+                client.delete_multi(stale)
+            state['stale'] = deferred
+
+            progress.add(copied)
+
+    def load_state(self):
+        if (self.options.state_file
+            and os.path.exists(self.options.state_file)):
+            with open(self.options.state_file) as f:
+                return json.load(f)
+        return {}
+
+    def save_state(self):
+        "Atomically replace the state file with our current state"
+        if not self.options.state_file:
+            return
+        tmpname = self.options.state_file + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmpname, self.options.state_file)
+
+
 class RDBrm(RDBCommand):
 
     def run(self, keys):
@@ -87,6 +414,67 @@ class RDBrm(RDBCommand):
             self.rdb.delete(key)
 
 
+class RDBbench(RDBCommand):
+    """Writes 'records' generated records and reads them back in
+       batches, with HTTP compression off and then on, to show what
+       compression costs in CPU and saves in bytes"""
+    requires_keys = False
+
+    def run(self, keys):
+        count = self.options.records
+        batch_size = self.options.batch_size
+        keys = ['rdbbench-%d' % i for i in xrange(count)]
+        for i in xrange(0, count, batch_size):
+            self.rdb.put_multi(dict((key, self._value(key))
+                                    for key in keys[i:i + batch_size]))
+
+        runs = []
+        for compress in (False, True):
+            rdb = client_from_spec(self.options.server, compress = compress)
+            before = self._compression(rdb)
+            started, cpu_started = time.time(), sum(os.times()[:2])
+            for i in xrange(0, count, batch_size):
+                rdb.get_multi(keys[i:i + batch_size])
+            wall = time.time() - started
+            cpu = sum(os.times()[:2]) - cpu_started
+            after = self._compression(rdb)
+            runs.append((compress, wall, cpu,
+                         dict((name, after[name] - before[name])
+                              for name in after)))
+
+        # the uncompressed run sent what the compressed one started with
+        uncompressed = runs[1][3]['bytes_in']
+        print '%-5s %8s %12s %12s %12s %12s' % (
+            '', 'wall', 'client cpu', 'server cpu', 'bytes', 'bytes/s')
+        for compress, wall, cpu, compression in runs:
+            sent = compression['bytes_out'] if compress else uncompressed
+            print '%-5s %7.2fs %11.2fs %11.2fs %12d %12.0f' % (
+                'gzip' if compress else 'none', wall, cpu,
+                compression['seconds'], sent, sent / wall)
+
+        self.rdb.delete_multi(keys)
+
+    @staticmethod
+    def _value(key):
+        # something like a typical JSON document, with some repetition
+        return {'id': key,
+                'name': 'Record %s' % key,
+                'tags': ['bench', 'generated', key[-1]],
+                'counts': dict(('c%d' % i, i * len(key)) for i in xrange(10)),
+                'text': ' '.join(['lorem ipsum dolor sit amet'] * 4)}
+
+    @staticmethod
+    def _compression(rdb):
+        """The servers' compression stats, summed. Servers without
+           compression turned on count as sending nothing compressed"""
+        ret = {'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+        for client in rdb.clients.itervalues():
+            stats = client.stats().get('http_compression', {})
+            for name in ret:
+                ret[name] += stats.get(name, 0)
+        return ret
+
+
 class rdbtestobject(object):
     "Just a picklable object to be used by the RDBtest command"
 
@@ -194,6 +582,78 @@ if __name__=='__main__':
                       help='''don't print a newline when print multiple
                               non-JSON values''',
                       default=True)
+    parser.add_option('-f', '--file',
+                      dest='file',
+                      help='''file for rdbload to read from or for rdbdump
+                              to write to (default: stdin/stdout)''',
+                      metavar='FILE',
+                      default=None)
+    parser.add_option('-F', '--format',
+                      dest='format',
+                      help='''record format for rdbload and rdbdump, "ndjson"
+                              or "binary"''',
+                      type='choice',
+                      choices=['ndjson', 'binary'],
+                      metavar='FORMAT',
+                      default='ndjson')
+    parser.add_option('-b', '--batch-size',
+                      dest='batch_size',
+                      help='number of records per bulk request',
+                      type='int',
+                      metavar='N',
+                      default=500)
+    parser.add_option('-P', '--parallel',
+                      dest='parallel',
+                      help='number of bulk requests to run at once',
+                      type='int',
+                      metavar='N',
+                      default=8)
+    parser.add_option('-o', '--old-server',
+                      dest='old_server',
+                      help='''for rdbrebalance, the spec that the cluster's
+                              keys were placed with. --server is the new
+                              spec that they'll be moved to''',
+                      metavar='SERVER',
+                      default=None)
+    parser.add_option('--replicas',
+                      dest='replicas',
+                      help='''for rdbrebalance, how many nodes each key is
+                              kept on (default: %default)''',
+                      type='int',
+                      metavar='N',
+                      default=1)
+    parser.add_option('-d', '--delete',
+                      action='store_true',
+                      dest='delete',
+                      help='''for rdbrebalance, delete keys from the nodes
+                              that the new spec doesn't put them on once
+                              they've been copied''',
+                      default=False)
+    parser.add_option('-R', '--rate',
+                      dest='rate',
+                      help='''for rdbrebalance, the most records per second
+                              to move (default: unlimited)''',
+                      type='int',
+                      metavar='N',
+                      default=0)
+    parser.add_option('-S', '--state-file',
+                      dest='state_file',
+                      help='''for rdbrebalance, where to save our progress
+                              so that an interrupted run can be resumed''',
+                      metavar='FILE',
+                      default=None)
+    parser.add_option('-N', '--records',
+                      dest='records',
+                      help='''for rdbbench, the number of records to write
+                              and read back''',
+                      type='int',
+                      metavar='N',
+                      default=10000)
+    parser.add_option('-q', '--quiet',
+                      action='store_true',
+                      dest='quiet',
+                      help="don't report progress on stderr",
+                      default=False)
 
     options, keys = parser.parse_args()
 
@@ -204,6 +664,10 @@ if __name__=='__main__':
             'rdbrm': RDBrm,
             'rdbput': RDBput,
             'rdbcat': RDBcat,
+            'rdbload': RDBload,
+            'rdbdump': RDBdump,
+            'rdbrebalance': RDBrebalance,
+            'rdbbench': RDBbench,
             'rdbtest': RDBtest}
     myname = os.path.basename(sys.argv[0])
     if myname.endswith('.py'):
@@ -212,7 +676,8 @@ if __name__=='__main__':
         parser.error('unknown operation %r' % myname)
 
     cls = clss[myname]
-    command = cls(options.server, options.json, newlines = options.newlines)
+    command = cls(options.server, options.json, newlines = options.newlines,
+                  options = options)
 
     if not keys and command.requires_keys:
         parser.error('no keys specified')
@@ -0,0 +1,193 @@
+"""The operations on stored values that the server's listeners share,
+   independent of the protocol that asked for them"""
+
+import simplejson as json
+
+import rdbcodec
+from rdbutil import Conflict, version_of
+
+
+class BadValue(ValueError):
+    "A value that clients wouldn't be able to read back"
+    pass
+
+
+def check_value(value):
+    "Refuse values that aren't in an envelope that clients can read"
+    if not rdbcodec.is_encoded(value):
+        try:
+            json.loads(value) # this will throw an exception if it's
+                              # not valid JSON data
+        except:
+            raise BadValue('Not valid JSON')
+
+
+# the codecs of the values that the server looks inside of, which
+# clients can send it anything in: unpickling runs code, and marshal's
+# loader isn't safe on bad input
+document_codecs = (rdbcodec.JSONCodec.id, rdbcodec.RawCodec.id)
+
+
+def document(value):
+    """The object that a stored value holds, or None if it isn't one
+       that we can read. Documents have to be in JSON envelopes, or in
+       binary ones from the json codec"""
+    try:
+        if rdbcodec.is_encoded(value):
+            return rdbcodec.decode_value(value, document_codecs)
+        obj = json.loads(value)
+    except Exception:
+        return None
+    if rdbcodec.is_json_envelope(obj):
+        # the legacy client's JSON envelope, which only holds a
+        # document if it isn't a pickle
+        return obj['value'] if obj['type'] == 'object' else None
+    return obj
+
+
+def lookup(obj, path):
+    """The field of a document at 'path', a list of dictionary keys
+       and list indexes (as strings), or None if it doesn't have one"""
+    for part in path:
+        if isinstance(obj, dict):
+            obj = obj.get(part)
+        elif isinstance(obj, list) and part.isdigit():
+            index = int(part)
+            obj = obj[index] if index < len(obj) else None
+        else:
+            return None
+    return obj
+
+
+def split_path(path):
+    "A dotted JSON path (like 'address.lines.0') as a list"
+    return path.split('.')
+
+
+_missing = object()
+
+
+def _project_field(obj, rests):
+    if not all(rests):
+        # the whole field, whatever else was asked for in it
+        return obj
+    return _project(obj, rests)
+
+
+def _project(obj, paths):
+    if isinstance(obj, list):
+        # indexes pick out items, as in lookup(), and other paths are
+        # into each of the items (that were picked out)
+        indexed, each = {}, []
+        for path in paths:
+            if path[0].isdigit():
+                indexed.setdefault(int(path[0]), []).append(path[1:])
+            else:
+                each.append(path)
+        if indexed:
+            items = [_project_field(obj[index], rests + each)
+                     for (index, rests) in sorted(indexed.iteritems())
+                     if index < len(obj)]
+        else:
+            items = [_project(item, each) for item in obj]
+        return [item for item in items if item is not _missing]
+    if not isinstance(obj, dict):
+        return _missing
+    wanted = {}
+    for path in paths:
+        wanted.setdefault(path[0], []).append(path[1:])
+    ret = {}
+    for part, rests in wanted.iteritems():
+        if part in obj:
+            field = _project_field(obj[part], rests)
+            if field is not _missing:
+                ret[part] = field
+    return ret
+
+
+def project(value, paths):
+    """A stored value with only the fields of the document at 'paths'
+       (lists of parts, as from split_path()), in the same envelope.
+       Fields that the document doesn't have are left out. A list
+       index in a path picks out that item, as in lookup(), and other
+       paths into lists are applied to each of their items. Values
+       that aren't JSON documents (see document()) are returned
+       whole"""
+    doc = document(value)
+    if not isinstance(doc, (dict, list)):
+        return value
+    return rdbcodec.reencode(value, _project(doc, paths))
+
+
+def _decode_stored(value):
+    """The object in a stored value for incr or append to change, which
+       has to be JSON (in any envelope) or a raw string"""
+    try:
+        if not rdbcodec.is_encoded(value):
+            obj = json.loads(value)
+            if not rdbcodec.is_json_envelope(obj):
+                return obj
+        return rdbcodec.decode_value(value, document_codecs)
+    except ValueError, e:
+        # like a pickle, which we won't run the code in
+        raise Conflict(str(e))
+
+
+def _reencode(value, obj):
+    "rdbcodec.reencode(), raising Conflict if obj doesn't fit"
+    try:
+        return rdbcodec.reencode(value, obj)
+    except (TypeError, ValueError), e:
+        # like bytes that aren't UTF-8 going into a JSON list
+        raise Conflict(str(e))
+
+
+def atomic_op(op, arg):
+    """Returns the function that backend.update() should apply for one
+       of the atomic operations: 'incr' (by the integer 'arg'),
+       'append' (the encoded value 'arg') or 'cas' (a tuple of the
+       expected version, '' for not-found, and the new value). The
+       values that incr and append change, and append's item, have
+       to be JSON or raw strings (see document_codecs), and they stay
+       in the envelope that they were in, with new ones in
+       rdbcodec.document_encoder's"""
+    if op == 'incr':
+        def incr(value):
+            n = 0 if value is None else _decode_stored(value)
+            if isinstance(n, bool) or not isinstance(n, (int, long)):
+                raise Conflict('not an integer')
+            return _reencode(value, n + arg)
+        return incr
+
+    elif op == 'append':
+        check_value(arg)
+        try:
+            item = _decode_stored(arg)
+        except Conflict, e:
+            raise BadValue(str(e))
+        def append(value):
+            """Lists get the item appended to them, and strings get it
+               concatenated. A new key starts a new list, unless the
+               item is a string"""
+            if value is None:
+                return (arg if isinstance(item, basestring)
+                        else _reencode(None, [item]))
+            old = _decode_stored(value)
+            if isinstance(old, list):
+                return _reencode(value, old + [item])
+            elif (isinstance(old, basestring)
+                  and isinstance(item, basestring)):
+                return _reencode(value, old + item)
+            raise Conflict("can't append to %s" % type(old).__name__)
+        return append
+
+    elif op == 'cas':
+        version, new = arg
+        check_value(new)
+        def cas(value):
+            if (version_of(value) if value is not None else '') != version:
+                raise Conflict('version mismatch')
+            return new
+        return cas
+
+    raise ValueError(op)
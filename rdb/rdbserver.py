@@ -1,35 +1,311 @@
 #!/usr/bin/env python
 
 import re
+import cgi
 import sys
+import time
 import logging
 import simplejson as json
+from cStringIO import StringIO
+from collections import OrderedDict
 from optparse import OptionParser
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
 
+import rdbops
+import rdbcodec
+import httpcompress
+from rdbtcp import RecordServer
+from admission import AdmissionControl, HIGH, NORMAL, LOW
 from backends import backends
-from rdbutil import NotFound
+from backends.compressedbackend import CompressedBackend
+from backends.timedbackend import TimedBackend
+from backends.loggedbackend import LoggedBackend
+from backends.hotkeybackend import HotKeyBackend
+from backends.chunkedbackend import ChunkedBackend, MANIFEST_TAG
+from backends.chunkedbackend import CHUNK_PREFIX
+from backends.indexedbackend import IndexedBackend, IndexNotReady
+from monitor import RequestMonitor
+from writelog import WriteLog
+from changefeed import ChangeFeed
+from replication import Replicator
+from rdbutil import NotFound, Conflict, Gone, pack_record, read_records
+from rdbutil import version_of
+from rdbutil import records_content_type
 
 
 class Config(object):
+    tick_interval = 0.1 # seconds between calls to backend.tick()
 
-    def __init__(self, backend = None, port = None):
+    # decompressed request bodies can't be bigger than tornado would
+    # have let the compressed ones be
+    max_body = 100 * 1024 * 1024
+
+    def __init__(self, backend = None, port = None, tcp_port = None,
+                 reap_interval = None, reap_batch = 1000,
+                 admission = None, monitor = None, write_log = None,
+                 replicator = None, http_compress_threshold = None,
+                 http_compress_level = 1, replicated_backend = None,
+                 processes = 1, restore = None, indexes = None,
+                 change_feed = None):
         self.backend = backend
+        # what replicas copy in a snapshot: the backend without the
+        # wrappers that change how values look (like ChunkedBackend)
+        self.replicated_backend = replicated_backend or backend
         self.port = port
+        self.tcp_port = tcp_port
+        self.admission = admission
+        self.monitor = monitor
+        self.write_log = write_log
+        self.replicator = replicator # if we're a replica
+        self.http_compress_threshold = http_compress_threshold
+        self.http_compress_level = http_compress_level
+        self.http_compression = httpcompress.CompressionStats()
+        self.reap_interval = reap_interval
+        self.reap_batch = reap_batch
+        self.processes = processes
+        self.restore = restore # a backup to restore before starting
+        self.indexes = indexes # the IndexedBackend, if there are any
+        self.change_feed = change_feed # for /_watch, if there's one
 
 
 class RDBRequestHandler(tornado.web.RequestHandler):
+    priority = NORMAL # which requests to refuse first when we're too
+                      # busy. None for never
+    monitored = True # whether to time requests, to log slow ones
+    key_count = None # how many keys the request was for, if known
+    send_poll = 0.01 # the most seconds between looks at whether a
+                     # piece of a streamed response has gone
+
+    _started = None
+    _timing = None
+    _bytes_flushed = 0
 
     @property
     def _backend(self):
         return self.application.settings['config'].backend
 
+    @property
+    def _admission(self):
+        return self.application.settings['config'].admission
+
+    @property
+    def _monitor(self):
+        return self.application.settings['config'].monitor
+
+    @property
+    def _write_log(self):
+        return self.application.settings['config'].write_log
+
+    @property
+    def _endpoint(self):
+        "What the slow request log calls this request, without the key"
+        return '%s /%s' % (self.request.method,
+                           self.request.path.split('/')[1])
+
+    def prepare(self):
+        if self._admission is not None:
+            if not self._admission.admit(self.priority):
+                self.set_status(503)
+                self.set_header('Retry-After', self._admission.retry_after)
+                self.finish()
+                return
+            self._started = time.time()
+        if self.monitored and self._monitor is not None:
+            self._timing = self._monitor.begin()
+        if self.request.headers.get('Content-Encoding'):
+            self._decompress_body()
+
+    def _decompress_body(self):
+        """Replace a compressed request body with what it decompresses
+           to, and read the arguments from it again if it's a form"""
+        coding = self.request.headers['Content-Encoding'].strip().lower()
+        if coding == 'identity':
+            return
+        try:
+            self.request.body = httpcompress.decompress(
+                self.request.body, coding,
+                self.application.settings['config'].max_body)
+        except ValueError, e:
+            raise tornado.web.HTTPError(400, str(e))
+
+        # tornado has already tried to parse the compressed body as a
+        # form, so start again from the query string
+        arguments = cgi.parse_qs(self.request.query)
+        if self.request.headers.get('Content-Type', '').startswith(
+            'application/x-www-form-urlencoded'):
+            for name, values in cgi.parse_qs(self.request.body).iteritems():
+                arguments.setdefault(name, []).extend(values)
+        self.request.arguments = dict(
+            (name, [v for v in values if v])
+            for (name, values) in arguments.iteritems()
+            if any(values))
+
+    def flush(self, include_footers = False):
+        self._bytes_flushed += sum(len(part) for part in self._write_buffer)
+        tornado.web.RequestHandler.flush(self, include_footers)
+
+    def finish(self, chunk = None):
+        tornado.web.RequestHandler.finish(self, chunk)
+        if self._started is not None:
+            self._admission.done(time.time() - self._started)
+        if self._timing is not None:
+            self._monitor.end(self._timing, self._endpoint, self.key_count,
+                              len(self.request.body or ''),
+                              self._bytes_flushed)
+
+    def _waiting(self):
+        """Call before an asynchronous handler waits for something, so
+           that the time it spends waiting isn't taken for time spent
+           handling requests"""
+        if self._started is not None:
+            self._admission.done(time.time() - self._started)
+            self._started = None
+
+    def _send(self, piece):
+        """Write a piece of a streamed response, and call the
+           handler's _send_next() once it's gone"""
+        self.write(piece)
+        self.flush()
+        self._when_sent()
+
+    def _when_sent(self, looks = 0):
+        """Call _send_next() once what's been flushed has gone, so that
+           we never read more of the response than the client is ready
+           for. tornado's flush() can't tell us when that is, and the
+           stream only tells whoever wrote to it (its write('',
+           callback) spins on a buffer with only '' left), so look"""
+        stream = self.request.connection.stream
+        io_loop = tornado.ioloop.IOLoop.instance()
+        if stream.closed():
+            return
+        if not stream.writing():
+            io_loop.add_callback(self._send_next)
+        elif looks < 2:
+            # the IOLoop polls, and the stream writes, between one round
+            # of callbacks and the next, which is often all it takes
+            io_loop.add_callback(lambda: self._when_sent(looks + 1))
+        else:
+            # then less and less often, for slow clients
+            delay = min(0.001 * 2 ** (looks - 2), self.send_poll)
+            io_loop.add_timeout(time.time() + delay,
+                                lambda: self._when_sent(min(looks + 1, 16)))
+
+    def _check_writable(self):
+        if self.application.settings['config'].replicator is not None:
+            raise tornado.web.HTTPError(403, 'Read-only replica')
+
+    def _accepts_records(self):
+        return records_content_type in self.request.headers.get('Accept', '')
+
+    def _sent_records(self):
+        return self.request.headers.get('Content-Type', '').startswith(
+            records_content_type)
+
+    def _check_value(self, value):
+        try:
+            rdbops.check_value(value)
+        except rdbops.BadValue, e:
+            raise tornado.web.HTTPError(406, str(e))
+
+    def _limit(self):
+        "The number in the 'limit' argument, of items to page through"
+        try:
+            limit = int(self.get_argument('limit', 1000))
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            raise tornado.web.HTTPError(400, 'Bad limit')
+        return limit
+
+    def _ttl(self):
+        "The number of seconds in the 'ttl' argument, if there is one"
+        ttl = self.get_argument('ttl', None)
+        if ttl is None:
+            return None
+        try:
+            ttl = int(ttl)
+        except ValueError:
+            ttl = 0
+        if ttl <= 0:
+            raise tornado.web.HTTPError(400, 'Bad ttl')
+        if not self._backend.supports_ttl:
+            raise tornado.web.HTTPError(501)
+        return ttl
+
+    def _fields(self):
+        """The paths of the fields that the client asked for with
+           'field' arguments, or None for whole values"""
+        fields = self.get_arguments('field')
+        if not fields:
+            return None
+        return [rdbops.split_path(field) for field in fields]
+
+    def _atomic_op(self, op, arg):
+        try:
+            return rdbops.atomic_op(op, arg)
+        except rdbops.BadValue, e:
+            # like an item to append that's a pickle
+            raise tornado.web.HTTPError(400, str(e))
+
+    def _range(self, size):
+        """The (start, end) of the bytes that the client asked for in
+           a Range header, or None for all of them. Clients that ask
+           for more than one range get all of them"""
+        header = self.request.headers.get('Range', '')
+        if not header.startswith('bytes=') or ',' in header:
+            return None
+        first, _, last = header[len('bytes='):].strip().partition('-')
+        try:
+            if not first:
+                # the last 'last' bytes
+                return max(0, size - int(last)), size
+            return int(first), min(size, int(last) + 1 if last else size)
+        except ValueError:
+            return None
+
+    def _not_modified(self, version):
+        "Whether the client's If-None-Match says it has this version"
+        inm = self.request.headers.get('If-None-Match', '')
+        return inm.strip() == '*' or ('"%s"' % version) in inm
+
+    def write_items(self, items, scan = False, next = None,
+                    conflicts = {}, unchanged = (), ttls = {}):
+        """Write out a dictionary of stored values as records if the
+           client can read them, otherwise as a JSON dict. For a page
+           of a scan, 'next' is the key to continue from, and 'ttls'
+           the seconds left on the keys that expire. 'conflicts' are
+           the messages for atomic operations that failed, and
+           'unchanged' the keys whose values the client already has,
+           which only the records format can carry"""
+        if self._accepts_records():
+            self.set_header('Content-Type', records_content_type)
+            self.write(''.join(
+                pack_record('t', key, '%d\n%s' % (ttls[key], value))
+                if key in ttls else pack_record('v', key, value)
+                for (key, value) in items.iteritems()))
+            self.write(''.join(pack_record('x', key, message)
+                               for (key, message) in conflicts.iteritems()))
+            self.write(''.join(pack_record('u', key, '')
+                               for key in unchanged))
+            if next is not None:
+                self.write(pack_record('n', next, ''))
+        else:
+            self.set_header('Content-Type', 'application/json')
+            items = dict((key, rdbcodec.envelope_to_json(value))
+                         for (key, value) in items.iteritems())
+            if scan:
+                items = {'items': items, 'next': next}
+                if ttls:
+                    items['ttls'] = ttls
+            self.write(json.dumps(items))
+
 
 class MainHandler(RDBRequestHandler):
     "/"
+    priority = None
 
     def get(self):
         resp = '''
@@ -68,78 +344,322 @@ class MainHandler(RDBRequestHandler):
 
 class DataHandler(RDBRequestHandler):
     '/data/.*'
+    priority = HIGH
+    key_count = 1
 
+    @tornado.web.asynchronous
     def get(self, key):
+        fields = self._fields()
+        if fields is not None:
+            self._get_fields(key, fields)
+            return
+        try:
+            reader = self._backend.get_reader(key)
+        except NotFound:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Etag', '"%s"' % reader.version)
+        if self._not_modified(reader.version):
+            self.set_status(304)
+            self.finish()
+            return
+        self.set_header('Content-Type', 'application/octet-stream'
+                        if reader.encoded
+                        else 'application/json')
+        self.set_header('Accept-Ranges', 'bytes')
+
+        byte_range = self._range(reader.size)
+        start, end = byte_range or (0, reader.size)
+        if byte_range is not None:
+            if start >= end:
+                self.set_status(416)
+                self.set_header('Content-Range', 'bytes */%d' % reader.size)
+                self.finish()
+                return
+            self.set_status(206)
+            self.set_header('Content-Range', 'bytes %d-%d/%d'
+                            % (start, end - 1, reader.size))
+        self.set_header('Content-Length', end - start)
+
+        self._pieces = reader.read(start, end)
         try:
-            self.write(self._backend[key])
+            piece = next(self._pieces, '')
         except NotFound:
             raise tornado.web.HTTPError(404)
+        if len(piece) == end - start:
+            self.finish(piece)
+            return
+        # the rest goes out a piece at a time, as the client takes it
+        self._waiting()
+        self._send(piece)
+
+    def _get_fields(self, key, fields):
+        """Just the fields at some paths into the document. Its ETag
+           is the whole value's, which they only change with"""
+        value = self._backend.get(key, None)
+        if value is None:
+            raise tornado.web.HTTPError(404)
+        version = version_of(value)
+        self.set_header('Etag', '"%s"' % version)
+        if self._not_modified(version):
+            self.set_status(304)
+            self.finish()
+            return
+        value = rdbops.project(value, fields)
+        self.set_header('Content-Type', 'application/octet-stream'
+                        if rdbcodec.is_encoded(value)
+                        else 'application/json')
+        self.finish(value)
+
+    def _send_next(self):
+        if self.request.connection.stream.closed():
+            return
+        try:
+            piece = next(self._pieces, None)
+        except NotFound:
+            # the value was replaced or expired while we were sending
+            # it, and it's too late to say so
+            logging.warning('%s went away while it was being sent',
+                            self.request.path)
+            self.request.connection.stream.close()
+            return
+        if piece is None:
+            self.finish()
+        else:
+            self._send(piece)
 
     def put(self, key):
+        self._check_writable()
         value = self.request.body
-        try:
-            json.loads(value) # this will throw an exception if it's not
-                              # valid JSON data
-        except:
-            raise tornado.web.HTTPError(406, 'Not valid JSON')
-        self._backend[key] = value
+        self._check_value(value)
+        self._backend.put(key, value, self._ttl())
 
     # some day this should support a mime multipart decode for
     # form-based upload
     #def post(self, key):
     #    pass
     def delete(self, key):
+        self._check_writable()
         del self._backend[key]
 
 
+class UploadHandler(RDBRequestHandler):
+    """/_upload/KEY?upload=ID
+
+       Store a big value a part at a time. POST without an upload
+       (and with a ttl if the value should expire) to start, which
+       returns the 'upload' id and the 'part_size' that every part but
+       the last has to be as JSON. PUT the parts in order, then POST
+       to store the value, whose version is returned in the ETag.
+       DELETE gives up. 404 for uploads that the server doesn't know
+       about, and 501 unless it's storing big values in chunks (see
+       --large-values)"""
+    key_count = 1
+
+    def post(self, key):
+        self._check_uploads()
+        upload = self.get_argument('upload', None)
+        if upload is None:
+            upload, part_size = self._backend.begin_upload(key, self._ttl())
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps({'upload': upload,
+                                   'part_size': part_size}))
+            return
+        try:
+            version = self._backend.commit_upload(upload)
+        except NotFound:
+            raise tornado.web.HTTPError(404)
+        except ValueError, e:
+            raise tornado.web.HTTPError(400, str(e))
+        self.set_header('Etag', '"%s"' % version)
+
+    def put(self, key):
+        self._check_uploads()
+        try:
+            self._backend.upload_part(self.get_argument('upload'),
+                                      self.request.body)
+        except NotFound:
+            raise tornado.web.HTTPError(404)
+        except rdbops.BadValue, e:
+            raise tornado.web.HTTPError(406, str(e))
+        except ValueError, e:
+            raise tornado.web.HTTPError(400, str(e))
+
+    def delete(self, key):
+        self._check_uploads()
+        self._backend.abort_upload(self.get_argument('upload'))
+
+    def _check_uploads(self):
+        self._check_writable()
+        if not self._backend.supports_uploads:
+            raise tornado.web.HTTPError(501)
+
+
+class AtomicHandler(RDBRequestHandler):
+    """/_incr/KEY?delta=N, /_append/KEY, /_cas/KEY?version=V
+
+       Modify a value in place on the server. _append and _cas take
+       the encoded value in the body. The new value's version is
+       returned in the ETag header, and _incr also returns the new
+       number as JSON. 409 if the operation doesn't apply, and 400 if
+       the value sent isn't JSON or a raw string (see rdbops)"""
+    priority = HIGH
+    key_count = 1
+
+    def post(self, op, key):
+        self._check_writable()
+        if op == '_incr':
+            try:
+                arg = int(self.get_argument('delta', 1))
+            except ValueError:
+                raise tornado.web.HTTPError(400, 'Bad delta')
+        elif op == '_append':
+            arg = self.request.body
+        elif op == '_cas':
+            arg = (self.get_argument('version', ''), self.request.body)
+
+        try:
+            if op == '_incr':
+                value = self._backend.incr(key, arg, self._ttl())
+            else:
+                value = self._backend.update(key,
+                                             self._atomic_op(op[1:], arg),
+                                             self._ttl())
+        except Conflict, e:
+            raise tornado.web.HTTPError(409, str(e))
+
+        self.set_header('Etag', '"%s"' % version_of(value))
+        if op == '_incr':
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps(rdbops.document(value)))
+
+
 class BulkHandler(RDBRequestHandler):
 
     def post(self, _op, _keysstr):
         # we actually ignore the operation and use the same handler
         # for all bulk operations. Yes, that means you can pass put=
         # to _delete_multi if you *really* wanted
+        # atomic operations and known versions are only in the
+        # records format
+        atomic, known = [], {}
+        if self._sent_records():
+            get, put, delete, atomic, known = self._read_records()
+        else:
+            get, put, delete = self._read_form()
+        self.key_count = len(get) + len(put) + len(delete) + len(atomic)
+        if put or delete or atomic:
+            self._check_writable()
+
+        ttl = self._ttl()
+
         ret = {}
+        unchanged = []
+        if get:
+            ret = self._backend.get_multi(get)
+            for key, version in known.iteritems():
+                if key in ret and version_of(ret[key]) == version:
+                    # the client has this one already
+                    del ret[key]
+                    unchanged.append(key)
+            fields = self._fields()
+            if fields is not None:
+                for key, value in ret.iteritems():
+                    ret[key] = rdbops.project(value, fields)
+
+        if put:
+            self._backend.put_multi(put, ttl)
+
+        conflicts = {}
+        for op, key, arg in atomic:
+            # incr's arg is the delta, and the others' the function
+            # for update()
+            try:
+                if op == 'incr':
+                    ret[key] = self._backend.incr(key, arg, ttl)
+                else:
+                    self._backend.update(key, arg, ttl)
+            except Conflict, e:
+                conflicts[key] = str(e)
+
+        if delete:
+            self._backend.delete_multi(delete)
+
+        self.write_items(ret, conflicts = conflicts, unchanged = unchanged)
 
+    def _read_records(self):
+        get, put, delete, atomic, known = [], {}, [], [], {}
+        for op, key, value in read_records(StringIO(self.request.body)):
+            if op == 'g':
+                # the value is the version that the client already
+                # has, if any
+                get.append(key)
+                if value:
+                    known[key] = value
+            elif op == 'p':
+                self._check_value(value)
+                put[key] = value
+            elif op == 'd':
+                delete.append(key)
+            elif op == 'i':
+                try:
+                    delta = int(value)
+                except ValueError:
+                    raise tornado.web.HTTPError(400, 'Bad delta')
+                atomic.append(('incr', key, delta))
+            elif op == 'a':
+                atomic.append(('append', key,
+                               self._atomic_op('append', value)))
+            elif op == 'c':
+                if '\n' not in value:
+                    raise tornado.web.HTTPError(400, 'Bad cas record')
+                atomic.append(('cas', key, self._atomic_op(
+                    'cas', tuple(value.split('\n', 1)))))
+            else:
+                raise tornado.web.HTTPError(400, 'Unknown op %r' % op)
+        return get, put, delete, atomic, known
+
+    def _read_form(self):
         get = self.get_argument('get', None)
-        if get:
-            keys = json.loads(get)['keys']
-            ret = self._backend.get_multi(keys)
-            ret = dict((key, json.loads(value))
-                       for (key, value) in ret.iteritems())
+        get = json.loads(get)['keys'] if get else []
 
         put = self.get_argument('put', None)
-        if put:
-            values = json.loads(put)
-            values = dict((key, json.dumps(val))
-                          for (key, val)
-                          in values.iteritems())
-            self._backend.put_multi(values)
+        put = dict((key, rdbcodec.envelope_from_json(val))
+                   for (key, val)
+                   in json.loads(put).iteritems()) if put else {}
 
         delete = self.get_argument('delete', None)
-        if delete:
-            keys = json.loads(delete)['keys']
-            for key in keys:
-                self._backend.delete(key)
+        delete = json.loads(delete)['keys'] if delete else []
 
-        self.write(json.dumps(ret))
+        return get, put, delete
 
 
 class IteratorHandler(RDBRequestHandler):
     '/_all_keys, /_all_data'
+    priority = LOW
+
+    flush_size = 64 * 1024 # send the response a piece this big at a
+                           # time, rather than all at the end
 
     def get(self, op):
         if not self._backend.supports_iteration:
-            raise HTTPError(501)
+            raise tornado.web.HTTPError(501)
 
         if op == '_all_data':
-            ret = self._yield_json_dict((key, json.loads(value))
+            ret = self._yield_json_dict((key,
+                                         rdbcodec.envelope_to_json(value))
                                         for key, value
                                         in self._backend.items())
         elif op == '_all_keys':
             ret = self._yield_json_list(self._backend.keys())
 
+        self.set_header('Content-Type', 'application/json')
+        pending = 0
         for s in ret:
             self.write(s)
+            pending += len(s)
+            if pending >= self.flush_size:
+                self.flush()
+                pending = 0
 
     def _yield_json_list(self, l):
         """Utility function to yield an arbitrarily long JSON list"""
@@ -170,25 +690,477 @@ class IteratorHandler(RDBRequestHandler):
         yield '}'
 
 
+class ScanHandler(RDBRequestHandler):
+    """/_scan?start=KEY&limit=N&ttls=1
+
+       With ttls=1, the keys that expire come with the seconds they
+       have left"""
+    priority = LOW
+
+    def get(self):
+        if not self._backend.supports_iteration:
+            raise tornado.web.HTTPError(501)
+
+        start = self.get_argument('start', None)
+        limit = self._limit()
+        items, next = self._backend.scan(start = start, limit = limit)
+        ttls = {}
+        if self.get_argument('ttls', None):
+            for key, value in items:
+                ttl = self._backend.ttl(key)
+                if ttl is not None:
+                    # it may have expired since the scan read it
+                    ttls[key] = max(1, ttl)
+
+        self.key_count = len(items)
+        self.write_items(dict(items), scan = True, next = next, ttls = ttls)
+
+
 class StatsHandler(RDBRequestHandler):
     '/_stats'
+    priority = None
+
+    def get(self):
+        stats = dict(self._backend.stats())
+        if self._admission is not None:
+            stats['admission'] = self._admission.stats()
+        if self._monitor is not None:
+            stats['requests'] = self._monitor.stats()
+        if self._write_log is not None:
+            stats['write_log'] = self._write_log.stats()
+        config = self.application.settings['config']
+        if config.change_feed is not None:
+            stats['change_feed'] = config.change_feed.stats()
+        if config.http_compress_threshold:
+            stats['http_compression'] = config.http_compression.stats()
+        replicator = self.application.settings['config'].replicator
+        if replicator is not None:
+            stats['replication'] = replicator.stats()
+        self.write(json.dumps(stats))
+
 
+class ReplicationLogHandler(RDBRequestHandler):
+    """/_replicate/log?since=SEQ&log=ID&limit=N&wait=SECONDS
+
+       Entries from the write log as records, starting with entry
+       SEQ, followed by an n record with the sequence number to ask
+       for next. If there are none yet, waits up to SECONDS for some.
+       Without 'since', just the n record for where the log is up to.
+       410 if the entries are no longer in the log, or if the log
+       isn't the one with the id ID"""
+    monitored = False # the waiting would make them all look slow
+
+    max_wait = 60
+
+    @tornado.web.asynchronous
     def get(self):
-        self.write(json.dumps(self._backend.stats()))
+        if self._write_log is None:
+            raise tornado.web.HTTPError(501)
+        try:
+            since = self.get_argument('since', None)
+            self.since = int(since) if since is not None else None
+            self.limit = int(self.get_argument('limit', 1000))
+            wait = min(float(self.get_argument('wait', 0)), self.max_wait)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        log_id = self.get_argument('log', None)
+        if log_id is not None and log_id != self._write_log.log_id:
+            raise tornado.web.HTTPError(410, 'Not the same log')
+
+        entries = self._entries()
+        if entries or not wait:
+            self._respond(entries)
+            return
+
+        self._waiting()
+        self._timeout = self._io_loop.add_timeout(time.time() + wait,
+                                                  self._timed_out)
+        self._write_log.wait(self._appended)
+
+    @property
+    def _io_loop(self):
+        return tornado.ioloop.IOLoop.instance()
+
+    def _entries(self):
+        if self.since is None:
+            return []
+        try:
+            return self._write_log.read_from(self.since, self.limit)
+        except Gone, e:
+            raise tornado.web.HTTPError(410, str(e))
+
+    def _appended(self):
+        # this is called in the middle of whichever request did the
+        # write, so answer once it's done
+        self._io_loop.remove_timeout(self._timeout)
+        self._io_loop.add_callback(self._wake)
+
+    def _timed_out(self):
+        self._write_log.unwait(self._appended)
+        self._wake()
+
+    def _wake(self):
+        if self.request.connection.stream.closed():
+            return
+        try:
+            entries = self._entries()
+        except tornado.web.HTTPError, e:
+            self.send_error(e.status_code)
+            return
+        self._respond(entries)
+
+    def _respond(self, entries):
+        log = self._write_log
+        next_seq = entries[-1][0] + 1 if entries else (
+            log.next_seq if self.since is None else self.since)
+        self.set_header('Content-Type', records_content_type)
+        self.set_header('X-Rdb-Log', log.log_id)
+        self.set_header('X-Rdb-Last-Seq', log.next_seq - 1)
+        if entries:
+            self.set_header('X-Rdb-Time', repr(entries[-1][1]))
+        self.write(''.join(pack_record(op, key, value)
+                           for (seq, written, op, key, value) in entries))
+        self.write(pack_record('n', str(next_seq), ''))
+        self.finish()
+
+
+class WatchHandler(RDBRequestHandler):
+    """/_watch?since=SEQ&feed=ID&key=KEY&prefix=PREFIX&wait=SECONDS&limit=N
+
+       The puts and deletes of the key KEY and of the keys that start
+       with PREFIX (both of which can be given any number of times, and
+       with neither it's every key) from change SEQ on, as p and d
+       records of the keys with their sequence numbers as values,
+       followed by an n record with the sequence number to ask for
+       next, or as JSON. If there are none yet, waits up to SECONDS for
+       some. Without 'since', just where the feed is up to.
+
+       410 if the changes are no longer in the feed, or if it isn't
+       the one with the id ID, when the client can't know what it's
+       missed and has to drop whatever it has cached. Long lists of
+       keys can be POSTed as a form instead"""
+    monitored = False # the waiting would make them all look slow
+
+    max_wait = 60
+    max_limit = 1000
+
+    _timeout = None
+    _answered = False
+
+    @property
+    def _feed(self):
+        return self.application.settings['config'].change_feed
+
+    @tornado.web.asynchronous
+    def get(self):
+        if self._feed is None:
+            raise tornado.web.HTTPError(501)
+        try:
+            since = self.get_argument('since', None)
+            self.since = int(since) if since is not None else None
+            self.limit = min(int(self.get_argument('limit', 1000)),
+                             self.max_limit)
+            wait = min(float(self.get_argument('wait', 0)), self.max_wait)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        feed_id = self.get_argument('feed', None)
+        if feed_id is not None and feed_id != self._feed.feed_id:
+            raise tornado.web.HTTPError(410, 'Not the same feed')
+        # as they were sent, since keys are bytes
+        self.keys = set(self.request.arguments.get('key', []))
+        self.prefixes = tuple(self.request.arguments.get('prefix', []))
+
+        changes = self._changes()
+        if changes or not wait or self.since is None:
+            self._respond(changes)
+            return
+
+        self._waiting()
+        self._timeout = self._io_loop.add_timeout(time.time() + wait,
+                                                  self._timed_out)
+        self._feed.wait(self._appended)
+
+    post = get
+
+    @property
+    def _io_loop(self):
+        return tornado.ioloop.IOLoop.instance()
+
+    def _match(self, key):
+        if key.startswith(CHUNK_PREFIX):
+            # a part of a large value, which clients never see
+            return False
+        if not self.keys and not self.prefixes:
+            return True
+        return key in self.keys or key.startswith(self.prefixes)
+
+    def _changes(self):
+        "The changes that we have for the client, moving 'since' past them"
+        if self.since is None:
+            return []
+        try:
+            changes, self.since = self._feed.read_from(self.since,
+                                                       self._match,
+                                                       self.limit)
+        except Gone, e:
+            raise tornado.web.HTTPError(410, str(e))
+        return changes
+
+    def _appended(self):
+        # this is called in the middle of whichever request did the
+        # write, so look once it's done
+        self._io_loop.add_callback(self._wake)
+
+    def _timed_out(self):
+        self._timeout = None
+        self._feed.unwait(self._appended)
+        self._wake()
+
+    def _wake(self):
+        if self._answered or self.request.connection.stream.closed():
+            return
+        try:
+            changes = self._changes()
+        except tornado.web.HTTPError, e:
+            self._stop_waiting()
+            self.send_error(e.status_code)
+            return
+        if changes or self._timeout is None:
+            self._stop_waiting()
+            self._respond(changes)
+        else:
+            # none of them were for this client
+            self._feed.wait(self._appended)
+
+    def _stop_waiting(self):
+        self._answered = True
+        self._feed.unwait(self._appended)
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def on_connection_close(self):
+        # so that clients that go away don't leave anything behind
+        self._stop_waiting()
+
+    def _respond(self, changes):
+        feed = self._feed
+        next_seq = feed.next_seq if self.since is None else self.since
+        self.set_header('X-Rdb-Feed', feed.feed_id)
+        self.set_header('X-Rdb-Last-Seq', feed.next_seq - 1)
+        if self._accepts_records():
+            self.set_header('Content-Type', records_content_type)
+            self.write(''.join(pack_record(op, key, str(seq))
+                               for (seq, op, key) in changes))
+            self.write(pack_record('n', str(next_seq), ''))
+        else:
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps({
+                'feed': feed.feed_id,
+                'changes': [{'seq': seq,
+                             'op': 'delete' if op == 'd' else 'put',
+                             'key': key}
+                            for (seq, op, key) in changes],
+                'next': next_seq}))
+        self.finish()
+
+
+class SnapshotHandler(RDBRequestHandler):
+    """/_replicate/snapshot?start=KEY&limit=N
+
+       A page of everything in the backend for a replica to copy, as
+       the records that the write log would have for them, followed by
+       an n record with the key to continue from if there's more"""
+    priority = LOW
+
+    def get(self):
+        backend = self.application.settings['config'].replicated_backend
+        if not backend.supports_iteration:
+            raise tornado.web.HTTPError(501)
+
+        start = self.get_argument('start', None)
+        limit = self._limit()
+        items, next = backend.scan(start = start, limit = limit)
+        self.key_count = len(items)
+
+        self.set_header('Content-Type', records_content_type)
+        for key, value in items:
+            ttl = backend.ttl(key)
+            self.write(pack_record(*LoggedBackend._put_entry(key, value,
+                                                             ttl)))
+        if next is not None:
+            self.write(pack_record('n', next, ''))
+
+
+class QueryHandler(RDBRequestHandler):
+    """/_query/INDEX?value=JSON or ?start=JSON&end=JSON, and
+       &limit=N&after=CURSOR&values=1
+
+       The keys (or with values=1, the items) of the documents whose
+       field in the index is 'value', or from 'start' up to but not
+       including 'end', in the index's order, a page at a time. Each
+       page ends with the cursor to get the next one with as 'after'.
+       503 while the index is being built"""
+    priority = LOW
+
+    def get(self, name):
+        indexes = self.application.settings['config'].indexes
+        if indexes is None or name not in indexes.indexes:
+            raise tornado.web.HTTPError(404, 'No such index')
+        args = {}
+        try:
+            for arg, param in (('value', 'equals'), ('start', 'start'),
+                               ('end', 'end')):
+                value = self.get_argument(arg, None)
+                if value is not None:
+                    args[param] = json.loads(value)
+            limit = int(self.get_argument('limit', 1000))
+            after = self.get_argument('after', None)
+            if after:
+                args['after'] = str(after).decode('hex')
+        except (ValueError, TypeError):
+            raise tornado.web.HTTPError(400)
+
+        try:
+            items, next = indexes.query(name, limit = limit, **args)
+        except ValueError, e:
+            raise tornado.web.HTTPError(400, str(e))
+        except IndexNotReady:
+            raise tornado.web.HTTPError(503, 'The index is being built')
+        if next is not None:
+            next = next.encode('hex')
+        self.key_count = len(items)
+
+        if self.get_argument('values', None):
+            # in the index's order, for clients that read records
+            values = OrderedDict()
+            for key, value in items:
+                if value.startswith(MANIFEST_TAG):
+                    # one that's stored in chunks
+                    value = self._backend.get(key, None)
+                if value is not None:
+                    values[key] = value
+            self.write_items(values, scan = True, next = next)
+        elif self._accepts_records():
+            self.set_header('Content-Type', records_content_type)
+            self.write(''.join(pack_record('k', key, '')
+                               for (key, value) in items))
+            if next is not None:
+                self.write(pack_record('n', next, ''))
+        else:
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps({'keys': [key for (key, value) in items],
+                                   'next': next}))
+
+
+class BackupHandler(RDBRequestHandler):
+    """/_backup
+
+       A consistent backup of the store, for rdbserver --restore. It's
+       sent a page at a time as the client takes it, with other
+       requests (writes too) handled in between, and it's of the store
+       as it is when the backup finishes"""
+    priority = LOW
+    monitored = False # it's as slow as the client is
+
+    _backup = None
+
+    @tornado.web.asynchronous
+    def get(self):
+        if not self._backend.supports_backup:
+            raise tornado.web.HTTPError(501)
+        if self.application.settings['config'].processes != 1:
+            # the spool would only have this process's writes
+            raise tornado.web.HTTPError(501, "Can't back up with "
+                                        '--processes')
+        self._backup = self._backend.begin_backup()
+        self.set_header('Content-Type', records_content_type)
+        self._waiting()
+        self._send_next()
+
+    def _send_next(self):
+        if self.request.connection.stream.closed():
+            return
+        piece = self._backup.read()
+        if piece:
+            self._send(piece)
+        else:
+            self.finish()
+
+    def on_connection_close(self):
+        if self._backup is not None:
+            self._backup.close()
+
+
+class ProfileHandler(RDBRequestHandler):
+    """/_profile?seconds=N&requests=N&sample=FRACTION
+
+       Profile a sample of the requests that arrive in the next N
+       seconds, or the next N sampled requests, and return the top of
+       the profile as text. 409 if a profile is already being taken"""
+    priority = None
+    monitored = False
+
+    max_seconds = 300
+
+    @tornado.web.asynchronous
+    def get(self):
+        try:
+            seconds = self.get_argument('seconds', None)
+            seconds = float(seconds) if seconds is not None else None
+            requests = self.get_argument('requests', None)
+            requests = int(requests) if requests is not None else None
+            sample = float(self.get_argument('sample', 1.0))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if not 0 < sample <= 1:
+            raise tornado.web.HTTPError(400, 'Bad sample')
+        if seconds is None and requests is None:
+            seconds = 10
+        seconds = min(seconds or self.max_seconds, self.max_seconds)
+
+        if not self._monitor.profile(self._report, seconds, requests,
+                                     sample):
+            raise tornado.web.HTTPError(409, 'Already profiling')
+        self._waiting()
+
+    def _report(self, report):
+        if self.request.connection.stream.closed():
+            return
+        self.set_header('Content-Type', 'text/plain')
+        self.finish(report)
 
 
 class RDBServerApplication(tornado.web.Application):
     maps = [
         (r'/', MainHandler),
         (r'/data/(.*)', DataHandler),
+        (r'/_upload/(.*)', UploadHandler),
         (r'/(_bulk|_get_multi|_put_multi|_delete_multi)(/?.*|$)', BulkHandler),
+        (r'/(_incr|_append|_cas)/(.*)', AtomicHandler),
         (r'/(_all_data|_all_keys)', IteratorHandler),
+        (r'/_scan', ScanHandler),
         (r'/_stats', StatsHandler),
+        (r'/_profile', ProfileHandler),
+        (r'/_backup', BackupHandler),
+        (r'/_query/([^/]+)', QueryHandler),
+        (r'/_watch', WatchHandler),
+        (r'/_replicate/log', ReplicationLogHandler),
+        (r'/_replicate/snapshot', SnapshotHandler),
         ]
 
     def __init__(self, config):
         self.rdb_config = config
-        tornado.web.Application.__init__(self, self.maps, config = config)
+        transforms = [tornado.web.ChunkedTransferEncoding]
+        if config.http_compress_threshold:
+            def compress(request):
+                return httpcompress.CompressTransform(
+                    request, config.http_compress_threshold,
+                    config.http_compress_level, config.http_compression)
+            transforms.insert(0, compress)
+        tornado.web.Application.__init__(self, self.maps,
+                                         transforms = transforms,
+                                         config = config)
 
 
 def args_to_config(sysargs):
@@ -198,6 +1170,142 @@ def args_to_config(sysargs):
                       help='which TCP port to listen on',
                       metavar='PORT',
                       type='int', default=6552)
+    parser.add_option('--processes', dest='processes',
+                      help='''serve HTTP from this many processes, which
+                              each open the backend for themselves, so
+                              it has to be one that they can all write
+                              to at once (memcache, or bdb and
+                              cachechain without --bloom-capacity). 0
+                              for one for each CPU
+                              (default: %default)''',
+                      metavar='N',
+                      type='int', default=1)
+    parser.add_option('-t', '--tcp-port', dest='tcp_port',
+                      help='''also listen on this TCP port for the
+                              pipelined records protocol (default: don't)''',
+                      metavar='PORT',
+                      type='int', default=None)
+    parser.add_option('-z', '--compress-threshold', dest='compress_threshold',
+                      help='''compress stored values of at least this many
+                              bytes (default: don't compress)''',
+                      metavar='BYTES',
+                      type='int', default=0)
+    parser.add_option('--max-lag', dest='max_lag',
+                      help='''refuse requests with a 503 while they'd have
+                              to wait more than this long for their turn.
+                              Bulk requests are refused at half of it,
+                              and scans at a quarter (default: %default ms,
+                              0 to never refuse requests)''',
+                      metavar='MS',
+                      type='float', default=500)
+    parser.add_option('--max-busy', dest='max_busy',
+                      help='''also refuse scans while more than this
+                              fraction of the time is spent handling
+                              requests (default: %default)''',
+                      metavar='FRACTION',
+                      type='float', default=0.9)
+    parser.add_option('--retry-after', dest='retry_after',
+                      help='''seconds that refused clients are told to wait
+                              (default: %default)''',
+                      metavar='SECONDS',
+                      type='int', default=1)
+    parser.add_option('-r', '--reap-interval', dest='reap_interval',
+                      help='''how often to remove expired keys, for
+                              backends that don't do it themselves
+                              (default: %default seconds, 0 to never)''',
+                      metavar='SECONDS',
+                      type='float', default=1.0)
+    parser.add_option('--reap-batch', dest='reap_batch',
+                      help='''the most expired keys to remove each time
+                              (default: %default)''',
+                      metavar='KEYS',
+                      type='int', default=1000)
+    parser.add_option('--slow-ms', dest='slow_ms',
+                      help='''log requests that take at least this long to
+                              the rdb.slow logger (default: %default ms,
+                              0 to not log them)''',
+                      metavar='MS',
+                      type='float', default=250)
+    parser.add_option('--http-compress-threshold',
+                      dest='http_compress_threshold',
+                      help='''compress responses of at least this many
+                              bytes, for clients that accept gzip or
+                              deflate. Streamed responses are always
+                              compressed (default: %default, 0 to never
+                              compress responses)''',
+                      metavar='BYTES',
+                      type='int', default=1024)
+    parser.add_option('--http-compress-level', dest='http_compress_level',
+                      help='''the zlib compression level for responses,
+                              from 1 (fastest) to 9 (smallest) (default:
+                              %default)''',
+                      metavar='LEVEL',
+                      type='int', default=1)
+    parser.add_option('-l', '--write-log', dest='write_log',
+                      help='''keep a log of writes in this directory, for
+                              replicas to tail (default: don't)''',
+                      metavar='DIR',
+                      default=None)
+    parser.add_option('--write-log-size', dest='write_log_size',
+                      help='''the most disk space that the write log can
+                              use, which is as far as a replica can fall
+                              behind before it has to start again from a
+                              snapshot (default: %default MB)''',
+                      metavar='MB',
+                      type='int', default=256)
+    parser.add_option('--watch', dest='watch',
+                      help='''remember the last N keys that were written,
+                              for clients to watch through /_watch, which
+                              is as far as one can fall behind before it
+                              has to drop everything that it has cached
+                              (default: don't)''',
+                      metavar='N',
+                      type='int', default=0)
+    parser.add_option('--replica-of', dest='replica_of',
+                      help='''be a read-only replica of the server at
+                              HOST:PORT, which must have a --write-log''',
+                      metavar='HOST:PORT',
+                      default=None)
+    parser.add_option('--large-values', dest='large_values',
+                      help='''store values of more than this many bytes in
+                              chunks, so that they can be sent and
+                              received a piece at a time, and accept
+                              uploads. This costs a read before every
+                              write. Replicas of a server that does this
+                              need it too (default: don't)''',
+                      metavar='BYTES',
+                      type='int', default=0)
+    parser.add_option('--large-value-chunk', dest='large_value_chunk',
+                      help='''the size of those chunks (default: %default)''',
+                      metavar='BYTES',
+                      type='int', default=1024 * 1024)
+    parser.add_option('--restore', dest='restore',
+                      help='''replace everything in the store with a
+                              backup from /_backup before starting. The
+                              write log is started afresh, so replicas
+                              copy the restored store again''',
+                      metavar='FILE',
+                      default=None)
+    parser.add_option('--index', dest='indexes',
+                      help='''keep an index of the JSON documents stored
+                              by their field at PATH (dotted, like
+                              address.city), to query as NAME. Only
+                              values in JSON envelopes are indexed (not
+                              marshal or pickle ones). Can be given more
+                              than once''',
+                      metavar='NAME=PATH',
+                      action='append', default=[])
+    parser.add_option('--hot-keys', dest='hot_keys',
+                      help='''report this many of the most read and
+                              written keys in /_stats, base64-encoded
+                              (default: %default, 0 to not keep track)''',
+                      metavar='K',
+                      type='int', default=10)
+    parser.add_option('--hot-key-window', dest='hot_key_window',
+                      help='''over the last this many seconds
+                              (default: %default)''',
+                      metavar='SECONDS',
+                      type='int', default=60)
     serveroptions, args = parser.parse_args(sysargs)
 
     if len(args) < 1:
@@ -205,6 +1313,18 @@ def args_to_config(sysargs):
 
     backendname, backend_args = args[0], args[1:]
 
+    if serveroptions.processes != 1:
+        # these keep state in the process that the others wouldn't see
+        for option, name in ((serveroptions.tcp_port, '--tcp-port'),
+                             (serveroptions.write_log, '--write-log'),
+                             (serveroptions.watch, '--watch'),
+                             (serveroptions.replica_of, '--replica-of'),
+                             (serveroptions.indexes, '--index'),
+                             (serveroptions.large_values,
+                              '--large-values')):
+            if option:
+                parser.error("%s can't be used with --processes" % name)
+
     if backendname not in backends:
         parser.error('unknown backend %r' % backendname)
 
@@ -215,23 +1335,135 @@ def args_to_config(sysargs):
     backend_cls.parse_arguments(backend_optionparser)
     backend_options, backend_args = (
         backend_optionparser.parse_args(backend_args))
-    backend = backend_cls(backend_options, backend_args)
+    try:
+        backend = backend_cls(backend_options, backend_args)
+    except ValueError, e:
+        parser.error(str(e))
+    if serveroptions.processes != 1 and not backend.supports_processes:
+        # a BDB store with a Bloom filter can only be open in one
+        parser.error("the %s backend can't be used with --processes"
+                     % backendname)
+    if serveroptions.restore and not backend.supports_backup:
+        parser.error("the %s backend can't be restored from a backup"
+                     % backendname)
+    if serveroptions.compress_threshold:
+        backend = CompressedBackend(backend,
+                                    serveroptions.compress_threshold)
+    indexes = None
+    if serveroptions.indexes:
+        if not (backend.supports_indexes and backend.supports_iteration):
+            parser.error("the %s backend can't keep indexes" % backendname)
+        declared = {}
+        for index in serveroptions.indexes:
+            name, _, path = index.partition('=')
+            if not name or not path or '/' in name:
+                parser.error('bad --index %r' % index)
+            declared[name] = path
+        backend = indexes = IndexedBackend(backend, declared)
+    write_log = None
+    if serveroptions.write_log:
+        write_log = WriteLog(serveroptions.write_log,
+                             serveroptions.write_log_size * 1024 * 1024)
+        backend = LoggedBackend(backend, write_log)
+    change_feed = None
+    if serveroptions.watch:
+        # writes that a replica applies are changes too
+        change_feed = ChangeFeed(serveroptions.watch)
+        backend = LoggedBackend(backend, change_feed)
+    replicator = None
+    if serveroptions.replica_of:
+        # replicas can have write logs of their own, so that there
+        # can be replicas of replicas
+        replicator = Replicator(backend, serveroptions.replica_of)
+    replicated_backend = backend
+    if serveroptions.large_values:
+        backend = ChunkedBackend(backend, serveroptions.large_values,
+                                 serveroptions.large_value_chunk)
+    if serveroptions.hot_keys:
+        backend = HotKeyBackend(backend, serveroptions.hot_keys,
+                                serveroptions.hot_key_window)
+    backend = TimedBackend(backend)
+    monitor = RequestMonitor(backend, serveroptions.slow_ms / 1000.0)
+
+    admission = None
+    if serveroptions.max_lag:
+        admission = AdmissionControl(serveroptions.max_lag / 1000.0,
+                                     serveroptions.max_busy,
+                                     serveroptions.retry_after)
 
     return Config(backend=backend,
-                  port=serveroptions.port)
+                  port=serveroptions.port,
+                  tcp_port=serveroptions.tcp_port,
+                  reap_interval=serveroptions.reap_interval,
+                  reap_batch=serveroptions.reap_batch,
+                  admission=admission,
+                  monitor=monitor,
+                  write_log=write_log,
+                  replicator=replicator,
+                  http_compress_threshold=serveroptions.http_compress_threshold,
+                  http_compress_level=serveroptions.http_compress_level,
+                  replicated_backend=replicated_backend,
+                  processes=serveroptions.processes,
+                  restore=serveroptions.restore,
+                  indexes=indexes,
+                  change_feed=change_feed)
     
 
 def main(sysargs):
     config = args_to_config(sysargs[1:])
     logging.basicConfig(level=logging.INFO)
 
+    if config.write_log is not None:
+        config.write_log.open()
     config.backend.open() # let's do this now so that we fail early if
                           # it can't be opened. request processors
                           # will open their own
 
+    if config.restore is not None:
+        with open(config.restore, 'rb') as f:
+            records = config.backend.restore(f)
+        logging.info('Restored %d records from %s', records, config.restore)
+
     application = RDBServerApplication(config)
     http_server = tornado.httpserver.HTTPServer(application)
-    http_server.listen(config.port)
+    if config.processes == 1:
+        http_server.listen(config.port)
+    else:
+        config.backend.close()
+        http_server.bind(config.port)
+        http_server.start(config.processes)
+        if http_server.io_loop is None:
+            # we're the parent, and start() only comes back once one
+            # of the workers has exited
+            logging.error('A server process exited')
+            return
+        config.backend.open()
+
+    if config.admission is not None:
+        config.admission.start()
+
+    if config.tcp_port:
+        RecordServer(config.backend,
+                     admission=config.admission,
+                     monitor=config.monitor,
+                     read_only=config.replicator is not None
+                     ).listen(config.tcp_port)
+
+    if config.replicator is not None:
+        config.replicator.start()
+
+    if config.reap_interval and config.backend.supports_ttl:
+        # this runs between requests, so backends don't have to
+        # worry about it happening at the same time as one
+        reaper = tornado.ioloop.PeriodicCallback(
+            lambda: config.backend.expire(config.reap_batch),
+            config.reap_interval * 1000)
+        reaper.start()
+
+    ticker = tornado.ioloop.PeriodicCallback(config.backend.tick,
+                                             config.tick_interval * 1000)
+    ticker.start()
+
     tornado.ioloop.IOLoop.instance().start()
 
 if __name__ == '__main__':
@@ -0,0 +1,235 @@
+"""A listener for the records protocol: the record format from rdbutil
+   sent straight over a TCP connection, without any HTTP around it.
+
+   Clients can send as many request records as they like without
+   waiting for answers, and get exactly one response record for each,
+   in the same order: v(alue) or f (not found) or u(nchanged) for g,
+   k (ok) for p and d, v for i, and k with the new version for a and
+   c. An atomic operation that doesn't apply gets an x (conflict) and
+   anything else that goes wrong an e(rror), each with a message as
+   the value. When the server is too busy, requests are answered with
+   an o(verloaded) record whose value is the number of seconds to wait
+   before trying again. There's no way to give a TTL; use HTTP for
+   those. Replicas answer anything but g with an e"""
+
+import time
+import errno
+import socket
+import logging
+from itertools import groupby
+
+import tornado.ioloop
+
+import rdbops
+from rdbutil import Conflict, version_of
+from rdbutil import pack_record, split_records
+from admission import HIGH, NORMAL
+
+
+class RecordServer(object):
+
+    def __init__(self, backend, io_loop = None, admission = None,
+                 monitor = None, read_only = False):
+        self.backend = backend
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.admission = admission
+        self.monitor = monitor
+        self.read_only = read_only
+        self._socket = None
+
+    def listen(self, port, address = ''):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setblocking(0)
+        sock.bind((address, port))
+        sock.listen(128)
+        self._socket = sock
+        self.io_loop.add_handler(sock.fileno(), self._handle_accept,
+                                 self.io_loop.READ)
+
+    def _handle_accept(self, fd, events):
+        while True:
+            try:
+                conn, address = self._socket.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            RecordConnection(self.backend, conn, self.io_loop,
+                             self.admission, self.monitor, self.read_only)
+
+
+class RecordConnection(object):
+    """One client's connection. Everything that has arrived is handled
+       in one go whenever the socket is readable, so a client that
+       pipelines its requests gets runs of gets, puts and deletes done
+       as get_multi, put_multi and delete_multi"""
+
+    read_size = 64 * 1024
+    max_pending = 4 * 1024 * 1024 # stop reading while we have this
+                                  # much waiting to be written
+
+    def __init__(self, backend, sock, io_loop, admission = None,
+                 monitor = None, read_only = False):
+        self.backend = backend
+        self.admission = admission
+        self.monitor = monitor
+        self.read_only = read_only
+        self.socket = sock
+        self.socket.setblocking(0)
+        self.io_loop = io_loop
+        self.inbuf = ''
+        self.outbuf = ''
+        self.state = io_loop.READ
+        io_loop.add_handler(sock.fileno(), self._handle_events, self.state)
+
+    def _handle_events(self, fd, events):
+        try:
+            if events & self.io_loop.READ:
+                self._handle_read()
+            if self.socket is not None and self.outbuf:
+                self._handle_write()
+            if events & self.io_loop.ERROR:
+                self.close()
+        except Exception:
+            logging.error('Error on a records connection, closing it',
+                          exc_info = True)
+            self.close()
+        if self.socket is None:
+            return
+
+        state = self.io_loop.ERROR
+        if len(self.outbuf) < self.max_pending:
+            state |= self.io_loop.READ
+        if self.outbuf:
+            state |= self.io_loop.WRITE
+        if state != self.state:
+            self.state = state
+            self.io_loop.update_handler(self.socket.fileno(), state)
+
+    def _handle_read(self):
+        chunks = [self.inbuf]
+        while True:
+            try:
+                chunk = self.socket.recv(self.read_size)
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                raise
+            if not chunk:
+                self.close()
+                return
+            chunks.append(chunk)
+            if len(chunk) < self.read_size:
+                break
+
+        data = ''.join(chunks)
+        records, self.inbuf = split_records(data)
+        if not records:
+            return
+
+        # everything that arrived together is admitted or refused
+        # together, as a single request if there's one or a bulk one
+        # otherwise
+        if (self.admission is not None and
+            not self.admission.admit(HIGH if len(records) == 1 else NORMAL)):
+            retry_after = str(self.admission.retry_after)
+            self.outbuf += ''.join(pack_record('o', key, retry_after)
+                                   for (op, key, value) in records)
+            return
+        started = time.time()
+        timing = self.monitor.begin() if self.monitor is not None else None
+        out = ''.join(self.handle(records))
+        self.outbuf += out
+        if self.admission is not None:
+            self.admission.done(time.time() - started)
+        if timing is not None:
+            self.monitor.end(timing, 'records', len(records),
+                             len(data) - len(self.inbuf), len(out))
+
+    def _handle_write(self):
+        try:
+            sent = self.socket.send(self.outbuf)
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            raise
+        self.outbuf = self.outbuf[sent:]
+
+    def close(self):
+        if self.socket is not None:
+            self.io_loop.remove_handler(self.socket.fileno())
+            self.socket.close()
+            self.socket = None
+
+    def handle(self, records):
+        "Yields the packed response records for a list of requests"
+        # runs of the same op are done together, which can't change
+        # the outcome since they're still done in order
+        for op, run in groupby(records, lambda record: record[0]):
+            run = list(run)
+            try:
+                if op == 'g':
+                    responses = self._get(run)
+                elif self.read_only:
+                    responses = [('e', key, 'Read-only replica')
+                                 for (_op, key, value) in run]
+                elif op == 'p':
+                    responses = self._put(run)
+                elif op == 'd':
+                    self.backend.delete_multi(key for (_op, key, value) in run)
+                    responses = [('k', key, '') for (_op, key, value) in run]
+                else:
+                    responses = [self._single(*record) for record in run]
+            except Exception, e:
+                logging.error('Error handling %r records', op,
+                              exc_info = True)
+                responses = [('e', key, str(e)) for (_op, key, value) in run]
+            for response in responses:
+                yield pack_record(*response)
+
+    def _get(self, run):
+        found = self.backend.get_multi(key for (op, key, known) in run)
+        ret = []
+        for op, key, known in run:
+            value = found.get(key)
+            if value is None:
+                ret.append(('f', key, ''))
+            elif known and version_of(value) == known:
+                ret.append(('u', key, ''))
+            else:
+                ret.append(('v', key, value))
+        return ret
+
+    def _put(self, run):
+        ret = []
+        good = {}
+        for op, key, value in run:
+            try:
+                rdbops.check_value(value)
+            except rdbops.BadValue, e:
+                ret.append(('e', key, str(e)))
+                continue
+            good[key] = value
+            ret.append(('k', key, ''))
+        if good:
+            self.backend.put_multi(good)
+        return ret
+
+    def _single(self, op, key, value):
+        try:
+            if op == 'i':
+                return ('v', key, self.backend.incr(key, int(value)))
+            elif op == 'a':
+                func = rdbops.atomic_op('append', value)
+            elif op == 'c' and '\n' in value:
+                func = rdbops.atomic_op('cas', tuple(value.split('\n', 1)))
+            else:
+                return ('e', key, 'Unknown op %r' % op)
+            new = self.backend.update(key, func)
+        except Conflict, e:
+            return ('x', key, str(e))
+        except (rdbops.BadValue, ValueError), e:
+            return ('e', key, str(e))
+        return ('k', key, version_of(new))
@@ -1,3 +1,7 @@
+import struct
+import hashlib
+
+
 class DictNature(object):
     """Mixin class to allow something with get/put/has_key/delete
        methods to be accessed using [] notation and have a default
@@ -20,6 +24,73 @@ class NotFound(Exception):
     pass
 
 
+class Conflict(Exception):
+    """An atomic operation couldn't be applied to the value that's
+       there: its version didn't match, or it's the wrong type"""
+    pass
+
+
+class Overloaded(Exception):
+    """The server is too busy to take the request, and asks that it not
+       be retried for 'retry_after' seconds"""
+
+    def __init__(self, retry_after = None):
+        self.retry_after = retry_after
+        Exception.__init__(self, 'server overloaded, retry after %ss'
+                           % retry_after)
+
+
+class Gone(Exception):
+    """The writes that a replica asked for have already been dropped
+       from the write log, so it has to start again from a snapshot"""
+    pass
+
+
+class NotModified(object):
+    """Returned in place of a value when the caller already has its
+       current version"""
+    pass
+
+
+def version_of(value):
+    """The version token of a stored value, which clients see as its
+       ETag"""
+    return hashlib.md5(value).hexdigest()
+
+
+class BulkError(Exception):
+    "One or more nodes failed during a bulk request"
+
+    def __init__(self, errors):
+        self.errors = errors
+        Exception.__init__(self, '; '.join('%s: %r' % (node, exc)
+                                           for (node, exc)
+                                           in sorted(errors.items())))
+
+
+class BulkResult(dict):
+    """The results of a bulk request that spans several nodes. Nodes
+       that failed or timed out are left out of the results, and their
+       exceptions are in 'errors', keyed by node. Atomic operations
+       that couldn't be applied have their Conflicts in 'errors' too,
+       keyed by key"""
+
+    def __init__(self, *a, **kw):
+        dict.__init__(self, *a, **kw)
+        self.errors = {}
+
+    def merge(self, other):
+        "Add another result's items and errors to this one"
+        self.update(other)
+        self.errors.update(getattr(other, 'errors', {}))
+
+    def check(self):
+        "Raise a BulkError if any node failed, otherwise return self"
+        if self.errors:
+            raise BulkError(self.errors)
+        return self
+
+
 def trace(fn):
     "function decorator to make a function be really verbose"
     def _fn(*a, **kw):
@@ -28,4 +99,62 @@ def trace(fn):
         print fn.__name__, repr(a), repr(kw), '->', repr(ret)
         return ret
     return _fn
-        
+
+
+# The binary record format used by rdbload/rdbdump and for bulk
+# requests: each record is a one-byte op code, the length of the key
+# and the length of the value as big-endian unsigned ints, followed by
+# the key and the value themselves. Requests use the ops g(et),
+# p(ut), d(elete), i(ncrement by the value), a(ppend the value) and
+# c(ompare-and-set, with the value being the expected version, a
+# newline and the new value). A g record's value can be the version
+# of the value that the client already has. Responses use v(alue),
+# n(ext key to scan from), x (conflict, with a message as the value),
+# u(nchanged, when the client has the current version) and, in scans
+# that ask for TTLs, t (as below) for the keys that expire, and the
+# records protocol (see rdbtcp) adds f (not found), k (ok), e(rror)
+# and o(verloaded). The write log and replication (see writelog) use
+# p, d and t (a put with a TTL, with the value being the TTL, a
+# newline and the value)
+record_header = struct.Struct('!cII')
+records_content_type = 'application/x-rdb-records'
+
+
+def pack_record(op, key, value):
+    return ''.join((record_header.pack(op, len(key), len(value)),
+                    key, value))
+
+
+def read_records(f):
+    """Yields (op, key, value) tuples read from the file-like object f
+       until it's exhausted"""
+    while True:
+        header = f.read(record_header.size)
+        if not header:
+            return
+        if len(header) != record_header.size:
+            raise ValueError('truncated record header')
+        op, keylen, valuelen = record_header.unpack(header)
+        key = f.read(keylen)
+        value = f.read(valuelen)
+        if len(key) != keylen or len(value) != valuelen:
+            raise ValueError('truncated record %r' % key)
+        yield op, key, value
+
+
+def split_records(buf):
+    """Parses as many complete records as there are at the start of
+       the string buf, returning a list of (op, key, value) tuples and
+       whatever is left of buf"""
+    ret = []
+    pos = 0
+    while len(buf) - pos >= record_header.size:
+        op, keylen, valuelen = record_header.unpack_from(buf, pos)
+        key_start = pos + record_header.size
+        end = key_start + keylen + valuelen
+        if end > len(buf):
+            break
+        ret.append((op, buf[key_start:key_start + keylen],
+                    buf[key_start + keylen:end]))
+        pos = end
+    return ret, buf[pos:]
@@ -0,0 +1,53 @@
+import os
+
+from rdbutil import pack_record, read_records
+
+
+class RecentKeys(object):
+    """Roughly the last 'capacity' distinct keys that were used, to
+       know which keys are worth having in a cache. Keys go into the
+       current generation, which replaces the previous one once it's
+       half full, so keeping track costs a set.add() per key"""
+
+    def __init__(self, capacity = 100000):
+        self.capacity = capacity
+        self.current = set()
+        self.previous = set()
+
+    def add(self, key):
+        self.current.add(key)
+        if len(self.current) >= self.capacity // 2:
+            self.previous = self.current
+            self.current = set()
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def keys(self):
+        "The keys, more recently used first"
+        ret = list(self.current)
+        ret.extend(key for key in self.previous if key not in self.current)
+        return ret
+
+    def __len__(self):
+        return len(self.current) + len(self.previous - self.current)
+
+    def save(self, path):
+        "Write the keys to a file, replacing it atomically"
+        # the server's other processes might be saving theirs too
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            for key in self.keys():
+                f.write(pack_record('k', key, ''))
+        os.rename(tmp, path)
+
+    @staticmethod
+    def load(path):
+        "The keys from a file written by save()"
+        try:
+            with open(path, 'rb') as f:
+                return [key for (op, key, value) in read_records(f)]
+        except (IOError, ValueError):
+            # there's no file yet, or it's damaged
+            return []
@@ -0,0 +1,224 @@
+"""Replicas: servers that keep their backend in step with a primary
+   server's by tailing its write log (see writelog), to add read
+   capacity without resharding.
+
+   A replica that's starting out, or that has fallen further behind
+   than the primary's log goes back, notes where the log is up to,
+   copies everything from a snapshot (pages of a scan) and then
+   applies the log from where it noted. Writes that happened during
+   the copy are applied again, which is harmless since applying the
+   log is idempotent. Keys that the replica has and the snapshot
+   doesn't are deleted along the way, by scanning the replica's own
+   backend over the same range of keys as each page of the snapshot,
+   which relies on both scans having the keys in byte order (as BDB,
+   the only backend that can scan, does)"""
+
+import time
+import logging
+import threading
+from cStringIO import StringIO
+
+import tornado.ioloop
+
+from rdbclient import RDBClient
+from rdbutil import Gone, Overloaded, read_records
+
+
+class Replicator(object):
+    """Runs in a thread of its own, making blocking requests to the
+       primary, and hands what it fetches to the IOLoop to apply so
+       that it never runs at the same time as a request"""
+
+    batch = 1000 # entries to fetch at a time
+    wait = 30 # seconds to wait for new writes in each request
+    retry = 1 # seconds to wait after an error
+
+    def __init__(self, backend, primary, io_loop = None):
+        self.backend = backend
+        self.primary = primary
+        self.client = RDBClient(primary)
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+
+        self.state = 'starting'
+        self.log_id = None
+        self.next_seq = None # the next entry to apply
+        self.primary_seq = None # the newest entry the primary has
+        self.applied_time = None # when the newest entry we've applied
+                                 # was written on the primary
+        self.resyncs = 0
+        self.errors = 0
+
+    def start(self):
+        thread = threading.Thread(target = self.run,
+                                  name = 'replicator %s' % self.primary)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while True:
+            try:
+                if self.next_seq is None:
+                    self.resync()
+                self.tail()
+            except Gone, e:
+                logging.warning('Replication from %s has fallen too far '
+                                'behind, starting again: %s',
+                                self.primary, e)
+                self.next_seq = None
+            except Overloaded, e:
+                time.sleep(e.retry_after or self.retry)
+            except Exception:
+                logging.error('Error replicating from %s', self.primary,
+                              exc_info = True)
+                self.state = 'error'
+                self.errors += 1
+                time.sleep(self.retry)
+
+    def resync(self):
+        "Copy everything from the primary, and note where its log was"
+        self.state = 'resyncing'
+        entries, next_seq = self._fetch_log()
+        start = next_seq
+
+        key = None
+        while True:
+            try:
+                entries, next = self._fetch_snapshot(key)
+            except Overloaded, e:
+                time.sleep(e.retry_after or self.retry)
+                continue
+            except Exception:
+                # the same page again, rather than starting over
+                logging.error('Error copying a snapshot from %s',
+                              self.primary, exc_info = True)
+                self.errors += 1
+                time.sleep(self.retry)
+                continue
+            self._on_loop(self._apply, entries)
+            if self.backend.supports_iteration:
+                self._drop_stale(key, next,
+                                 set(k for (op, k, value) in entries))
+            key = next
+            if key is None:
+                break
+
+        self.next_seq = start
+        self.resyncs += 1
+        logging.info('Copied a snapshot from %s, replicating from %d',
+                     self.primary, start)
+
+    def _fetch_snapshot(self, start = None):
+        """Fetch the page of the primary's snapshot after 'start',
+           returning its entries and the key to continue from"""
+        args = {'limit': self.batch}
+        if start is not None:
+            args['start'] = start
+        resp = self.client.openurl('GET', func = '/_replicate/snapshot',
+                                   args = args, return_response = True,
+                                   timeout = 60)
+        entries = []
+        next = None
+        for op, key, value in read_records(StringIO(resp.data)):
+            if op == 'n':
+                next = key
+            else:
+                entries.append((op, key, value))
+        return entries, next
+
+    def _drop_stale(self, after, upto, keep):
+        """Delete the keys that we have after 'after' (or from the
+           beginning) up to and including 'upto' (or to the end) that
+           aren't in 'keep', the keys of the snapshot's page for that
+           range. A page of our own keys at a time, so that the IOLoop
+           is never held up for long"""
+        while True:
+            items, next = self._on_loop(self.backend.scan, after,
+                                        self.batch)
+            stale = [key for (key, value) in items
+                     if (upto is None or key <= upto) and key not in keep]
+            if stale:
+                self._on_loop(self._apply, [('d', key, '')
+                                            for key in stale])
+            if next is None or (upto is not None and next >= upto):
+                return
+            after = next
+
+    def tail(self):
+        "Apply the primary's log until something goes wrong"
+        self.state = 'tailing'
+        while True:
+            entries, next_seq = self._fetch_log(self.next_seq, self.wait)
+            self._on_loop(self._apply, entries)
+            self.next_seq = next_seq
+
+    def _fetch_log(self, since = None, wait = 0):
+        """Fetch entries from the primary's log, starting with 'since'
+           (or none, to find out where it's up to), returning them and
+           the next sequence number"""
+        args = {'limit': self.batch, 'wait': wait}
+        if since is not None:
+            args['since'] = since
+            args['log'] = self.log_id
+        resp = self.client.openurl('GET', func = '/_replicate/log',
+                                   args = args, return_response = True,
+                                   timeout = wait + 60)
+        self.log_id = resp.getheader('X-Rdb-Log')
+        self.primary_seq = int(resp.getheader('X-Rdb-Last-Seq'))
+        entries = []
+        next_seq = None
+        for op, key, value in read_records(StringIO(resp.data)):
+            if op == 'n':
+                next_seq = int(key)
+            else:
+                entries.append((op, key, value))
+        if entries:
+            self.applied_time = float(resp.getheader('X-Rdb-Time'))
+        return entries, next_seq
+
+    def _on_loop(self, func, *a):
+        "Call func on the IOLoop's thread, and wait for it to finish"
+        done = threading.Event()
+        result = {}
+        def call():
+            try:
+                result['value'] = func(*a)
+            except Exception, e:
+                result['error'] = e
+            finally:
+                done.set()
+        self.io_loop.add_callback(call)
+        done.wait()
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
+    def _apply(self, entries):
+        for op, key, value in entries:
+            if op == 'p':
+                self.backend.put(key, value)
+            elif op == 't':
+                ttl, value = value.split('\n', 1)
+                self.backend.put(key, value, int(ttl)
+                                 if self.backend.supports_ttl else None)
+            elif op == 'd':
+                self.backend.delete(key)
+            else:
+                raise ValueError('Unknown op %r in the log' % op)
+
+    def stats(self):
+        lag = None
+        if self.next_seq is not None and self.primary_seq is not None:
+            lag = max(0, self.primary_seq - self.next_seq + 1)
+        return {
+            'primary': self.primary,
+            'state': self.state,
+            'next_seq': self.next_seq,
+            'primary_seq': self.primary_seq,
+            'lag': lag,
+            # how far behind the primary's clock we are, which is only
+            # meaningful while there's something left to apply
+            'lag_seconds': (time.time() - self.applied_time
+                            if lag and self.applied_time else 0),
+            'resyncs': self.resyncs,
+            'errors': self.errors,
+            }
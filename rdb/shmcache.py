@@ -0,0 +1,266 @@
+"""A fixed-size cache of values in shared memory, for the worker
+   processes on a host to share, so that a value that any of them has
+   read is there for all of them.
+
+   The cache is a file that's mmap()ed by every process, made of
+   fixed-size slots. Each key can be in either of two slots (from its
+   hash), and a new one replaces whichever of them is empty, expired
+   or was filled longest ago.
+
+   Reads take no locks and write nothing to the shared memory, so that
+   they don't slow each other down however many processes there are.
+   Each slot starts with a sequence number that's odd while the slot
+   is being written, and a read that sees it change has to try again
+   (a seqlock). Writers take a lock on their slot with lockf(), which
+   the kernel lets go of if they die.
+
+   Filling the cache races with writes by other processes: one can
+   read a value from the backend, then another write a new one and
+   invalidate the key, and then the first put the old value in the
+   cache. So a miss hands out a token (the sequence numbers of the
+   key's slots), and a fill with it is refused if either slot has
+   changed since"""
+
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import threading
+
+MAGIC = 'RDBS'
+FORMAT_VERSION = 1
+
+header = struct.Struct('<4sIII') # magic, version, slot size, slots
+header_size = 4096 # so that the slots are page aligned
+
+# seq, key hash, expires (0 for never), filled, key length, value length
+slot_header = struct.Struct('<IQddII')
+seq_format = struct.Struct('<I')
+
+read_attempts = 3 # before a slot being written counts as a miss
+
+
+def _hashes(key):
+    h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+    # 0 is what an empty slot has
+    return h1 | 1, h2
+
+
+class SharedCache(object):
+    """'size' bytes of 'slot_size' byte slots in the file at 'path'.
+       Values that don't fit into a slot with their key aren't
+       cached"""
+
+    def __init__(self, path, size = 64 * 1024 * 1024, slot_size = 4096):
+        self.path = path
+        self.slot_size = slot_size
+        self.slots = max(2, size // slot_size)
+        self.max_item = slot_size - slot_header.size
+
+        self.mm = None
+        self.fd = None
+        # lockf() locks belong to the process, so they don't keep our
+        # own threads out of a slot
+        self.lock = threading.Lock()
+
+        self.hits = self.misses = 0
+        self.fills = self.refused = self.evictions = self.too_big = 0
+
+    def open(self):
+        self.close()
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            length = header_size + self.slots * self.slot_size
+            # while we look at the header, and maybe (re)make the file
+            fcntl.lockf(fd, fcntl.LOCK_EX, header_size, 0)
+            try:
+                ours = header.pack(MAGIC, FORMAT_VERSION, self.slot_size,
+                                   self.slots)
+                if os.read(fd, header.size) != ours:
+                    # a new file, or one made with other settings, whose
+                    # contents we can't use
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, length)
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.write(fd, ours)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, header_size, 0)
+            self.mm = mmap.mmap(fd, length)
+        except:
+            os.close(fd)
+            raise
+        self.fd = fd
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def clear(self):
+        """Empty every slot, each under its lock like any other write,
+           rather than truncating the file under processes that have it
+           mapped"""
+        with self.lock:
+            for offset in xrange(header_size,
+                                 header_size + self.slots * self.slot_size,
+                                 self.slot_size):
+                if not slot_header.unpack_from(self.mm, offset)[1]:
+                    continue
+                self._lock(offset)
+                try:
+                    self._write_slot(offset)
+                finally:
+                    self._unlock(offset)
+
+    def _slots(self, hashes):
+        h1, h2 = hashes
+        first = h1 % self.slots
+        second = h2 % self.slots
+        if second == first:
+            second = (first + 1) % self.slots
+        return (header_size + first * self.slot_size,
+                header_size + second * self.slot_size)
+
+    def _read_slot(self, offset, key, h, now):
+        """The value in the slot at 'offset' if it's 'key's and hasn't
+           expired, None if it isn't there, and the sequence number
+           that it was read at"""
+        mm = self.mm
+        for i in xrange(read_attempts):
+            (seq, slot_hash, expires, filled, klen,
+             vlen) = slot_header.unpack_from(mm, offset)
+            if seq & 1:
+                continue
+            if slot_hash != h:
+                value = None
+            else:
+                # the lengths might be from half of a write, which the
+                # sequence number will catch, but they mustn't take us
+                # out of the slot
+                start = offset + slot_header.size
+                end = start + min(klen + vlen, self.max_item)
+                data = mm[start:end]
+                value = data[klen:] if data[:klen] == key else None
+                if expires and expires <= now:
+                    value = None
+            if seq_format.unpack_from(mm, offset)[0] == seq:
+                return value, seq
+        return None, None
+
+    def get(self, key, now = None):
+        """The value for 'key', or None and a token to fill it in
+           with, as (value, token)"""
+        now = now or time.time()
+        hashes = _hashes(key)
+        token = []
+        for offset in self._slots(hashes):
+            value, seq = self._read_slot(offset, key, hashes[0], now)
+            if value is not None:
+                self.hits += 1
+                return value, None
+            token.append(seq)
+        self.misses += 1
+        if None in token:
+            # we couldn't get a consistent look at a slot
+            return None, None
+        return None, tuple(token)
+
+    def _lock(self, offset):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.slot_size, offset)
+
+    def _unlock(self, offset):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def _write_slot(self, offset, h = 0, expires = 0, filled = 0, key = '',
+                    value = ''):
+        "Rewrite a slot that we hold the lock on"
+        mm = self.mm
+        seq = seq_format.unpack_from(mm, offset)[0]
+        seq_format.pack_into(mm, offset, (seq + 1) & 0xffffffff)
+        slot_header.pack_into(mm, offset, (seq + 1) & 0xffffffff, h,
+                              expires, filled, len(key), len(value))
+        if key:
+            start = offset + slot_header.size
+            mm[start:start + len(key) + len(value)] = key + value
+        seq_format.pack_into(mm, offset, (seq + 2) & 0xffffffff)
+
+    def fill(self, key, value, token, ttl = None):
+        """Cache a value that was read after get() missed, unless
+           something has changed the key's slots since then. Returns
+           whether it was cached"""
+        if token is None:
+            return False
+        if len(key) + len(value) > self.max_item:
+            self.too_big += 1
+            return False
+        now = time.time()
+        hashes = _hashes(key)
+        slots = self._slots(hashes)
+        with self.lock:
+            # in the same order in every process, so that two filling
+            # keys whose slots are the other way around can't deadlock
+            for offset in sorted(slots):
+                self._lock(offset)
+            try:
+                seqs = tuple(seq_format.unpack_from(self.mm, offset)[0]
+                             for offset in slots)
+                if seqs != token:
+                    self.refused += 1
+                    return False
+                # the slot that's free, or was filled longest ago
+                victim = None
+                for offset in slots:
+                    (seq, slot_hash, expires, filled, klen,
+                     vlen) = slot_header.unpack_from(self.mm, offset)
+                    if not slot_hash or (expires and expires <= now):
+                        victim = offset
+                        break
+                    if victim is None or filled < victim_filled:
+                        victim, victim_filled = offset, filled
+                if slot_header.unpack_from(self.mm, victim)[1]:
+                    self.evictions += 1
+                self._write_slot(victim, hashes[0],
+                                 now + ttl if ttl else 0, now, key, value)
+                self.fills += 1
+                return True
+            finally:
+                for offset in slots:
+                    self._unlock(offset)
+
+    def invalidate(self, keys):
+        """Drop 'keys', and make fills with tokens from before now fail
+           for them"""
+        with self.lock:
+            for key in keys:
+                hashes = _hashes(key)
+                for offset in self._slots(hashes):
+                    self._lock(offset)
+                    try:
+                        if slot_header.unpack_from(self.mm,
+                                                   offset)[1] == hashes[0]:
+                            self._write_slot(offset)
+                        else:
+                            # a new sequence number, for the tokens
+                            seq = seq_format.unpack_from(self.mm, offset)[0]
+                            seq_format.pack_into(self.mm, offset,
+                                                 (seq + 2) & 0xffffffff)
+                    finally:
+                        self._unlock(offset)
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'slots': self.slots,
+            'slot_size': self.slot_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'fills': self.fills,
+            'refused_fills': self.refused,
+            'evictions': self.evictions,
+            'too_big': self.too_big,
+            }
@@ -0,0 +1,100 @@
+"""Keeping a client's local cache of values fresh by watching servers'
+   change feeds (see changefeed and rdbserver --watch), so that
+   entries can be cached for as long as they stay the same rather than
+   for a short TTL.
+
+   A value that the caller read just before a change, but only put in
+   its cache after the watcher dropped the key, stays there until the
+   next change, so caches should still have a TTL, just a much longer
+   one"""
+
+import time
+import logging
+import threading
+
+from rdbutil import Gone, Overloaded
+
+
+class Watcher(object):
+    """Drops keys from 'cache' as they're written, watching each of a
+       client's servers (an RDBClient's one, or an RDBMultiClient's
+       nodes) from a thread of its own. 'cache' is anything with
+       pop(key, default) and clear(), like a dict, which the threads
+       have to be able to change while others use it.
+
+       Everything is dropped from the cache whenever a watcher can't
+       know what it's missed: when it starts watching a server, and if
+       it falls too far behind or the server restarts. 'on_change' is
+       called with each change (seq, 'put' or 'delete', key) too, and
+       'on_resync' with the server, for callers that cache more than
+       'cache' does"""
+
+    wait = 30 # seconds to wait for changes in each request
+    retry = 1 # seconds to wait after an error
+
+    def __init__(self, client, cache, keys = (), prefixes = (),
+                 on_change = None, on_resync = None):
+        self.clients = getattr(client, 'clients', None) or {
+            '%s:%d' % (client.server, client.port): client}
+        self.cache = cache
+        self.keys = list(keys)
+        self.prefixes = list(prefixes)
+        self.on_change = on_change
+        self.on_resync = on_resync
+
+        self.stopped = threading.Event()
+        self.changes = self.resyncs = self.errors = 0
+
+    def start(self):
+        for node, client in self.clients.iteritems():
+            thread = threading.Thread(target = self.run,
+                                      args = (node, client),
+                                      name = 'watcher %s' % node)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        "Stop watching, once the requests that are waiting come back"
+        self.stopped.set()
+
+    def run(self, node, client):
+        feed = since = None
+        while not self.stopped.is_set():
+            try:
+                if since is None:
+                    changes, feed, since = client.watch(wait = 0)
+                    self._resync(node)
+                changes, feed, since = client.watch(
+                    since, feed, self.keys, self.prefixes, self.wait)
+                self._changed(changes)
+            except Gone, e:
+                logging.warning('Fell behind the changes on %s, dropping '
+                                'the cache: %s', node, e)
+                since = None
+            except Overloaded, e:
+                time.sleep(e.retry_after or self.retry)
+            except Exception:
+                logging.error('Error watching %s', node, exc_info = True)
+                self.errors += 1
+                time.sleep(self.retry)
+
+    def _resync(self, node):
+        self.cache.clear()
+        self.resyncs += 1
+        if self.on_resync is not None:
+            self.on_resync(node)
+
+    def _changed(self, changes):
+        for change in changes:
+            self.cache.pop(change[2], None)
+            if self.on_change is not None:
+                self.on_change(change)
+        self.changes += len(changes)
+
+    def stats(self):
+        return {
+            'servers': len(self.clients),
+            'changes': self.changes,
+            'resyncs': self.resyncs,
+            'errors': self.errors,
+            }
@@ -0,0 +1,231 @@
+"""An ordered log of the writes that a server has applied, which
+   replicas tail to apply the same writes to their own backends.
+
+   Every put and delete gets the next sequence number. Entries are
+   appended to segment files in a directory, and the oldest segments
+   are removed once the log is over its size, so the log is a ring
+   that holds the most recent writes. A replica that has fallen
+   further behind than that has to start again from a snapshot.
+
+   Entries are the records from rdbutil, each preceded by its
+   sequence number and the time it was written: p(ut) with the value,
+   t for a put with a TTL, whose value is "ttl\\nvalue", and d(elete)"""
+
+import os
+import time
+import uuid
+import struct
+from itertools import islice
+from collections import deque
+
+from rdbutil import Gone, pack_record, record_header
+
+entry_header = struct.Struct('!Qd') # sequence number, time
+
+
+class WriteLog(object):
+
+    segment_prefix = 'log.'
+    recent_bytes = 8 * 1024 * 1024 # of entries to keep in memory too
+
+    def __init__(self, path, max_bytes = 256 * 1024 * 1024, segments = 8):
+        """Keep the log in the directory 'path', in about 'segments'
+           files of at most max_bytes between them"""
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = max(max_bytes // segments, 64 * 1024)
+
+        self.log_id = None # changes whenever the log is started afresh,
+                           # so replicas can't mistake one log's
+                           # numbers for another's
+        self.first_seq = 1 # the oldest entry we still have
+        self.next_seq = 1
+        self.last_time = None # when the newest entry was written
+
+        self._segments = [] # (first seq, filename), oldest first
+        self._file = None
+        self._file_bytes = 0
+        self._recent = deque() # (seq, time, op, key, value)
+        self._recent_bytes = 0
+        self._waiters = []
+
+    def open(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        id_path = os.path.join(self.path, 'id')
+        if os.path.exists(id_path):
+            self.log_id = open(id_path).read().strip()
+        else:
+            self.log_id = uuid.uuid4().hex
+            tmp = id_path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(self.log_id)
+            os.rename(tmp, id_path)
+
+        for name in os.listdir(self.path):
+            if name.startswith(self.segment_prefix):
+                try:
+                    first = int(name[len(self.segment_prefix):])
+                except ValueError:
+                    continue
+                self._segments.append((first, os.path.join(self.path, name)))
+        self._segments.sort()
+
+        if self._segments:
+            self.first_seq = self._segments[0][0]
+            last_first, filename = self._segments[-1]
+            self.next_seq, good = self._recover(last_first, filename)
+            self._file = open(filename, 'r+b')
+            self._file.truncate(good) # drop a half-written entry
+            self._file.seek(good)
+            self._file_bytes = good
+        else:
+            self._new_segment()
+
+    def _recover(self, seq, filename):
+        """Find the sequence number following the last whole entry in a
+           segment, and the length of the whole entries"""
+        good = 0
+        with open(filename, 'rb') as f:
+            for entry_seq, entry_time, op, key, value in self._read(f):
+                seq = entry_seq + 1
+                self.last_time = entry_time
+                good = f.tell()
+        return seq, good
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def reset(self):
+        """Start the log afresh, with a new id and none of its entries,
+           when the store has been replaced (by restoring a backup) so
+           that they no longer lead to it. Replicas then have to start
+           again from a snapshot"""
+        self.close()
+        for first, filename in self._segments:
+            os.unlink(filename)
+        os.unlink(os.path.join(self.path, 'id'))
+        self._segments = []
+        self._recent.clear()
+        self._recent_bytes = 0
+        self.first_seq = self.next_seq = 1
+        self.last_time = None
+        self.open()
+
+    def _new_segment(self):
+        if self._file is not None:
+            self._file.close()
+        filename = os.path.join(self.path, '%s%020d' % (self.segment_prefix,
+                                                        self.next_seq))
+        self._segments.append((self.next_seq, filename))
+        self._file = open(filename, 'w+b')
+        self._file_bytes = 0
+
+        # drop the oldest segments while we're over, keeping the one
+        # we just started
+        while (len(self._segments) > 1
+               and len(self._segments) * self.segment_bytes > self.max_bytes):
+            first, oldest = self._segments.pop(0)
+            os.unlink(oldest)
+            self.first_seq = self._segments[0][0]
+
+    def append(self, entries):
+        """Append a list of (op, key, value) entries, returning the
+           sequence number of the last one"""
+        now = time.time()
+        data = []
+        for op, key, value in entries:
+            seq = self.next_seq
+            self.next_seq += 1
+            data.append(entry_header.pack(seq, now))
+            data.append(pack_record(op, key, value))
+            self._remember((seq, now, op, key, value))
+        data = ''.join(data)
+        self._file.write(data)
+        self._file.flush()
+        self._file_bytes += len(data)
+        self.last_time = now
+        if self._file_bytes >= self.segment_bytes:
+            self._new_segment()
+
+        waiters, self._waiters = self._waiters, []
+        for callback in waiters:
+            callback()
+        return self.next_seq - 1
+
+    def _remember(self, entry):
+        self._recent.append(entry)
+        self._recent_bytes += len(entry[3]) + len(entry[4])
+        while self._recent_bytes > self.recent_bytes and len(self._recent) > 1:
+            old = self._recent.popleft()
+            self._recent_bytes -= len(old[3]) + len(old[4])
+
+    def wait(self, callback):
+        "Call callback (once) the next time entries are appended"
+        self._waiters.append(callback)
+
+    def unwait(self, callback):
+        if callback in self._waiters:
+            self._waiters.remove(callback)
+
+    def read_from(self, seq, limit = 1000, max_bytes = 4 * 1024 * 1024):
+        """Up to 'limit' entries (seq, time, op, key, value) starting with
+           sequence number 'seq'. Raises Gone if they've been dropped
+           from the log"""
+        if seq < self.first_seq or seq > self.next_seq:
+            raise Gone('%d is not in the log (%d to %d)'
+                       % (seq, self.first_seq, self.next_seq))
+        if self._recent and self._recent[0][0] <= seq:
+            return self._read_recent(seq, limit, max_bytes)
+
+        for i in range(len(self._segments) - 1, -1, -1):
+            if self._segments[i][0] <= seq:
+                break
+        ret = []
+        size = 0
+        for first, filename in self._segments[i:]:
+            with open(filename, 'rb') as f:
+                for entry in self._read(f):
+                    if entry[0] < seq:
+                        continue
+                    ret.append(entry)
+                    size += len(entry[3]) + len(entry[4])
+                    if len(ret) >= limit or size >= max_bytes:
+                        return ret
+        return ret
+
+    def _read_recent(self, seq, limit, max_bytes):
+        ret = []
+        size = 0
+        # the entries are numbered consecutively
+        for entry in islice(self._recent, seq - self._recent[0][0], None):
+            ret.append(entry)
+            size += len(entry[3]) + len(entry[4])
+            if len(ret) >= limit or size >= max_bytes:
+                break
+        return ret
+
+    def _read(self, f):
+        "Yields the whole entries in a segment file"
+        while True:
+            header = f.read(entry_header.size + record_header.size)
+            if len(header) < entry_header.size + record_header.size:
+                return
+            seq, entry_time = entry_header.unpack(header[:entry_header.size])
+            op, keylen, valuelen = record_header.unpack(
+                header[entry_header.size:])
+            data = f.read(keylen + valuelen)
+            if len(data) < keylen + valuelen:
+                return
+            yield seq, entry_time, op, data[:keylen], data[keylen:]
+
+    def stats(self):
+        return {
+            'log_id': self.log_id,
+            'first_seq': self.first_seq,
+            'last_seq': self.next_seq - 1,
+            'segments': len(self._segments),
+            'last_write': self.last_time,
+            }